@@ -0,0 +1,99 @@
+"""In memory stand-in for the Docker client, so benchmarks run without a daemon."""
+import sys
+import types
+
+
+class FakeContainer(object):
+
+    def __init__(self, name: str, image: str):
+        self.name = name
+        self.image = image
+        self.status = "created"
+
+    def start(self):
+        self.status = "running"
+
+    def stop(self):
+        self.status = "exited"
+
+    def restart(self):
+        self.status = "running"
+
+    def logs(self, **kwargs):
+        return b""
+
+    def stats(self, stream=False, decode=False):
+        return iter([])
+
+
+class FakeContainers(object):
+
+    def __init__(self):
+        self._containers = {}
+
+    def create(self, image: str, name: str="", **kwargs):
+        container = FakeContainer(name, image)
+        self._containers[name] = container
+        return container
+
+    def get(self, name: str):
+        if name not in self._containers:
+            raise KeyError(name)
+        return self._containers[name]
+
+    def list(self, all: bool=False, filters: dict=None):
+        prefix = (filters or {}).get("name", "")
+        return [c for c in self._containers.values()
+                if prefix in c.name and (all or c.status == "running")]
+
+
+class FakeImage(object):
+
+    def __init__(self, tags):
+        self.tags = tags
+
+
+class FakeImages(object):
+
+    def __init__(self, image: str, versions):
+        self._images = [FakeImage([f"{image}:{v}"]) for v in versions]
+
+    def list(self, name: str=""):
+        return self._images
+
+
+class FakeDockerClient(object):
+
+    def __init__(self, image: str="foundryvtt", versions=("0.7.9", "0.8.9", "9.280")):
+        self.containers = FakeContainers()
+        self.images = FakeImages(image, versions)
+
+
+def install():
+    """Register a minimal ``docker`` module when the real package is not installed.
+
+    The package only needs ``docker.client.from_env`` and ``docker.types.LogConfig``
+    at import time; benchmarks always inject a ``FakeDockerClient`` afterwards.
+    """
+    try:
+        import docker  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    class LogConfig(object):
+        class types(object):
+            JSON = "json-file"
+
+        def __init__(self, type: str="", config: dict=None):
+            self.type = type
+            self.config = config or {}
+
+    docker = types.ModuleType("docker")
+    client = types.ModuleType("docker.client")
+    docker_types = types.ModuleType("docker.types")
+    client.from_env = FakeDockerClient
+    docker_types.LogConfig = LogConfig
+    docker.client = client
+    docker.types = docker_types
+    sys.modules.update({"docker": docker, "docker.client": client, "docker.types": docker_types})
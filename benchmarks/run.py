@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Time the backup, restore, listing, cleanup and instance operations on synthetic data.
+
+Runs offline against a temporary Foundry root with a fake Docker client and
+prints a JSON report, e.g.::
+
+    python benchmarks/run.py --shape many-small --scale 0.5 --output before.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_PATH)
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_PATH), "src"))
+
+import fakedocker  # noqa: E402
+fakedocker.install()
+
+from foundryvtt import Foundry, FoundryRepo  # noqa: E402
+from foundryvtt.backupengine import BackupEngine  # noqa: E402
+from foundryvtt.backupmgr import BackupManager  # noqa: E402
+from foundryvtt.retention import RetentionPolicy  # noqa: E402
+from synthetic import SHAPES, make_fake_backups, make_instance_tree, scaled  # noqa: E402
+
+
+def check_positive(value):
+    ivalue = int(value)
+    if ivalue <= 0:
+        raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
+    return ivalue
+
+
+class Bench(object):
+
+    def __init__(self, root: str, args):
+        self._root = root
+        self._args = args
+        self._results = {}
+        self._docker = fakedocker.FakeDockerClient()
+        self._foundry = None
+
+    @property
+    def results(self):
+        return self._results
+
+    def measure(self, name: str, func, setup=None, repeat: int=None, **info):
+        """Run ``func`` ``repeat`` times, ``setup`` before each run is not timed."""
+        if self._args.only and not any(name.startswith(o) for o in self._args.only):
+            return
+        times = []
+        result = None
+        for _ in range(repeat or self._args.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+        entry = {"runs": len(times), "min": min(times), "median": statistics.median(times), "max": max(times)}
+        entry.update(info)
+        if "bytes" in info:
+            entry["bytes_per_sec"] = info["bytes"] / entry["median"] if entry["median"] else 0
+        self._results[name] = entry
+        print(f"{name}: {entry['median'] * 1000:.1f} ms", file=sys.stderr)
+        return result
+
+    def setup_foundry(self):
+        path = os.path.join(self._root, "foundry")
+        self._foundry = Foundry(path)
+        self._foundry._docker_client = self._docker
+        os.makedirs(self._foundry.instances_path, exist_ok=True)
+        os.makedirs(self._foundry.backup_path, exist_ok=True)
+        self._foundry.write_settings()
+
+    def run(self):
+        self.setup_foundry()
+        self.bench_instances()
+        self.bench_backups()
+        self.bench_listing()
+
+    def bench_instances(self):
+        names = [f"inst-{i}" for i in range(self._args.instances)]
+        self.measure("create_instances", lambda: [self._foundry.create_instance(n, "9.280") for n in names],
+                     repeat=1, instances=len(names))
+        self.measure("get_instances", self._foundry.get_instances, instances=len(names))
+        self.measure("get_available_port", self._foundry.get_available_port, instances=len(names))
+        self.measure("get_statuses", self._foundry.get_statuses, instances=len(names))
+        self.measure("get_instances_reopen", lambda: Foundry(self._foundry.path).get_instances(), instances=len(names))
+        repo_path = os.path.join(self._root, "foundryvtt.repo")
+        paths = [self._foundry.path] + [os.path.join(self._root, f"host-{i}") for i in range(len(names) * 50)]
+        with open(repo_path, "wt") as f:
+            json.dump({"instances": paths}, f)
+        self.measure("load_repo", lambda: FoundryRepo(repo_path).main, hosts=len(paths))
+
+    def bench_backups(self):
+        shape = scaled(SHAPES[self._args.shape], self._args.scale)
+        instance = self._foundry.get_instance("inst-0")
+        size = make_instance_tree(instance.instance_data_path, shape)
+        manager = self._foundry.backup_manager
+        engine = BackupEngine(self._args.codec, None, self._args.workers)
+        info = {"bytes": size, "shape": self._args.shape, "scale": self._args.scale}
+
+        self.measure("backup_full", lambda: manager.create_full_backup(instance, engine=engine),
+                     setup=self.clear_backups, **info)
+        self.measure("backup_world", lambda: manager.create_world_backup(instance, engine=engine),
+                     setup=self.clear_backups, **info)
+        self.measure("backup_world_per_world", lambda: manager.create_world_backups(instance, engine=engine, force=True),
+                     setup=self.clear_backups, **info)
+        self.measure("backup_world_per_world_unchanged", lambda: manager.create_world_backups(instance, engine=engine),
+                     **info)
+        self.measure("backup_full_dedup", lambda: manager.create_full_backup(instance, dedup=True),
+                     setup=self.clear_backups, **info)
+        self.measure("backup_full_dedup_incremental", lambda: manager.create_full_backup(instance, dedup=True),
+                     **info)
+
+        self.clear_backups()
+        manager.create_world_backup(instance, engine=engine)
+        backup = manager.get_world_backups()[0]
+        self.measure("restore_world", lambda: manager.restore_world_backup(backup, instance), **info)
+        self.measure("restore_world_changed", lambda: manager.restore_world_backup(backup, instance),
+                     setup=lambda: shutil.rmtree(instance.world_path), **info)
+
+    def bench_listing(self):
+        self.clear_backups()
+        instances = [f"inst-{i}" for i in range(self._args.instances)]
+        worlds = [f"world-{i}" for i in range(20)]
+        make_fake_backups(self._foundry.backup_path, self._args.backups, instances, worlds)
+        info = {"backups": self._args.backups}
+        self.measure("get_backups_cold", lambda: BackupManager(self._foundry).get_backups(),
+                     setup=self.drop_catalog, **info)
+        manager = BackupManager(self._foundry)
+        manager.get_backups()
+        self.measure("get_backups_warm", manager.get_backups, **info)
+        self.measure("get_backups_reopen", lambda: BackupManager(self._foundry).get_backups(), **info)
+        policy = RetentionPolicy()
+        self.measure("plan_retention", lambda: manager.plan_retention(policy), **info)
+        # Deleting backups is destructive, every run starts from a fresh copy of the fake archives
+        source = os.path.join(self._root, "fake-backups")
+        shutil.copytree(self._foundry.backup_path, source)
+        self.measure("cleanup_world", lambda: BackupManager(self._foundry).cleanup_world(old_count=10),
+                     setup=lambda: self.restore_backups(source), **info)
+        self.measure("apply_retention", lambda: self._foundry.prune_backups(policy),
+                     setup=lambda: self.restore_backups(source), **info)
+
+    def clear_backups(self):
+        shutil.rmtree(self._foundry.backup_path, ignore_errors=True)
+        os.makedirs(self._foundry.backup_path)
+        self.drop_catalog()
+
+    def drop_catalog(self):
+        try:
+            os.remove(self._foundry.backup_manager.catalog.path)
+        except FileNotFoundError:
+            pass
+
+    def restore_backups(self, source: str):
+        shutil.rmtree(self._foundry.backup_path)
+        shutil.copytree(source, self._foundry.backup_path)
+        self._foundry._backup_manager = BackupManager(self._foundry)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCH_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+def compare(results: dict, baseline_path: str):
+    """Print the median of each benchmark relative to a previous report."""
+    with open(baseline_path, "rt") as f:
+        baseline = json.load(f)
+    print(f"Compared to {baseline.get('commit', '')[:10] or baseline_path}:", file=sys.stderr)
+    for name, entry in results.items():
+        base = baseline["results"].get(name)
+        if not base or not base["median"]:
+            continue
+        ratio = entry["median"] / base["median"]
+        print(f"\t{name}: {ratio:.2f}x ({base['median'] * 1000:.1f} ms -> {entry['median'] * 1000:.1f} ms)",
+              file=sys.stderr)
+
+
+def main(args):
+    root = tempfile.mkdtemp(prefix="fvtt-bench-", dir=args.tmp or None)
+    bench = Bench(root, args)
+    # Keep the backup and instance logs out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "wt")
+    try:
+        bench.run()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "results": bench.results,
+        }
+    if args.baseline:
+        compare(bench.results, args.baseline)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "wt") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark foundryvtt backup and instance operations")
+    parser.add_argument("--shape", metavar="shape", default="many-small", choices=list(SHAPES),
+                        help=f"Shape of the synthetic data tree ({', '.join(SHAPES)})")
+    parser.add_argument("--scale", metavar="scale", default=1.0, type=float,
+                        help="Multiplier for the records, images and assets of the shape")
+    parser.add_argument("--instances", metavar="instances", default=20, type=check_positive,
+                        help="The number of instances to create")
+    parser.add_argument("--backups", metavar="backups", default=5000, type=check_positive,
+                        help="The number of fake archives in the backup directory")
+    parser.add_argument("--repeat", metavar="repeat", default=3, type=check_positive,
+                        help="The number of runs of each benchmark")
+    parser.add_argument("--codec", metavar="codec", default="deflate",
+                        help="Compression codec of the backups")
+    parser.add_argument("--workers", metavar="workers", default=1, type=check_positive,
+                        help="Number of processes compressing in parallel")
+    parser.add_argument("--only", metavar="only", action="append",
+                        help="Only run the benchmarks whose name starts with this prefix")
+    parser.add_argument("--tmp", metavar="tmp", default="",
+                        help="Where to create the temporary Foundry root")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the temporary Foundry root")
+    parser.add_argument("--baseline", metavar="baseline", default="",
+                        help="A previous JSON report to compare the results with")
+    parser.add_argument("-o", "--output", metavar="output", default="",
+                        help="Write the JSON report to this file instead of stdout")
+    main(parser.parse_args())
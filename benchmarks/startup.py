@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Time the startup of ``fvtt`` commands that must stay fast, from cron or shell completion.
+
+Runs each command in a fresh interpreter against a temporary Foundry root
+filled with fake archives, reports the wall time and the slowest imports,
+and fails when a command is over budget or imports a heavy dependency::
+
+    python benchmarks/startup.py --budget 150
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(BENCH_PATH)
+FVTT = os.path.join(ROOT_PATH, "bin", "fvtt")
+sys.path.insert(0, BENCH_PATH)
+
+from synthetic import make_fake_backups  # noqa: E402
+
+COMMANDS = {
+    "backup-list": ["backup", "list"],
+    "help": ["--help"],
+    }
+# Only the commands touching containers, connections or metrics may load these
+HEAVY_MODULES = ["docker", "requests", "urllib3", "psutil", "packaging", "http.server", "multiprocessing",
+                 "concurrent.futures"]
+
+
+def check_positive(value):
+    ivalue = int(value)
+    if ivalue <= 0:
+        raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
+    return ivalue
+
+
+def make_root(path: str, backups: int):
+    os.makedirs(os.path.join(path, "instances"))
+    with open(os.path.join(path, "settings.db"), "wt") as f:
+        json.dump({"backup": "backup", "instances": "instances", "production_instance": "prod",
+                   "docker_image": "foundryvtt"}, f)
+    make_fake_backups(os.path.join(path, "backup"), backups, ["prod"], [f"world-{i}" for i in range(10)])
+
+
+def run_command(root: str, args, importtime: bool=False):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.join(ROOT_PATH, "src"),
+                                                                      os.environ.get("PYTHONPATH")])))
+    cmd = [sys.executable] + (["-X", "importtime"] if importtime else []) + [FVTT, "-p", root] + args
+    start = time.perf_counter()
+    process = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if process.returncode:
+        raise RuntimeError(f"{' '.join(args)} failed: {process.stderr.strip()}")
+    return elapsed, process.stderr
+
+
+def parse_importtime(output: str):
+    """Cumulative microseconds of each imported module, from the ``-X importtime`` output."""
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def main(args):
+    root = tempfile.mkdtemp(prefix="fvtt-startup-", dir=args.tmp or None)
+    results = {}
+    failed = False
+    try:
+        make_root(root, args.backups)
+        # The first listing builds the catalog, the budget is for the following ones
+        run_command(root, COMMANDS["backup-list"])
+        for name, command in COMMANDS.items():
+            times = [run_command(root, command)[0] for _ in range(args.repeat)]
+            modules = parse_importtime(run_command(root, command, importtime=True)[1])
+            heavy = sorted(m for m in modules if m.split(".")[0] in HEAVY_MODULES or m in HEAVY_MODULES)
+            slowest = sorted(modules.items(), key=lambda i: i[1], reverse=True)[:args.top]
+            results[name] = {"runs": len(times), "min": min(times), "median": statistics.median(times),
+                             "max": max(times), "modules": len(modules), "heavy": heavy,
+                             "slowest": [{"module": m, "ms": t / 1000} for m, t in slowest]}
+            over = statistics.median(times) * 1000 > args.budget
+            print(f"{name}: {statistics.median(times) * 1000:.1f} ms{' over budget' if over else ''}",
+                  file=sys.stderr)
+            if heavy:
+                print(f"\t{name} imports {', '.join(heavy)}", file=sys.stderr)
+            failed = failed or over or bool(heavy)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print(json.dumps({"budget_ms": args.budget, "backups": args.backups, "python": sys.version.split()[0],
+                      "results": results}, indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of fvtt commands")
+    parser.add_argument("--budget", metavar="budget", default=150, type=check_positive,
+                        help="Maximum median wall time of each command in ms")
+    parser.add_argument("--backups", metavar="backups", default=1000, type=check_positive,
+                        help="The number of fake archives in the backup directory")
+    parser.add_argument("--repeat", metavar="repeat", default=5, type=check_positive,
+                        help="The number of runs of each command")
+    parser.add_argument("--top", metavar="top", default=10, type=check_positive,
+                        help="The number of slowest imports to report")
+    parser.add_argument("--tmp", metavar="tmp", default="",
+                        help="Where to create the temporary Foundry root")
+    sys.exit(main(parser.parse_args()))
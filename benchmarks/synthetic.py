@@ -0,0 +1,109 @@
+"""Synthetic Foundry data trees and backup directories."""
+import datetime
+import json
+import os
+import random
+
+# worlds: number of worlds, db_files/db_records: LevelDB or NeDB files per world and
+# JSON records in each, images: incompressible scene images per world of image_size
+# bytes, assets: shared incompressible asset files of asset_size bytes
+SHAPES = {
+    "few-large": {"worlds": 2, "db_files": 12, "db_records": 4000, "images": 40, "image_size": 256 * 1024,
+                  "assets": 100, "asset_size": 128 * 1024},
+    "many-small": {"worlds": 40, "db_files": 6, "db_records": 150, "images": 4, "image_size": 64 * 1024,
+                   "assets": 100, "asset_size": 32 * 1024},
+    "assets-heavy": {"worlds": 4, "db_files": 6, "db_records": 300, "images": 10, "image_size": 128 * 1024,
+                     "assets": 1500, "asset_size": 96 * 1024},
+    "db-heavy": {"worlds": 6, "db_files": 20, "db_records": 3000, "images": 2, "image_size": 64 * 1024,
+                 "assets": 20, "asset_size": 32 * 1024},
+    }
+
+DB_NAMES = ["actors", "items", "journal", "scenes", "tables", "macros", "playlists", "messages", "combats",
+            "cards", "folders", "settings", "users", "fog"]
+
+
+def scaled(shape: dict, scale: float):
+    results = dict(shape)
+    for key in ("db_records", "images", "assets"):
+        results[key] = max(1, int(shape[key] * scale))
+    return results
+
+
+def make_record(rng: random.Random, i: int):
+    return {
+        "_id": f"{rng.getrandbits(64):016x}",
+        "name": f"Entity {i}",
+        "type": rng.choice(["npc", "character", "weapon", "spell", "loot"]),
+        "img": f"worlds/images/token-{rng.randrange(500)}.webp",
+        "data": {"hp": rng.randrange(200), "ac": rng.randrange(10, 25), "notes": "lorem ipsum " * rng.randrange(1, 20)},
+        "flags": {},
+        }
+
+
+def make_world(path: str, name: str, shape: dict, rng: random.Random):
+    world_path = os.path.join(path, name)
+    data_path = os.path.join(world_path, "data")
+    scenes_path = os.path.join(world_path, "scenes")
+    os.makedirs(data_path, exist_ok=True)
+    os.makedirs(scenes_path, exist_ok=True)
+    with open(os.path.join(world_path, "world.json"), "wt") as f:
+        json.dump({"name": name, "title": name.title(), "system": "dnd5e", "coreVersion": "9.280"}, f)
+    total = 0
+    for i in range(shape["db_files"]):
+        db_name = DB_NAMES[i % len(DB_NAMES)] + (f"-{i // len(DB_NAMES)}" if i >= len(DB_NAMES) else "")
+        with open(os.path.join(data_path, f"{db_name}.db"), "wt") as f:
+            for j in range(shape["db_records"]):
+                total += f.write(json.dumps(make_record(rng, j)) + "\n")
+    for i in range(shape["images"]):
+        total += write_random(os.path.join(scenes_path, f"scene-{i}.webp"), shape["image_size"], rng)
+    return total
+
+
+def make_instance_tree(data_path: str, shape: dict, seed: int=0):
+    """Fill an instance data dir, return its size in bytes."""
+    rng = random.Random(seed)
+    worlds_path = os.path.join(data_path, "Data", "worlds")
+    assets_path = os.path.join(data_path, "Data", "assets")
+    os.makedirs(worlds_path, exist_ok=True)
+    os.makedirs(assets_path, exist_ok=True)
+    os.makedirs(os.path.join(data_path, "Config"), exist_ok=True)
+    with open(os.path.join(data_path, "Config", "options.json"), "wt") as f:
+        json.dump({"port": 30000, "upnp": False}, f)
+    total = 0
+    for i in range(shape["worlds"]):
+        total += make_world(worlds_path, f"world-{i}", shape, rng)
+    for i in range(shape["assets"]):
+        folder = os.path.join(assets_path, f"pack-{i % 20}")
+        os.makedirs(folder, exist_ok=True)
+        total += write_random(os.path.join(folder, f"asset-{i}.webp"), shape["asset_size"], rng)
+    return total
+
+
+def write_random(path: str, size: int, rng: random.Random):
+    with open(path, "wb") as f:
+        f.write(rng.randbytes(size) if hasattr(rng, "randbytes") else os.urandom(size))
+    return size
+
+
+def make_fake_backups(backup_path: str, count: int, instances, worlds, seed: int=0):
+    """Create ``count`` small fake archives named like real ones, spread over the last two years."""
+    rng = random.Random(seed)
+    os.makedirs(backup_path, exist_ok=True)
+    now = datetime.datetime.now()
+    names = set()
+    while len(names) < count:
+        date = now - datetime.timedelta(seconds=rng.randrange(2 * 365 * 24 * 3600))
+        stamp = date.strftime("%Y%m%d-%H%M%S")
+        kind = rng.random()
+        if kind < 0.2:
+            names.add(f"full-{stamp}.zip")
+        elif kind < 0.4:
+            names.add(f"world-{stamp}.zip")
+        elif kind < 0.5:
+            names.add(f"assets-{rng.choice(instances)}-{stamp}.zip")
+        else:
+            names.add(f"world-{rng.choice(instances)}-{rng.choice(worlds)}-{stamp}.zip")
+    for name in names:
+        with open(os.path.join(backup_path, name), "wb") as f:
+            f.write(b"\0" * rng.randrange(64, 512))
+    return sorted(names)
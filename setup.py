@@ -17,11 +17,13 @@ setuptools.setup(
     },
     classifiers=[
         "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.8",
         "License :: OSI Approved :: MIT License",
-        "Operating System :: Centos 8",
+        "Operating System :: POSIX :: Linux",
     ],
     package_dir={"": "src"},
     scripts=['bin/fvtt'],
     packages=setuptools.find_packages(where="src"),
-    python_requires=">=3.6",
+    python_requires=">=3.8",
 )
\ No newline at end of file
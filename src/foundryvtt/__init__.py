@@ -1,6 +1,24 @@
-from .backup import Backup
-from .foundry import Foundry, FoundryRepo
-from .instance import FoundryInstance
+import importlib
 
+# Submodules are only imported on first access, so a command pays for what it uses
+_EXPORTS = {
+    "Backup": ".backup",
+    "Foundry": ".foundry",
+    "FoundryRepo": ".foundry",
+    "FoundryInstance": ".instance",
+    }
 
-__all__ = ["Backup", "Foundry", "FoundryRepo", "FoundryInstance"]
\ No newline at end of file
+
+__all__ = ["Backup", "Foundry", "FoundryRepo", "FoundryInstance"]
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -2,15 +2,45 @@ import datetime
 import os
 import re
 
+# <type>[-<instance>[-<world>]]-<timestamp>, e.g. world-prod-my-campaign-20240101-120000.zip
+BACKUP_FILE_RE = re.compile(r"(\w+?)(?:-(.+))?-(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})\.(zip|manifest)$")
+
 
 class Backup(object):
 
-    def __init__(self, path: str, file: str, date: str):
+    @classmethod
+    def Parse(cls, file: str):
+        """Return the (type, date, instance, world) encoded in a backup file name, None if it is not a backup.
+
+        The instance is the first dash separated part after the type, the world
+        is the rest, so the world name is wrong for instance names with dashes;
+        the catalog records both explicitly when a backup is created.
+        """
+        match = BACKUP_FILE_RE.match(file)
+        if not match:
+            return None
+        date = datetime.datetime(*(int(x) for x in match.groups()[2:8]))
+        instance, world = "", ""
+        if match.group(2):
+            if match.group(1) == "world":
+                instance, _, world = match.group(2).partition("-")
+            else:
+                instance = match.group(2)
+        return match.group(1), date, instance, world
+
+    def __init__(self, path: str, file: str, date: str, type: str="", instance: str="", size: int=0,
+                 files: int=0, checksum: str="", world: str=""):
         self._path = path
         self._file = file
         self._full_path = os.path.join(self._path, self._file)
-        self._name = self._file[:-4]
+        self._name, self._extension = os.path.splitext(self._file)
         self._date = date
+        self._type = type
+        self._instance = instance
+        self._size = size
+        self._files = files
+        self._checksum = checksum
+        self._world = world
 
     @property
     def file(self):
@@ -28,6 +58,34 @@ class Backup(object):
     def name(self):
         return self._name
 
+    @property
+    def type(self):
+        return self._type
+
+    @property
+    def instance(self):
+        return self._instance
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def files(self):
+        return self._files
+
+    @property
+    def checksum(self):
+        return self._checksum
+
+    @property
+    def world(self):
+        return self._world
+
+    @property
+    def is_manifest(self):
+        return self._extension == ".manifest"
+
     def __str__(self):
         return f"Name: {self.name} date: {self.date}"
     
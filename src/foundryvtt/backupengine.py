@@ -0,0 +1,440 @@
+import collections
+import hashlib
+import json
+import math
+import os
+import re
+import time
+import zipfile
+import zlib
+from typing import Callable, List, Tuple
+from .throttle import Throttle, run_low_priority
+from . import zipcompat
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# Files above this size are streamed by the main process instead of being sent to a worker
+PARALLEL_LIMIT = 16 * 1024 * 1024
+PROBE_SIZE = 64 * 1024
+ENTROPY_THRESHOLD = 7.5
+# Archive member holding the size and sha256 of every file, outside of the backup name folder
+INTEGRITY_FILE = ".integrity.json"
+
+CODECS = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+    }
+if hasattr(zipfile, "ZIP_ZSTANDARD"):
+    CODECS["zstd"] = zipfile.ZIP_ZSTANDARD
+
+COMPRESSED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".webp", ".gif", ".avif",
+    ".mp3", ".ogg", ".oga", ".opus", ".m4a", ".aac", ".flac",
+    ".webm", ".mp4", ".m4v", ".mkv",
+    ".zip", ".gz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".woff", ".woff2", ".pdf",
+    }
+
+
+def entropy(sample: bytes):
+    """Shannon entropy of ``sample`` in bits per byte."""
+    if not sample:
+        return 0.0
+    size = len(sample)
+    return -sum(c / size * math.log2(c / size) for c in collections.Counter(sample).values())
+
+
+def is_compressed(path: str, sample: bytes=b""):
+    """Guess if the content of ``path`` is already compressed from its extension or a sample of it."""
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    return len(sample) >= 4096 and entropy(sample) >= ENTROPY_THRESHOLD
+
+
+def compress_file(path: str, compress_type: int, compresslevel: int=None):
+    """Read and compress a whole file, run inside the worker processes."""
+    with open(path, "rb") as f:
+        data = f.read()
+    crc = zlib.crc32(data)
+    digest = hashlib.sha256(data).hexdigest()
+    if compress_type != zipfile.ZIP_STORED and not is_compressed(path, data[:PROBE_SIZE]):
+        compressor = zipcompat.get_compressor(compress_type, compresslevel)
+        packed = compressor.compress(data) + compressor.flush()
+        if len(packed) < len(data):
+            return compress_type, crc, digest, len(data), packed
+    return zipfile.ZIP_STORED, crc, digest, len(data), data
+
+
+ZINFO_FIELDS = ["date_time", "compress_type", "comment", "extra", "create_system", "create_version",
+                "extract_version", "reserved", "flag_bits", "volume", "internal_attr", "external_attr",
+                "header_offset", "CRC", "compress_size", "file_size"]
+
+
+class Checkpoint(object):
+    """Progress of an archive being written, saved next to its ``.part`` file.
+
+    Every ``interval`` seconds the entries fully written so far are saved with
+    the offset where the next one starts. Resuming truncates the ``.part`` file
+    at that offset and rebuilds the zip directory from the saved entries, so
+    only the files written after the last checkpoint are read again.
+    """
+
+    def __init__(self, path: str, sources: List[Tuple[str, str]], interval: float):
+        self._path = path
+        self._sources = [list(source) for source in sources]
+        self._interval = interval
+        self._saved = time.monotonic()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def sources(self):
+        return self._sources
+
+    def load(self):
+        """The saved (offset, entries), None when there is nothing to resume for these sources."""
+        try:
+            with open(self._path, "rt") as f:
+                info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if info.get("sources") != self._sources:
+            return None
+        hashes = info.get("hashes", {})
+        entries = []
+        for fields in info["entries"]:
+            zinfo = zipfile.ZipInfo(fields["filename"])
+            for name in ZINFO_FIELDS:
+                value = fields[name]
+                if name in ("comment", "extra"):
+                    value = bytes.fromhex(value)
+                elif name == "date_time":
+                    value = tuple(value)
+                setattr(zinfo, name, value)
+            entries.append(zinfo)
+        return info["offset"], entries, hashes
+
+    def save_if_due(self, zf: zipfile.ZipFile, stats: 'BackupStats'):
+        if time.monotonic() - self._saved >= self._interval:
+            self.save(zf, stats)
+
+    def save(self, zf: zipfile.ZipFile, stats: 'BackupStats'):
+        # Everything before the offset must be in the file before it is recorded
+        offset = zipcompat.end_offset(zf)
+        entries = []
+        for zinfo in zf.filelist:
+            fields = {name: getattr(zinfo, name) for name in ZINFO_FIELDS}
+            fields["filename"] = zinfo.filename
+            fields["comment"] = zinfo.comment.hex()
+            fields["extra"] = zinfo.extra.hex()
+            entries.append(fields)
+        info = {"sources": self._sources, "offset": offset, "entries": entries, "hashes": stats.hashes}
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "wt") as f:
+            json.dump(info, f)
+        os.replace(tmp_path, self._path)
+        self._saved = time.monotonic()
+
+    def remove(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+
+class BackupStats(object):
+
+    def __init__(self):
+        self._bytes = 0
+        self._stored_bytes = 0
+        self._files = 0
+        self._hashes = {}
+        self._checksum = None
+        self._start = time.monotonic()
+        self._end = None
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    @property
+    def stored_bytes(self):
+        return self._stored_bytes
+
+    @property
+    def files(self):
+        return self._files
+
+    @property
+    def hashes(self):
+        """[size, sha256] of the files added, by archive name."""
+        return self._hashes
+
+    @property
+    def checksum(self):
+        """sha256 of the archive or manifest written, None until it is complete."""
+        return self._checksum
+
+    @property
+    def elapsed(self):
+        end = self._end if self._end is not None else time.monotonic()
+        return end - self._start
+
+    @property
+    def bytes_per_sec(self):
+        elapsed = self.elapsed
+        return self._bytes / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def files_per_sec(self):
+        elapsed = self.elapsed
+        return self._files / elapsed if elapsed > 0 else 0.0
+
+    def add(self, size: int, stored: int=None, name: str="", digest: str=""):
+        self._bytes += size
+        self._stored_bytes += size if stored is None else stored
+        self._files += 1
+        if name:
+            self._hashes[name] = [size, digest]
+
+    def stop(self, checksum: str=None):
+        self._end = time.monotonic()
+        self._checksum = checksum
+
+    def __str__(self):
+        return (f"{self.files} files, {self.bytes / (1024 * 1024):.1f} MiB "
+                f"({self.stored_bytes / (1024 * 1024):.1f} MiB stored) in {self.elapsed:.1f}s "
+                f"({self.bytes_per_sec / (1024 * 1024):.1f} MiB/s, {self.files_per_sec:.1f} files/s)")
+
+
+class BackupEngine(object):
+    """Walk source trees once and stream every file straight into a zip archive.
+
+    The archive is written next to its final location under a hidden ``.part``
+    name and renamed into place once complete, so an interrupted run never
+    leaves a half-written ``.zip`` that ``BackupManager.get_backups`` would pick up.
+
+    With more than one worker, files are compressed in a process pool and the
+    main process only appends the compressed data to the archive. Content that
+    is already compressed is stored as is.
+
+    Reads are limited to ``max_rate`` bytes per second, or ``busy_rate`` while
+    the ``busy`` callable given to ``create`` reports an active session, and
+    run with the ``nice`` and ``ionice`` priority. With ``checkpoint`` seconds,
+    an interrupted archive keeps its ``.part`` file and resumes on the next run.
+    """
+
+    def __init__(self, codec: str="deflate", level: int=None, workers: int=1, max_rate: float=0,
+                 busy_rate: float=0, nice: int=0, ionice: str="", checkpoint: float=0):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}, expected one of {', '.join(CODECS)}")
+        self._codec = codec
+        self._compression = CODECS[codec]
+        self._compresslevel = level
+        self._workers = max(1, workers)
+        self._max_rate = max_rate
+        self._busy_rate = busy_rate
+        self._nice = nice
+        self._ionice = ionice
+        self._checkpoint = checkpoint
+
+    @property
+    def codec(self):
+        return self._codec
+
+    @property
+    def level(self):
+        return self._compresslevel
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def max_rate(self):
+        return self._max_rate
+
+    @property
+    def busy_rate(self):
+        return self._busy_rate
+
+    @property
+    def adaptive(self):
+        return self._busy_rate > 0
+
+    @property
+    def checkpoint(self):
+        return self._checkpoint
+
+    def create(self, archive_path: str, sources: List[Tuple[str, str]], busy: Callable=None):
+        """Create ``archive_path`` from ``sources``, a list of (source dir, archive prefix)."""
+        return run_low_priority(lambda: self._create(archive_path, sources, busy), self._nice, self._ionice)
+
+    def _create(self, archive_path: str, sources: List[Tuple[str, str]], busy: Callable=None):
+        stats = BackupStats()
+        throttle = Throttle(self._max_rate, self._busy_rate, busy)
+        tmp_path = self.partial_path(archive_path)
+        checkpoint = Checkpoint(f"{tmp_path}.checkpoint", sources, self._checkpoint) if self._checkpoint else None
+        resumed = checkpoint.load() if checkpoint and os.path.exists(tmp_path) else None
+        try:
+            zf, writer = self._open(tmp_path, resumed, stats)
+            with zf:
+                done = set(zf.NameToInfo)
+                entries = (entry for src, prefix in sources for entry in self.walk(src, prefix)
+                           if entry[1] not in done)
+                if self._workers > 1 and self._compression != zipfile.ZIP_STORED:
+                    self._write_parallel(zf, entries, stats, throttle, checkpoint)
+                else:
+                    for path, arcname in entries:
+                        self.add_file(zf, path, arcname, stats, throttle, checkpoint)
+                self._write_integrity(zf, stats)
+            os.replace(tmp_path, archive_path)
+        except BaseException:
+            # Keep the partial archive when a checkpoint can resume it
+            if checkpoint is None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if checkpoint:
+            checkpoint.remove()
+        stats.stop(writer.hexdigest())
+        return stats
+
+    def _open(self, tmp_path: str, resumed, stats: BackupStats):
+        if not resumed:
+            return zipcompat.create(tmp_path, self._compression, self._compresslevel)
+        offset, entries, hashes = resumed
+        print(f"Resuming {tmp_path} after {len(entries)} entries")
+        zf, writer = zipcompat.resume(tmp_path, offset, entries, self._compression, self._compresslevel)
+        for zinfo in entries:
+            if not zinfo.is_dir():
+                size, digest = hashes.get(zinfo.filename, [zinfo.file_size, ""])
+                stats.add(size, zinfo.compress_size, zinfo.filename, digest)
+        return zf, writer
+
+    def _write_integrity(self, zf: zipfile.ZipFile, stats: BackupStats):
+        info = {"version": 1, "algorithm": "sha256", "files": stats.hashes}
+        zinfo = zipfile.ZipInfo(INTEGRITY_FILE, time.localtime()[:6])
+        zinfo.external_attr = 0o644 << 16
+        zf.writestr(zinfo, json.dumps(info), zipfile.ZIP_DEFLATED)
+
+    def partial_path(self, archive_path: str):
+        folder, file = os.path.split(archive_path)
+        return os.path.join(folder, f".{file}.part")
+
+    def find_partial(self, folder: str, prefix: str, src_dirs: List[str]):
+        """Name of an interrupted ``<prefix>-<timestamp>`` archive of ``src_dirs``, None if there is none."""
+        if not self._checkpoint:
+            return None
+        pattern = re.compile(rf"\.({re.escape(prefix)}-\d{{8}}-\d{{6}})\.zip\.part\.checkpoint$")
+        try:
+            files = sorted(os.listdir(folder), reverse=True)
+        except FileNotFoundError:
+            return None
+        for file in files:
+            match = pattern.match(file)
+            if not match:
+                continue
+            try:
+                with open(os.path.join(folder, file), "rt") as f:
+                    saved = json.load(f)["sources"]
+            except (OSError, ValueError, KeyError):
+                continue
+            if [src for src, _ in saved] == src_dirs and os.path.exists(os.path.join(folder, file[:-len(".checkpoint")])):
+                return match.group(1)
+        return None
+
+    def walk(self, src: str, prefix: str):
+        """Yield (path, arcname) for every directory and regular file under ``src``."""
+        if not os.path.isdir(src):
+            return
+        stack = [(src, prefix)]
+        while stack:
+            folder, arcfolder = stack.pop()
+            yield folder, arcfolder + "/"
+            try:
+                entries = sorted(os.scandir(folder), key=lambda e: e.name)
+            except FileNotFoundError:
+                continue
+            subdirs = []
+            for entry in entries:
+                arcname = f"{arcfolder}/{entry.name}"
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append((entry.path, arcname))
+                    elif entry.is_file():
+                        yield entry.path, arcname
+                except FileNotFoundError:
+                    continue
+            stack.extend(reversed(subdirs))
+
+    def add_file(self, zf: zipfile.ZipFile, path: str, arcname: str, stats: BackupStats, throttle: Throttle=None,
+                 checkpoint: Checkpoint=None):
+        try:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+            if zinfo.is_dir():
+                zf.writestr(zinfo, b"")
+                return
+            with open(path, "rb") as src:
+                sample = src.read(PROBE_SIZE)
+                src.seek(0)
+                zinfo.compress_type = self._compression
+                zipcompat.set_compress_level(zinfo, self._compresslevel)
+                if is_compressed(path, sample):
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                digest = hashlib.sha256()
+                with zf.open(zinfo, "w") as dest:
+                    while True:
+                        data = src.read(COPY_BUFFER_SIZE)
+                        if not data:
+                            break
+                        if throttle:
+                            throttle.consume(len(data))
+                        digest.update(data)
+                        dest.write(data)
+            stats.add(zinfo.file_size, zinfo.compress_size, arcname, digest.hexdigest())
+        except FileNotFoundError:
+            # The instance is live, files can disappear between the walk and the read
+            pass
+        if checkpoint:
+            checkpoint.save_if_due(zf, stats)
+
+    def _write_parallel(self, zf: zipfile.ZipFile, entries, stats: BackupStats, throttle: Throttle=None,
+                        checkpoint: Checkpoint=None):
+        from concurrent.futures import ProcessPoolExecutor
+        pending = collections.deque()
+        with ProcessPoolExecutor(self._workers) as pool:
+            for path, arcname in entries:
+                try:
+                    zinfo = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+                except FileNotFoundError:
+                    continue
+                if zinfo.is_dir() or zinfo.file_size > PARALLEL_LIMIT or is_compressed(path):
+                    self.add_file(zf, path, arcname, stats, throttle, checkpoint)
+                    continue
+                if throttle:
+                    # Workers read the whole file, account for it before handing it over
+                    throttle.consume(zinfo.file_size)
+                pending.append((zinfo, pool.submit(compress_file, path, self._compression, self._compresslevel)))
+                # Bound the compressed data waiting in memory
+                while len(pending) > self._workers * 2:
+                    self._write_compressed(zf, *pending.popleft(), stats, checkpoint)
+            while pending:
+                self._write_compressed(zf, *pending.popleft(), stats, checkpoint)
+
+    def _write_compressed(self, zf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, future, stats: BackupStats,
+                          checkpoint: Checkpoint=None):
+        try:
+            compress_type, crc, digest, size, data = future.result()
+        except FileNotFoundError:
+            return
+        zinfo.compress_type = compress_type
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        zinfo.compress_size = len(data)
+        zipcompat.write_compressed(zf, zinfo, data)
+        stats.add(size, len(data), zinfo.filename, digest)
+        if checkpoint:
+            checkpoint.save_if_due(zf, stats)
@@ -1,7 +1,16 @@
+import contextlib
 import datetime
 import os
-import re
+import threading
 from .backup import Backup
+from .backupengine import BackupEngine
+from .catalog import BackupCatalog
+from .dedupstore import DedupStore
+from .restoreengine import RestoreEngine
+from .retention import RetentionPlan, RetentionPolicy, plan_retention
+from .throttle import SessionMonitor
+from .sync import BackupSync, SyncTarget
+from .verify import BackupVerifier
 from typing import List
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
@@ -16,26 +25,34 @@ class BackupManager(object):
 
     def __init__(self, foundry: 'Foundry'):
         self._foundry = foundry
+        self._catalog = None
+        self._names_lock = threading.Lock()
+        self._reserved_names = set()
 
     @property
     def backup_path(self):
         return self._foundry.backup_path
 
+    @property
+    def dedup_store(self):
+        return DedupStore(self.backup_path)
+
+    @property
+    def catalog(self):
+        with self._names_lock:
+            if not self._catalog:
+                self._catalog = BackupCatalog(self.backup_path)
+        return self._catalog
+
     def get_backups(self):
         worlds = []
         fulls = []
 
-        for file in os.listdir(self.backup_path):
-            if re.match(r"(\w+)-(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})\.zip", file):
-                backup_info = re.findall(r"(\w+)-(\d{4})(\d{2})(\d{2})-(\d{2})(\d{2})(\d{2})\.zip", file)
-                date_parts = (int(x) for x in backup_info[0][1:])
-                backup_type = backup_info[0][0]
-                date = datetime.datetime(*date_parts)
-                backup = Backup(self.backup_path, file, date)
-                if backup_type == "world":
-                    worlds.append(backup)
-                else:
-                    fulls.append(backup)
+        for backup in self.catalog.backups():
+            if backup.type in ("world", "assets"):
+                worlds.append(backup)
+            else:
+                fulls.append(backup)
         worlds = sorted(worlds, key = lambda i: i.date, reverse=True)
         fulls = sorted(fulls, key = lambda i: i.date, reverse=True)
         return worlds, fulls
@@ -48,63 +65,206 @@ class BackupManager(object):
         worlds, _ = self.get_backups()
         return worlds
 
+    def get_backup(self, name: str):
+        worlds, fulls = self.get_backups()
+        for backup in worlds + fulls:
+            if name in (backup.name, backup.file):
+                return backup
+        return None
+
     def generate_backup_name(self, prefix: str, instance: 'FoundryInstance'):
         now = datetime.datetime.now()
-        return f"{prefix}-{now.strftime('%Y%m%d-%H%M%S')}"
+        with self._names_lock:
+            # Concurrent backups started in the same second get the next free second
+            while True:
+                name = f"{prefix}-{now.strftime('%Y%m%d-%H%M%S')}"
+                if name not in self._reserved_names and not self._backup_exists(name):
+                    self._reserved_names.add(name)
+                    return name
+                now += datetime.timedelta(seconds=1)
+
+    def resume_backup_name(self, prefix: str, instance: 'FoundryInstance', src_dirs: List[str],
+                           engine: BackupEngine=None):
+        """Name of an interrupted backup ``engine`` can resume, a new name otherwise."""
+        if engine:
+            name = engine.find_partial(self.backup_path, prefix, src_dirs)
+            with self._names_lock:
+                if name and name not in self._reserved_names:
+                    self._reserved_names.add(name)
+                    return name
+        return self.generate_backup_name(prefix, instance)
+
+    def _backup_exists(self, name: str):
+        return any(os.path.exists(os.path.join(self.backup_path, f"{name}{ext}")) for ext in (".zip", ".manifest"))
+
+    def create_full_backup(self, instance: 'FoundryInstance', dedup: bool=False, engine: BackupEngine=None,
+                           consistent: bool=False):
+        resume_engine = None if dedup or consistent else engine
+        backup_name = self.resume_backup_name(f"full-{instance.name}", instance, [instance.instance_data_path], resume_engine)
+        started = datetime.datetime.now()
+        with self._frozen_sources(instance, [(instance.instance_data_path, backup_name)], consistent) as sources:
+            if dedup:
+                return self._create_dedup_backup(backup_name, sources, instance, self.get_full_backups(), started=started)
+            return self._create_backup(backup_name, sources, instance, engine, started=started)
+
+    def create_world_backup(self, instance: 'FoundryInstance', dedup: bool=False, engine: BackupEngine=None,
+                            consistent: bool=False):
+        data_path = os.path.join(instance.instance_data_path, "Data")
+        src_dirs = [os.path.join(data_path, "worlds"), os.path.join(data_path, "assets")]
+        resume_engine = None if dedup or consistent else engine
+        backup_name = self.resume_backup_name(f"world-{instance.name}", instance, src_dirs, resume_engine)
+        sources = [
+            (os.path.join(data_path, "worlds"), f"{backup_name}/Data/worlds"),
+            (os.path.join(data_path, "assets"), f"{backup_name}/Data/assets"),
+            ]
+        started = datetime.datetime.now()
+        with self._frozen_sources(instance, sources, consistent) as sources:
+            if dedup:
+                return self._create_dedup_backup(backup_name, sources, instance, self.get_world_backups(),
+                                                 started=started)
+            return self._create_backup(backup_name, sources, instance, engine, started=started)
+
+    def create_world_backups(self, instance: 'FoundryInstance', dedup: bool=False, engine: BackupEngine=None,
+                             jobs: int=2, force: bool=False, consistent: bool=False):
+        """Write one archive per world and one for the shared assets, ``jobs`` at a time.
+
+        Unless ``force`` is set, the worlds and assets unchanged since their
+        last backup, according to the instance data index, are skipped. With
+        ``consistent``, every archive is built from the same snapshot.
+        """
+        data_path = os.path.join(instance.instance_data_path, "Data")
+        changed = instance.changed_worlds()
+        worlds = instance.tracker.children("Data/worlds") if force else changed
+        backups = self.get_world_backups()
+        resume_engine = None if dedup or consistent else engine
+        tasks = []
+        for world in worlds:
+            world_path = os.path.join(data_path, "worlds", world)
+            backup_name = self.resume_backup_name(f"world-{instance.name}-{world}", instance, [world_path],
+                                                  resume_engine)
+            sources = [(world_path, f"{backup_name}/Data/worlds/{world}")]
+            previous = [b for b in backups if b.type == "world" and b.world == world]
+            tasks.append((backup_name, sources, previous, world))
+        assets_path = os.path.join(data_path, "assets")
+        if os.path.isdir(assets_path) and (force or self._assets_changed(instance)):
+            backup_name = self.resume_backup_name(f"assets-{instance.name}", instance, [assets_path], resume_engine)
+            previous = [b for b in backups if b.type == "assets"]
+            tasks.append((backup_name, [(assets_path, f"{backup_name}/Data/assets")], previous, ""))
+        skipped = len(instance.tracker.children("Data/worlds")) - len(worlds)
+        if skipped:
+            print(f"Skipping {skipped} unchanged worlds of {instance.name}")
+        if not tasks:
+            return []
+        started = datetime.datetime.now()
+        all_sources = [source for task in tasks for source in task[1]]
+        with self._frozen_sources(instance, all_sources, consistent) as frozen:
+            from concurrent.futures import ThreadPoolExecutor
+            frozen = dict(zip(all_sources, frozen))
+            with ThreadPoolExecutor(max(1, jobs), thread_name_prefix="world-backup") as pool:
+                futures = []
+                for backup_name, sources, previous, world in tasks:
+                    sources = [frozen[source] for source in sources]
+                    if dedup:
+                        futures.append(pool.submit(self._create_dedup_backup, backup_name, sources, instance,
+                                                   previous, world, started))
+                    else:
+                        futures.append(pool.submit(self._create_backup, backup_name, sources, instance, engine,
+                                                   world, started))
+                return [f.result() for f in futures]
+
+    @contextlib.contextmanager
+    def _frozen_sources(self, instance: 'FoundryInstance', sources, consistent: bool):
+        """Yield ``sources``, read from a snapshot of the instance when ``consistent`` is set."""
+        if not consistent:
+            yield sources
+            return
+        paths = [os.path.relpath(src, instance.instance_data_path) for src, _ in sources]
+        with instance.snapshot(["" if path == "." else path for path in paths]) as snapshot:
+            yield [(snapshot.translate(src), prefix) for src, prefix in sources]
 
-    def create_backup_folder(self, backup_dir: str):
-        os.system(f"mkdir -p {self.backup_path}/{backup_dir}")
+    def _assets_changed(self, instance: 'FoundryInstance'):
+        backups = [b for b in self.get_world_backups()
+                   if b.instance == instance.name and (b.type == "assets" or (b.type == "world" and not b.world))]
+        last = instance.tracker.last_change("Data/assets")
+        return not backups or last is None or last > max(self.backup_started(b) for b in backups)
 
-    def create_full_backup(self, instance: 'FoundryInstance'):
-        backup_dir = self.generate_backup_name("full", instance)
-        self.create_backup_folder(backup_dir)
+    def _create_backup(self, backup_name: str, sources, instance: 'FoundryInstance', engine: BackupEngine=None,
+                       world: str="", started: datetime.datetime=None):
+        archive_path = os.path.join(self.backup_path, f"{backup_name}.zip")
+        engine = engine or BackupEngine()
+        os.makedirs(self.backup_path, exist_ok=True)
+        self.catalog.records()
+        print(f"Creating backup {archive_path}")
+        started = started or datetime.datetime.now()
+        if os.path.exists(engine.partial_path(archive_path)):
+            # A resumed archive holds files read since the first attempt
+            started = Backup.Parse(f"{backup_name}.zip")[1]
+        busy = SessionMonitor(self._foundry, instance) if engine.adaptive else None
+        stats = engine.create(archive_path, sources, busy)
+        self._add_to_catalog(archive_path, instance, stats, started, world)
+        print(f"Backup {backup_name} done: {stats}")
+        return stats
 
-        os.system(f"rsync -a --progress {instance.instance_data_path}/ {self.backup_path}/{backup_dir}")
-        os.system(f"cd {self.backup_path}/ && zip -r {backup_dir}.zip ./{backup_dir}")
-        os.system(f"rm -rf {self.backup_path}/{backup_dir}")
+    def _create_dedup_backup(self, backup_name: str, sources, instance: 'FoundryInstance', backups: List[Backup],
+                             world: str="", started: datetime.datetime=None):
+        manifest_path = os.path.join(self.backup_path, f"{backup_name}.manifest")
+        previous = next((b.path for b in backups if b.is_manifest and b.instance in ("", instance.name)), None)
+        os.makedirs(self.backup_path, exist_ok=True)
+        print(f"Creating deduplicated backup {manifest_path}")
+        started = started or datetime.datetime.now()
+        stats = self.dedup_store.create(manifest_path, sources, previous)
+        self._add_to_catalog(manifest_path, instance, stats, started, world)
+        print(f"Backup {backup_name} done: {stats}")
+        return stats
 
-    def create_world_backup(self, instance: 'FoundryInstance'):
-        backup_dir = self.generate_backup_name("world", instance)
-        self.create_backup_folder(backup_dir)
+    def _add_to_catalog(self, backup_path: str, instance: 'FoundryInstance', stats, started: datetime.datetime,
+                        world: str=""):
+        self.catalog.add(os.path.basename(backup_path), instance.name, stats.files, stats.checksum, world=world,
+                         started=started.isoformat(), data_size=stats.bytes, duration=round(stats.elapsed, 3))
 
-        os.system(f"mkdir -p {self.backup_path}/{backup_dir}/Data")
-        os.system(f"rsync -a --progress {instance.instance_data_path}/Data/worlds {self.backup_path}/{backup_dir}/Data")
-        os.system(f"rsync -a --progress {instance.instance_data_path}/Data/assets {self.backup_path}/{backup_dir}/Data")
-        os.system(f"cd {self.backup_path}/ && zip -r {backup_dir}.zip ./{backup_dir}")
-        os.system(f"rm -rf {self.backup_path}/{backup_dir}")
+    def backup_started(self, backup: Backup):
+        """When the data of ``backup`` started to be read, its name date for older backups."""
+        started = self.catalog.records().get(backup.file, {}).get("started")
+        return datetime.datetime.fromisoformat(started) if started else backup.date
 
     def restore_full_backup(self, backup: Backup, instance: 'FoundryInstance'):
-        src_tmp_path = instance.instance_data_path + ".bak"
-        backup_file = f'{self.backup_path}/{backup.file}'
-        tmp_path = f"{self.backup_path}/restore-full"
-
-        print(f"Create unzip dir {tmp_path}")
-        os.system(f"mkdir -p {tmp_path}")
-        print(f"Unzip backup {backup_file} to {tmp_path}")
-        os.system(f"unzip {backup_file} -d {tmp_path}")
-        print(f"Rename data dir {instance.instance_data_path} to {src_tmp_path}")
-        os.system(f"mv {instance.instance_data_path} {src_tmp_path}")
-        print(f"Copy backup {tmp_path} to data path {instance.instance_data_path}")
-        os.system(f"rsync -a --progress {tmp_path}/{backup.name}/ {instance.instance_data_path}")
-        os.system(f"rm -rf {src_tmp_path}")
-        os.system(f"rm -rf {tmp_path}")
-    
-    def restore_world_backup(self, backup: Backup, instance: 'FoundryInstance'):
-        src_tmp_path = instance.instance_data_path + ".bak"
-        backup_file = f'{self.backup_path}/{backup.file}'
-        tmp_path = f"{self.backup_path}/restore-world"
-
-        print(f"Create unzip dir {tmp_path}")
-        os.system(f"mkdir -p {tmp_path}")
-        print(f"Unzip backup {backup_file} to {tmp_path}")
-        os.system(f"unzip {backup_file} -d {tmp_path}")
-        print(f"Copy data dir {instance.instance_data_path} to {src_tmp_path}")
-        os.system(f"rsync -a --progress {instance.instance_data_path}/ {src_tmp_path}")
-        print(f"Copy backup {tmp_path} to data path {instance.world_path}")
-        os.system(f"rsync -a --progress {tmp_path}/{backup.name}/ {instance.instance_data_path}")
-        os.system(f"rm -rf {src_tmp_path}")
-        os.system(f"rm -rf {tmp_path}")
+        engine = RestoreEngine()
+        print(f"Restore backup {backup.path} to {instance.instance_data_path}")
+        with engine.open(backup.path) as entries:
+            stats = engine.restore(entries, instance.instance_data_path, [""])
+        print(f"Restore {backup.name} done: {stats}")
+        return stats
     
+    def restore_world_backup(self, backup: Backup, instance: 'FoundryInstance', world: str="", pattern: str="",
+                             replace_assets: bool=False):
+        """Restore the worlds and assets of a backup.
+
+        ``world`` restores only that world, ``pattern`` only the files whose path
+        relative to the data dir matches the glob, e.g. ``Data/worlds/*/data/actors.db``.
+        Worlds are replaced, assets are merged so the ones uploaded since the
+        backup are kept, unless ``replace_assets`` is set. Returns None without
+        touching the instance when ``world`` is not in the backup.
+        """
+        engine = RestoreEngine()
+        with engine.open(backup.path) as entries:
+            if world and f"Data/worlds/{world}" not in engine.children(entries, "Data/worlds"):
+                print(f"Cannot restore world {world}, it is not in backup {backup.name}")
+                return None
+            print(f"Restore backup {backup.path} to {instance.instance_data_path}")
+            if pattern:
+                stats = engine.restore_files(entries, instance.instance_data_path, pattern)
+            elif world:
+                stats = engine.restore(entries, instance.instance_data_path, [f"Data/worlds/{world}"])
+            else:
+                stats = engine.restore(entries, instance.instance_data_path, engine.children(entries, "Data/worlds"))
+                if "Data/assets" in engine.children(entries, "Data"):
+                    if replace_assets:
+                        engine.restore(entries, instance.instance_data_path, ["Data/assets"], stats)
+                    else:
+                        engine.merge(entries, instance.instance_data_path, ["Data/assets"], stats)
+        print(f"Restore {backup.name} done: {stats}")
+        return stats
+
     def cleanup_world(self, keep_delta=datetime.timedelta(30), old_count: int=0):
         self._cleanup(self.get_world_backups(), keep_delta, old_count)
     
@@ -112,13 +272,61 @@ class BackupManager(object):
         self._cleanup(self.get_full_backups(), keep_delta, old_count)
     
     def _cleanup(self, backups: List[Backup], keep_delta: datetime.timedelta, old_count: int):
-        if old_count:
-            backups_to_delete = self._get_backup_to_delete_by_count(backups, old_count)
-        else:
-            backups_to_delete = self._get_backup_to_delete_by_delta(backups, keep_delta)
-        for b in backups_to_delete:
+        """Delete the backups past ``old_count``, or older than ``keep_delta``, of each series.
+
+        Like ``plan_retention``, a series is the backups of a type, instance and
+        world, and its newest backup is always kept: per-world backups skip
+        unchanged worlds, so the only backup of a stable world is also old.
+        """
+        series = {}
+        for b in backups:
+            series.setdefault((b.type, b.instance, b.world), []).append(b)
+        backups_to_delete = []
+        for items in series.values():
+            items = sorted(items, key=lambda b: b.date, reverse=True)
+            if old_count:
+                backups_to_delete.extend(self._get_backup_to_delete_by_count(items, max(1, old_count)))
+            else:
+                backups_to_delete.extend(self._get_backup_to_delete_by_delta(items[1:], keep_delta))
+        self.delete_backups(backups_to_delete)
+
+    def plan_retention(self, policy: RetentionPolicy, backups: List[Backup]=None):
+        if backups is None:
+            worlds, fulls = self.get_backups()
+            backups = worlds + fulls
+        return plan_retention(backups, policy)
+
+    def apply_retention(self, plan: RetentionPlan):
+        self.delete_backups(plan.delete)
+
+    def delete_backups(self, backups: List[Backup]):
+        for b in backups:
             print(f'Deleting {b.name}')
-            os.system(f'rm {b.path}')
+            try:
+                os.remove(b.path)
+            except FileNotFoundError:
+                pass
+        if backups:
+            self.catalog.remove([b.file for b in backups])
+        if any(b.is_manifest for b in backups):
+            self.collect_garbage()
+
+    def verify_backups(self, backups: List[Backup]=None, window: datetime.timedelta=None, workers: int=None):
+        """Check the backups against their integrity manifests, skipping those verified within ``window``."""
+        if backups is None:
+            worlds, fulls = self.get_backups()
+            backups = worlds + fulls
+        return BackupVerifier(self.catalog, workers).verify(backups, window)
+
+    def sync(self, target: SyncTarget, jobs: int=4, max_rate: float=0, delete: bool=True, dry_run: bool=False):
+        """Upload the backups not synced to ``target`` yet and delete the ones removed here."""
+        return BackupSync(self, target, jobs, max_rate, delete).run(dry_run)
+
+    def collect_garbage(self):
+        worlds, fulls = self.get_backups()
+        manifests = [b.path for b in worlds + fulls if b.is_manifest]
+        removed, freed = self.dedup_store.collect_garbage(manifests)
+        print(f'Removed {removed} unused chunks, freed {freed / (1024 * 1024):.1f} MiB')
 
     def _get_backup_to_delete_by_count(self, backups: List[Backup], old_count: int):
         return backups[old_count:]
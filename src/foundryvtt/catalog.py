@@ -0,0 +1,240 @@
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from .backup import Backup
+from .backupengine import INTEGRITY_FILE
+from typing import List
+
+CATALOG_FILE = ".catalog.jsonl"
+CATALOG_LOCK = ".catalog.lock"
+
+
+def file_checksum(path: str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def count_files(path: str):
+    """Number of files in a backup, read from the zip central directory or the manifest."""
+    try:
+        if path.endswith(".manifest"):
+            with open(path, "rt") as f:
+                entries = json.load(f)["entries"]
+            return sum(1 for e in entries if not e["name"].endswith("/"))
+        with zipfile.ZipFile(path) as zf:
+            return sum(1 for i in zf.infolist() if not i.is_dir() and i.filename != INTEGRITY_FILE)
+    except Exception:
+        return 0
+
+
+class BackupCatalog(object):
+    """Append-only JSON lines index of the backups stored in ``backup_path``.
+
+    Every line is an operation on the catalog: ``add`` and ``remove`` a backup,
+    or ``mtime`` to record the backup directory mtime the catalog matches. When
+    the directory mtime changes behind our back, the catalog is reconciled with
+    a single ``os.scandir`` instead of trusting stale records.
+
+    Any ``fvtt`` process or the daemon can write it: every change, and the
+    compaction that replaces the file, happens under an exclusive lock on
+    ``.catalog.lock`` after reading the lines other processes appended.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._catalog_path = os.path.join(self._path, CATALOG_FILE)
+        self._lock_path = os.path.join(self._path, CATALOG_LOCK)
+        self._records = None
+        self._dir_mtime = None
+        self._seen_mtime = None
+        self._lines = 0
+        self._stamp = None
+        # Backups of several worlds or instances can be recorded from concurrent threads
+        self._lock = threading.RLock()
+
+    @property
+    def path(self):
+        return self._catalog_path
+
+    def records(self):
+        """Current records by backup file name."""
+        with self._transaction():
+            self._refresh()
+            return dict(self._records)
+
+    def backups(self):
+        results = []
+        for file, record in self.records().items():
+            results.append(Backup(self._path, file, datetime.datetime.fromisoformat(record["date"]),
+                                  record["type"], record.get("instance", ""), record.get("size", 0),
+                                  record.get("files", 0), record.get("checksum", ""), record.get("world", "")))
+        return results
+
+    def add(self, file: str, instance: str="", files: int=0, checksum: str=None, **info):
+        """Record a backup just written in ``backup_path``.
+
+        Pass the ``checksum`` computed while writing it, otherwise the backup
+        is read again to compute it.
+        """
+        parsed = Backup.Parse(file)
+        if not parsed:
+            return
+        backup_path = os.path.join(self._path, file)
+        record = {
+            "op": "add",
+            "file": file,
+            "type": parsed[0],
+            "instance": instance,
+            "world": parsed[3],
+            "date": parsed[1].isoformat(),
+            "size": os.path.getsize(backup_path),
+            "files": files,
+            "checksum": checksum if checksum is not None else file_checksum(backup_path),
+            }
+        record.update(info)
+        with self._transaction():
+            self._append([record])
+
+    def update(self, file: str, **info):
+        """Merge ``info`` into the record of ``file``."""
+        with self._transaction():
+            self._append([dict(info, op="update", file=file)])
+
+    def remove(self, files: List[str]):
+        with self._transaction():
+            self._append([{"op": "remove", "file": file} for file in files])
+
+    def rebuild(self):
+        """Reconcile the catalog with the content of the backup directory."""
+        with self._transaction():
+            self._load()
+            self._rebuild()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock, open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _rebuild(self):
+        # Backups found on disk without a record, like the full-<ts> and
+        # world-<ts> archives of older versions, get what their name tells.
+        # Older names have no instance, so retention keeps them in a series of
+        # their own, and no checksum, which would mean reading every archive.
+        records = self._records
+        current = {}
+        for entry in os.scandir(self._path):
+            parsed = Backup.Parse(entry.name)
+            if not parsed:
+                continue
+            record = records.get(entry.name)
+            st = entry.stat()
+            if not record or record.get("size") != st.st_size:
+                record = {
+                    "op": "add",
+                    "file": entry.name,
+                    "type": parsed[0],
+                    "instance": parsed[2],
+                    "world": parsed[3],
+                    "date": parsed[1].isoformat(),
+                    "size": st.st_size,
+                    "files": count_files(entry.path),
+                    "checksum": "",
+                    }
+            current[entry.name] = record
+        self._write(current)
+
+    def _load(self):
+        try:
+            stamp = self._file_stamp()
+        except FileNotFoundError:
+            stamp = None
+        if self._records is None or stamp != self._stamp:
+            self._records = self._read() if stamp else {}
+            self._stamp = stamp
+
+    def _refresh(self):
+        self._load()
+        dir_mtime = os.stat(self._path).st_mtime_ns
+        if self._dir_mtime != dir_mtime:
+            self._rebuild()
+        self._seen_mtime = self._dir_mtime
+
+    def _read(self):
+        records = {}
+        self._dir_mtime = None
+        self._lines = 0
+        try:
+            with open(self._catalog_path, "rt") as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        self._apply(records, json.loads(line))
+                    except ValueError:
+                        # Torn last line of an interrupted write
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _apply(self, records: dict, record: dict):
+        op = record["op"]
+        if op == "add":
+            records[record["file"]] = record
+        elif op == "update":
+            if record["file"] in records:
+                info = dict(record)
+                del info["op"]
+                records[record["file"]].update(info)
+        elif op == "remove":
+            records.pop(record["file"], None)
+        elif op == "mtime":
+            self._dir_mtime = record["value"]
+
+    def _append(self, records: List[dict]):
+        self._load()
+        # The catalog matched the directory when we last looked at it, so the
+        # directory changes since then are the ones we are recording now
+        fresh = self._seen_mtime is not None and self._seen_mtime == self._dir_mtime
+        with open(self._catalog_path, "at") as f:
+            for record in records:
+                self._apply(self._records, record)
+                f.write(json.dumps(record) + "\n")
+            self._lines += len(records)
+            if fresh:
+                self._dir_mtime = os.stat(self._path).st_mtime_ns
+                self._seen_mtime = self._dir_mtime
+                f.write(json.dumps({"op": "mtime", "value": self._dir_mtime}) + "\n")
+                self._lines += 1
+        self._stamp = self._file_stamp()
+        if self._lines > 2 * len(self._records) + 100:
+            self._write(self._records)
+
+    def _write(self, records: dict):
+        tmp_path = f"{self._catalog_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wt") as f:
+            for record in records.values():
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, self._catalog_path)
+        self._records = records
+        self._dir_mtime = os.stat(self._path).st_mtime_ns
+        self._seen_mtime = self._dir_mtime
+        with open(self._catalog_path, "at") as f:
+            f.write(json.dumps({"op": "mtime", "value": self._dir_mtime}) + "\n")
+        self._lines = len(records) + 1
+        self._stamp = self._file_stamp()
+
+    def _file_stamp(self):
+        st = os.stat(self._catalog_path)
+        return (st.st_size, st.st_mtime_ns)
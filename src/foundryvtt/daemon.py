@@ -0,0 +1,203 @@
+import datetime
+import fcntl
+import os
+import threading
+import time
+from typing import Dict, List
+from .jobs import QUEUED, Job, JobQueue
+from .retention import RetentionPolicy
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .backupengine import BackupEngine
+    from .foundry import Foundry
+
+# Jobs run for each instance, the other kinds work on the whole host
+INSTANCE_KINDS = ["world", "full"]
+HOST_KINDS = ["clean", "prune", "verify", "sync"]
+KINDS = INSTANCE_KINDS + HOST_KINDS
+DEFAULT_LIMITS = {"world": 2, "full": 1, "clean": 1, "prune": 1, "verify": 1, "sync": 1}
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 3600
+TICK = 1.0
+
+
+class PermanentError(RuntimeError):
+    """A job failure retrying cannot fix, like a corrupted archive."""
+
+
+class Schedule(object):
+    """Submit a ``kind`` job every ``interval``, one per instance for backups."""
+
+    def __init__(self, kind: str, interval: datetime.timedelta, **params):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown job kind {kind}, expected one of {', '.join(KINDS)}")
+        self._kind = kind
+        self._interval = interval
+        self._params = params
+
+    @property
+    def kind(self):
+        return self._kind
+
+    @property
+    def interval(self):
+        return self._interval
+
+    @property
+    def params(self):
+        return self._params
+
+    def due(self, last: datetime.datetime, now: datetime.datetime):
+        return last is None or now - last >= self._interval
+
+
+class BackupDaemon(object):
+    """Run scheduled and submitted jobs from the queue of a Foundry host.
+
+    A single daemon runs per host, holding ``.daemon.lock``. At most ``jobs``
+    jobs run at once and at most ``limits[kind]`` of each kind. Two jobs never
+    work on the same instance at once, and host jobs like cleanups wait for
+    every other job to finish, so they never delete a backup being written.
+    A failed job is queued again after ``retry_delay`` seconds, doubled on
+    each attempt, until it ran ``retries`` times, unless it raised a
+    ``PermanentError``.
+    """
+
+    def __init__(self, foundry: 'Foundry', schedules: List[Schedule]=None, engine: 'BackupEngine'=None,
+                 jobs: int=2, limits: Dict[str, int]=None, retries: int=3, retry_delay: float=RETRY_DELAY):
+        self._foundry = foundry
+        self._queue = JobQueue(foundry.path)
+        self._schedules = schedules or []
+        self._engine = engine
+        self._jobs = max(1, jobs)
+        self._limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self._retries = max(1, retries)
+        self._retry_delay = retry_delay
+        self._running = {}
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(foundry.path, ".daemon.lock")
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def run(self, stop: threading.Event=None, tick: float=TICK):
+        """Schedule and run jobs until ``stop`` is set, then wait for the running ones."""
+        from concurrent.futures import ThreadPoolExecutor
+        stop = stop or threading.Event()
+        with open(self._lock_path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError(f"A daemon is already running for {self._foundry.path}")
+            for job in self._queue.recover():
+                print(f"Queued again interrupted job {job}")
+            with ThreadPoolExecutor(self._jobs, thread_name_prefix="daemon-job") as pool:
+                while not stop.is_set():
+                    try:
+                        self.schedule()
+                        self.dispatch(pool)
+                    except Exception as e:
+                        print(f"Cannot schedule jobs: {e}")
+                    stop.wait(tick)
+                print("Waiting for the running jobs")
+
+    def schedule(self, now: datetime.datetime=None):
+        """Submit the jobs of the schedules that are due."""
+        now = now or datetime.datetime.now()
+        for schedule in self._schedules:
+            if not schedule.due(self._queue.last_scheduled(schedule.kind), now):
+                continue
+            if schedule.kind in INSTANCE_KINDS:
+                for instance in self._foundry.get_instances():
+                    self._queue.submit(schedule.kind, instance.name, **schedule.params)
+            else:
+                self._queue.submit(schedule.kind, **schedule.params)
+            self._queue.set_scheduled(schedule.kind, now)
+
+    def dispatch(self, pool):
+        """Start every ready job the limits allow, oldest first."""
+        now = datetime.datetime.now()
+        for job in self._queue.jobs([QUEUED]):
+            if job.ready > now:
+                continue
+            with self._lock:
+                if not self._can_start(job):
+                    continue
+                job = self._queue.start(job.id)
+                if not job:
+                    continue
+                self._running[job.id] = job
+            pool.submit(self._execute, job)
+
+    def _can_start(self, job: Job):
+        running = list(self._running.values())
+        if len(running) >= self._jobs:
+            return False
+        if sum(1 for j in running if j.kind == job.kind) >= self._limits.get(job.kind, self._jobs):
+            return False
+        if any(not j.instance for j in running):
+            return False
+        if not job.instance:
+            return not running
+        return all(j.instance != job.instance for j in running)
+
+    def _execute(self, job: Job):
+        print(f"Starting job {job}")
+        start = time.monotonic()
+        error = ""
+        permanent = False
+        try:
+            getattr(self, f"_run_{job.kind}")(job)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            permanent = isinstance(e, PermanentError)
+        duration = time.monotonic() - start
+        retry = None
+        if error and not permanent and job.attempts < self._retries:
+            delay = min(MAX_RETRY_DELAY, self._retry_delay * 2 ** (job.attempts - 1))
+            retry = datetime.timedelta(seconds=delay)
+        try:
+            job = self._queue.finish(job.id, duration, error, retry)
+            print(f"Finished job {job}" + (f", retrying in {retry.total_seconds():.1f}s" if retry else ""))
+        finally:
+            with self._lock:
+                self._running.pop(job.id, None)
+
+    def _run_world(self, job: Job):
+        p = job.params
+        instance = self._foundry.get_instance(job.instance)
+        instance.world_backup(p.get("dedup", False), self._engine, p.get("per_world", False),
+                              p.get("world_jobs", 2), p.get("force", False), p.get("consistent", False))
+
+    def _run_full(self, job: Job):
+        p = job.params
+        instance = self._foundry.get_instance(job.instance)
+        instance.full_backup(p.get("dedup", False), self._engine, p.get("consistent", False))
+
+    def _run_clean(self, job: Job):
+        keep_delta = datetime.timedelta(job.params.get("days", 30))
+        self._foundry.clean_world_backup(keep_delta, job.params.get("count", 0))
+        self._foundry.clean_full_backup(keep_delta, job.params.get("count", 0))
+
+    def _run_prune(self, job: Job):
+        p = job.params
+        policy = RetentionPolicy(p.get("hourly", 24), p.get("daily", 14), p.get("weekly", 8), p.get("monthly", 12))
+        print(self._foundry.prune_backups(policy))
+
+    def _run_verify(self, job: Job):
+        window = datetime.timedelta(days=job.params.get("days", 7))
+        results = self._foundry.backup_manager.verify_backups(window=window, workers=job.params.get("workers"))
+        failed = [r.file for r in results if not r.ok]
+        if failed:
+            # Retrying does not fix a corrupted archive
+            raise PermanentError(f"{len(failed)} backups failed verification: {', '.join(failed)}")
+
+    def _run_sync(self, job: Job):
+        target = self._foundry.sync_target(job.params.get("target", ""))
+        if not target:
+            raise RuntimeError("No sync target configured")
+        stats = self._foundry.backup_manager.sync(target, job.params.get("jobs", 4), job.params.get("max_rate", 0))
+        print(f"Sync done: {stats}")
+        if stats.errors:
+            raise RuntimeError(f"{len(stats.errors)} objects failed to sync")
@@ -0,0 +1,189 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from .backupengine import BackupEngine, BackupStats
+from typing import List, Tuple
+
+CHUNK_SIZE = 4 * 1024 * 1024
+GC_GRACE = datetime.timedelta(days=1)
+
+
+class DedupStore(object):
+    """Content addressed chunk store backing ``.manifest`` backups.
+
+    Files are split in fixed size chunks named by their sha256 and stored once
+    under ``<backup_path>/chunks``. A backup is a small JSON manifest listing the
+    chunks of every file. Files whose size and mtime did not change since the
+    previous manifest reuse its chunk list without being read again.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._chunks_path = os.path.join(self._path, "chunks")
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def chunks_path(self):
+        return self._chunks_path
+
+    def chunk_path(self, digest: str):
+        return os.path.join(self._chunks_path, digest[:2], digest)
+
+    def put_chunk(self, data: bytes):
+        """Store ``data`` if it is not already in the store, return its digest and stored size."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        try:
+            # Refresh the mtime so a concurrent garbage collection keeps the chunk
+            os.utime(path)
+            return digest, 0
+        except FileNotFoundError:
+            pass
+        packed = zlib.compress(data, 6)
+        payload = b"Z" + packed if len(packed) < len(data) else b"R" + data
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique per writer, threads of a process can store the same chunk at once
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            if not os.path.exists(path):
+                raise
+            # Stored meanwhile by another writer
+            return digest, 0
+        return digest, len(payload)
+
+    def get_chunk(self, digest: str):
+        with open(self.chunk_path(digest), "rb") as f:
+            payload = f.read()
+        if payload[:1] == b"Z":
+            return zlib.decompress(payload[1:])
+        return payload[1:]
+
+    def load_manifest(self, manifest_path: str):
+        with open(manifest_path, "rt") as f:
+            return json.load(f)
+
+    def create(self, manifest_path: str, sources: List[Tuple[str, str]], previous: str=None):
+        """Store ``sources`` and write the manifest, reusing unchanged files from ``previous``."""
+        stats = BackupStats()
+        known = {}
+        if previous:
+            try:
+                for entry in self.load_manifest(previous)["entries"]:
+                    if "chunks" in entry:
+                        known[self._relative_name(entry["name"])] = entry
+            except Exception as e:
+                print(f"Cannot load previous manifest {previous}: {e}")
+
+        entries = []
+        engine = BackupEngine()
+        for src, prefix in sources:
+            for path, arcname in engine.walk(src, prefix):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    # Deleted since it was listed
+                    continue
+                if arcname.endswith("/"):
+                    entries.append({"name": arcname, "mode": st.st_mode & 0o7777, "mtime": st.st_mtime_ns})
+                    continue
+                chunks = self._reuse_chunks(known.get(self._relative_name(arcname)), st)
+                stored = 0
+                if chunks is None:
+                    try:
+                        f = open(path, "rb")
+                    except FileNotFoundError:
+                        continue
+                    with f:
+                        chunks, stored = self._store_file(f)
+                entries.append({"name": arcname, "mode": st.st_mode & 0o7777, "mtime": st.st_mtime_ns,
+                                "size": st.st_size, "chunks": chunks})
+                stats.add(st.st_size, stored)
+
+        manifest = {
+            "version": 1,
+            "created": datetime.datetime.now().isoformat(),
+            "chunk_size": CHUNK_SIZE,
+            "entries": entries,
+            }
+        data = json.dumps(manifest).encode()
+        tmp_path = BackupEngine().partial_path(manifest_path)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, manifest_path)
+        stats.stop(hashlib.sha256(data).hexdigest())
+        return stats
+
+    def refcounts(self, manifest_paths: List[str]):
+        counts = {}
+        for manifest_path in manifest_paths:
+            for entry in self.load_manifest(manifest_path)["entries"]:
+                for digest in entry.get("chunks", []):
+                    counts[digest] = counts.get(digest, 0) + 1
+        return counts
+
+    def collect_garbage(self, manifest_paths: List[str]):
+        """Delete the chunks no manifest in ``manifest_paths`` references any more.
+
+        Chunks touched during the last ``GC_GRACE`` are kept, they may belong to
+        a backup that is still being written.
+        """
+        counts = self.refcounts(manifest_paths)
+        limit = time.time() - GC_GRACE.total_seconds()
+        removed = 0
+        freed = 0
+        if not os.path.isdir(self._chunks_path):
+            return removed, freed
+        for folder in os.scandir(self._chunks_path):
+            if not folder.is_dir():
+                continue
+            for chunk in os.scandir(folder.path):
+                if counts.get(chunk.name):
+                    continue
+                st = chunk.stat()
+                if st.st_mtime > limit:
+                    continue
+                os.remove(chunk.path)
+                removed += 1
+                freed += st.st_size
+        return removed, freed
+
+    def _reuse_chunks(self, entry: dict, st: os.stat_result):
+        if not entry or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+            return None
+        try:
+            for digest in entry["chunks"]:
+                os.utime(self.chunk_path(digest))
+        except FileNotFoundError:
+            return None
+        return entry["chunks"]
+
+    def _store_file(self, f):
+        chunks = []
+        stored = 0
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            digest, size = self.put_chunk(data)
+            chunks.append(digest)
+            stored += size
+        return chunks, stored
+
+    def _relative_name(self, arcname: str):
+        # Drop the backup name so entries can be matched across manifests
+        return arcname.split("/", 1)[-1]
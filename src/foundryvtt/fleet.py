@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+from typing import Callable, List
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .instance import FoundryInstance
+
+
+class FleetResult(object):
+
+    def __init__(self, name: str, action: str, ok: bool, result=None, error: str="", elapsed: float=0.0):
+        self._name = name
+        self._action = action
+        self._ok = ok
+        self._result = result
+        self._error = error
+        self._elapsed = elapsed
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def action(self):
+        return self._action
+
+    @property
+    def ok(self):
+        return self._ok
+
+    @property
+    def result(self):
+        return self._result
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def elapsed(self):
+        return self._elapsed
+
+    def __str__(self):
+        state = "ok" if self._ok else f"failed: {self._error}"
+        return f"{self._name}: {self._action} {state} ({self._elapsed:.1f}s)"
+
+
+class FleetExecutor(object):
+    """Run an action on many instances, each in its own thread.
+
+    ``jobs`` bounds the number of instances handled at once, and disk heavy
+    actions are limited to ``io_jobs`` at once, so backups are throttled
+    separately from cheap Docker calls. An instance that runs longer than
+    ``timeout`` seconds is reported as failed and frees its slots. Its thread
+    cannot be interrupted: it is a daemon thread that keeps running until it
+    finishes or the process exits, so a timeout bounds the wall time of a
+    command, and a timed-out backup leaves its partial archive behind.
+    """
+
+    def __init__(self, jobs: int=4, io_jobs: int=1, timeout: float=None):
+        self._jobs = max(1, jobs)
+        self._io_jobs = max(1, io_jobs)
+        self._timeout = timeout
+
+    def run(self, instances: List['FoundryInstance'], action: str, func: Callable, io_bound: bool=False):
+        limit = min(self._jobs, self._io_jobs) if io_bound else self._jobs
+        waiting = list(instances)
+        running = {}
+        results = {}
+        finished = queue.Queue()
+        while waiting or running:
+            while waiting and len(running) < limit:
+                instance = waiting.pop(0)
+                running[instance.name] = time.monotonic()
+                threading.Thread(target=self._run_one, args=(instance, func, finished),
+                                 name=f"fleet-{action}-{instance.name}", daemon=True).start()
+            try:
+                name, ok, value = finished.get(timeout=0.5)
+                # A late result of a job already reported as timed out is dropped
+                if name in running:
+                    elapsed = time.monotonic() - running.pop(name)
+                    if ok:
+                        results[name] = FleetResult(name, action, True, value, elapsed=elapsed)
+                    else:
+                        results[name] = FleetResult(name, action, False, error=value, elapsed=elapsed)
+            except queue.Empty:
+                pass
+            if self._timeout is None:
+                continue
+            now = time.monotonic()
+            for name, start in list(running.items()):
+                if now - start > self._timeout:
+                    del running[name]
+                    results[name] = FleetResult(name, action, False, error=f"timed out after {self._timeout}s",
+                                                elapsed=now - start)
+        return [results[instance.name] for instance in instances]
+
+    def _run_one(self, instance: 'FoundryInstance', func: Callable, finished: queue.Queue):
+        try:
+            finished.put((instance.name, True, func(instance)))
+        except BaseException as e:
+            finished.put((instance.name, False, str(e) or type(e).__name__))
@@ -1,59 +1,107 @@
+import contextlib
 import datetime
-import docker
+import ipaddress
 import json
 import os
-import psutil
 import re
-import requests
-import subprocess
+import threading
 
-from packaging import version
+from typing import List
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .backupengine import BackupEngine
 from .instance import FoundryInstance
 from .backupmgr import BackupManager
+from .ports import PortAllocator
+from .registry import InstanceRegistry, published_port
+from .retention import RetentionPolicy
+from .sockets import established_connections
 
 class FoundryRepo(object):
+    """Foundry hosts of this machine, by path in registration order.
+
+    Hosts are only loaded when used, so ``main`` does not load the others.
+    Changes are written atomically, once at the end of a ``batch``.
+    """
 
     def __init__(self, path="/etc/foundryvtt.repo"):
         self._path = path
-        self._instances = []
+        # Path to Foundry, None until loaded
+        self._foundries = {}
+        self._batch = 0
+        self._dirty = False
         self.load()
-    
+
     @property
     def instances(self):
-        return self._instances
-    
+        return [self.get(path) for path in self._foundries]
+
+    @property
+    def paths(self):
+        return list(self._foundries)
+
     @property
     def main(self):
-        if self._instances:
-            return self._instances[0]
+        for path in self._foundries:
+            return self.get(path)
         return None
 
-    def add(self, instance: FoundryInstance):
-        if instance.path not in self._instances_paths:
-            self._instances.append(instance)
-            self.write()
+    def get(self, path: str):
+        """The Foundry registered at ``path``, None when there is none."""
+        if path not in self._foundries:
+            return None
+        if self._foundries[path] is None:
+            self._foundries[path] = Foundry.Load(path)
+        return self._foundries[path]
 
-    @property
-    def _instances_paths(self):
-        return [i.path for i in self._instances]
+    def __contains__(self, path: str):
+        return path in self._foundries
+
+    def add(self, instance: 'Foundry'):
+        if instance.path not in self._foundries:
+            self._foundries[instance.path] = instance
+            self._changed()
+
+    def remove(self, path: str):
+        if self._foundries.pop(path, False) is not False:
+            self._changed()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Defer the writes of the changes made in the block to a single one."""
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+            if not self._batch and self._dirty:
+                self.write()
+
+    def _changed(self):
+        self._dirty = True
+        if not self._batch:
+            self.write()
 
     def load(self):
         try:
             with open(self._path, "rt") as f:
                 repo = json.load(f)
-                for r in repo["instances"]:
-                    self.add(Foundry.Load(r))
+            # Older repos could list a path twice
+            self._foundries = dict.fromkeys(repo["instances"])
+            self._dirty = False
         except Exception as e:
             print(f"Cannot load repo: {e}")
 
     def write(self):
         repo = {
-            "instances": self._instances_paths,
+            "instances": list(self._foundries),
             }
-        
-        with open(self._path, "wt") as f:
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wt") as f:
             json.dump(repo, f)
-        
+        os.replace(tmp_path, self._path)
+        self._dirty = False
+
 class Foundry(object):
 
     @classmethod
@@ -90,8 +138,20 @@ class Foundry(object):
         self._instances_path = os.path.join(self._path, self._instances)
         self._production_instance_path = os.path.join(self._instances_path, self._production_instance)
         self._settings_path = os.path.join(self.path, "settings.db")
+        self._geoip = {}
+        self._sync = {}
         self.load_settings()
         self._backup_manager = BackupManager.Load(self)
+        self._registry = InstanceRegistry(self._instances_path)
+        self._port_allocator = PortAllocator(self)
+        self._docker_client = None
+        self._docker_lock = threading.Lock()
+        self._geolocator = None
+        # Instances by name with the settings they were loaded from
+        self._instances_cache = {}
+        self._instances_lock = threading.Lock()
+        # Settings of the instances without a port and without a container publishing one
+        self._without_port = {}
 
     @property
     def path(self):
@@ -109,6 +169,44 @@ class Foundry(object):
     def instances_path(self):
         return self._instances_path
 
+    @property
+    def registry(self):
+        return self._registry
+
+    @property
+    def port_allocator(self):
+        return self._port_allocator
+
+    @property
+    def geolocator(self):
+        """IP geolocation configured by the ``geoip`` settings, created on first use.
+
+        ``{"db": path}`` resolves offline from a MaxMind database, otherwise
+        ``{"url": ..., "token": ...}`` selects an ipinfo.io compatible server.
+        """
+        if self._geolocator is None:
+            from .geoip import DEFAULT_TTL, GeoCache, GeoLocator, IpInfoProvider, MaxMindProvider
+            if self._geoip.get("db"):
+                provider = MaxMindProvider(self._geoip["db"])
+            else:
+                provider = IpInfoProvider(self._geoip.get("url", "https://ipinfo.io"), self._geoip.get("token", ""))
+            cache = GeoCache(os.path.join(self._path, ".geoip-cache.json"), self._geoip.get("ttl", DEFAULT_TTL))
+            self._geolocator = GeoLocator(provider, cache)
+        return self._geolocator
+
+    def sync_target(self, url: str=""):
+        """Offsite copy of the backups, ``url`` or the ``sync`` settings, None when not configured.
+
+        ``{"url": ..., "options": {...}}`` where the options are the ones of
+        the target, like ``endpoint`` and keys for S3 or ``user`` for WebDAV.
+        """
+        from .sync import create_target
+        if url:
+            return create_target(url)
+        if not self._sync.get("url"):
+            return None
+        return create_target(self._sync["url"], **self._sync.get("options", {}))
+
     @property
     def production_instance(self):
         return self._production_instance
@@ -117,20 +215,103 @@ class Foundry(object):
     def docker_image(self):
         return self._docker_image
 
+    @property
+    def docker_client(self):
+        """Docker client shared by every instance, created on first use."""
+        with self._docker_lock:
+            if self._docker_client is None:
+                # Importing docker pulls in requests and urllib3, only pay for it when containers are touched
+                import docker
+                self._docker_client = docker.client.from_env()
+        return self._docker_client
+
     def get_instances(self):
-        instances = []
-        for name in os.listdir(self._instances_path):
-            instance = FoundryInstance.Load(self, name)
-            instances.append(instance)
-        return instances
+        return [self.get_instance(name) for name in self._registry.names()]
     
     def get_instance(self, name: str):
-        return FoundryInstance.Load(self, name)
+        """Instance ``name``, the same object until its settings change on disk."""
+        info = self._registry.get(name)
+        with self._instances_lock:
+            cached = self._instances_cache.get(name)
+            if info is not None and cached and cached[0] is info:
+                return cached[1]
+            instance = FoundryInstance.Load(self, name)
+            if info is not None:
+                self._instances_cache[name] = (info, instance)
+            return instance
+
+    def get_containers(self):
+        """All the instance containers by name, fetched in a single API call."""
+        containers = self.docker_client.containers.list(all=True, filters={"name": f"{self._docker_image}-"})
+        return {c.name: c for c in containers}
+
+    def get_statuses(self, instances: List[FoundryInstance]=None):
+        """Status of each instance by name, None for instances without a container."""
+        containers = self.get_containers()
+        statuses = {}
+        for instance in instances if instances is not None else self.get_instances():
+            container = containers.get(instance.service)
+            statuses[instance.name] = instance.status(container) if container else None
+        return statuses
+
+    def _executor(self, jobs: int, io_jobs: int=1, timeout: float=None):
+        from .fleet import FleetExecutor
+        return FleetExecutor(jobs, io_jobs, timeout)
+
+    def start_all(self, instances: List[FoundryInstance]=None, jobs: int=4, timeout: float=None):
+        return self._executor(jobs, timeout=timeout).run(self._fleet(instances), "start", lambda i: i.start())
+
+    def stop_all(self, instances: List[FoundryInstance]=None, jobs: int=4, timeout: float=None):
+        return self._executor(jobs, timeout=timeout).run(self._fleet(instances), "stop", lambda i: i.stop())
+
+    def restart_all(self, instances: List[FoundryInstance]=None, jobs: int=4, timeout: float=None):
+        return self._executor(jobs, timeout=timeout).run(self._fleet(instances), "restart", lambda i: i.restart())
+
+    def backup_all(self, instances: List[FoundryInstance]=None, kind: str="world", jobs: int=4, io_jobs: int=1,
+                   timeout: float=None, dedup: bool=False, engine: 'BackupEngine'=None, per_world: bool=False,
+                   world_jobs: int=2, consistent: bool=False):
+        if kind == "full":
+            func = lambda i: i.full_backup(dedup, engine, consistent)
+        else:
+            func = lambda i: i.world_backup(dedup, engine, per_world, world_jobs, consistent=consistent)
+        return self._executor(jobs, io_jobs, timeout).run(self._fleet(instances), f"{kind} backup", func, io_bound=True)
+
+    def logs(self, instances: List[FoundryInstance]=None, since: datetime.datetime=None,
+             until: datetime.datetime=None, tail: int=None, follow: bool=False, level: str="", files: bool=False):
+        """Log records of many instances, merged by time or interleaved as they come when following."""
+        from .logs import merge_logs
+        streams = [i.logs(since, until, tail, follow, level, files) for i in self._fleet(instances)]
+        return merge_logs(streams, follow, tail)
+
+    def watch_data(self, instances: List[FoundryInstance]=None, interval: float=60, stop: threading.Event=None):
+        """Keep the data index of every instance up to date, one thread each, until ``stop`` is set."""
+        stop = stop or threading.Event()
+        threads = []
+        for instance in self._fleet(instances):
+            print(f"Watching {instance.instance_data_path}")
+            thread = threading.Thread(target=instance.tracker.watch, args=(interval, stop),
+                                      name=f"watch-{instance.name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        try:
+            # Short joins so the main thread still gets KeyboardInterrupt
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(0.5)
+        finally:
+            stop.set()
+
+    def _fleet(self, instances: List[FoundryInstance]=None):
+        return instances if instances is not None else self.get_instances()
 
     def create_instance(self, name: str, version: str=""):
         if not version:
             version = self.get_versions()[0]
-        return FoundryInstance.Create(self, name, version, self.get_available_port())
+        port = self._port_allocator.reserve(name)
+        try:
+            return FoundryInstance.Create(self, name, version, port)
+        finally:
+            self._port_allocator.release(port)
     
     def clean_world_backup(self, keep_delta: datetime.timedelta=datetime.timedelta(30), old_count: int=0):
         self.backup_manager.cleanup_world(keep_delta, old_count)
@@ -138,9 +319,15 @@ class Foundry(object):
     def clean_full_backup(self, keep_delta: datetime.timedelta=datetime.timedelta(30), old_count: int=0):
         self.backup_manager.cleanup_full(keep_delta, old_count)
     
+    def prune_backups(self, policy: RetentionPolicy, dry_run: bool=False):
+        plan = self.backup_manager.plan_retention(policy)
+        if not dry_run:
+            self.backup_manager.apply_retention(plan)
+        return plan
+    
     def get_versions(self):
-        dclient = docker.client.from_env()
-        images = dclient.images.list(self._docker_image)
+        from packaging import version
+        images = self.docker_client.images.list(self._docker_image)
         versions = []
         for image in images:
             for tag in image.tags:
@@ -150,44 +337,73 @@ class Foundry(object):
         return sorted(versions, reverse=True)
 
     def get_listening_ports(self):
-        connections = psutil.net_connections(kind='tcp4')
-        ports = []
-        for c in connections:
-            if c.status == "LISTEN":
-                if c.laddr.port not in ports:
-                    ports.append(c.laddr.port)
-        instances = self.get_instances()
-        for instance in instances:
-            if instance.port not in ports:
-                ports.append(instance.port)
-        return sorted(ports)
+        return sorted(self._port_allocator.listening_ports() | set(self.get_instance_ports()))
 
     def get_available_port(self):
-        ports = self.get_listening_ports()
-        port = 30000
-        while port < 40000:
-            if port not in ports:
-                return port
-            port += 1
-        return -1
+        return self._port_allocator.available()
    
+    def get_instance_ports(self):
+        """Instance names by port, read from the registry.
+
+        Instances created before their port was saved in their settings get
+        the port their container publishes, from a single container listing,
+        and their settings are migrated so it only happens once. Instances
+        without a container are left out, they cannot have connections, and
+        only looked up again once their settings change.
+        """
+        entries = self._registry.entries()
+        ports = {info["port"]: name for name, info in entries.items() if "port" in info}
+        missing = [name for name, info in entries.items()
+                   if "port" not in info and self._without_port.get(name) is not info]
+        if missing:
+            try:
+                containers = self.get_containers()
+            except Exception as e:
+                print(f"Cannot list the containers: {e}")
+                containers = {}
+            for name in missing:
+                port = published_port(containers.get(entries[name].get("service", f"{self._docker_image}-{name}")))
+                if port:
+                    self._registry.update(name, port=port)
+                    ports[port] = name
+                else:
+                    self._without_port[name] = entries[name]
+        return ports
+
+    def get_connection_counts(self):
+        """Number of established connections to each instance port.
+
+        Only the connections of the host network namespace are seen: behind
+        the host reverse proxy these are the proxy connections. Players
+        reaching a published port directly go through Docker DNAT to the
+        container and never appear in the host ``/proc/net/tcp``, so an
+        instance can read 0 during a live session in that setup.
+        """
+        ports = self.get_instance_ports()
+        counts = {name: 0 for name in self._registry.entries()}
+        for c in established_connections(set(ports)):
+            counts[ports[c.local_port]] += 1
+        return counts
+
     def get_connections(self):
+        """Players connected to the web or instance ports, with their location.
+
+        Peers on loopback or private addresses, like the host reverse proxy or
+        docker-proxy, are not players and are left out, so they are never sent
+        to the geolocation service. The same Docker DNAT limit as for
+        ``get_connection_counts`` applies.
+        """
         try:
-            connections = []
-            res = subprocess.getoutput("ss -o state established '( sport = :http or sport = :https )'")
-            ips = []
-            for l in res.split("\n")[1:]:
-                parts = re.findall(r"tcp\s+(\d+)\s+(\d+)\s+([^\s]+)\s+([^\s]+)\s+", l)
-                ip, _ = parts[0][3].split(":")
-                if ip not in ips:
-                    ips.append(ip)
-            i = 1
-            for ip in ips:
-                res = requests.get(f"https://ipinfo.io/{ip}")
-                info = res.json()
-                connections.append({"ip": ip, "city": info["city"], "region": info["region"], "country": info["country"], "org": info["org"], "postal": info["postal"]})
-                i += 1
-            return connections
+            web_ports = {80: "", 443: ""}
+            web_ports.update(self.get_instance_ports())
+            ips = {}
+            for c in established_connections(set(web_ports)):
+                ip = ipaddress.ip_address(c.remote_ip)
+                if ip.is_private or ip.is_loopback:
+                    continue
+                ips.setdefault(c.remote_ip, (web_ports[c.local_port], c.local_port))
+            locations = self.geolocator.locate(list(ips))
+            return [dict(locations[ip], ip=ip, instance=instance, port=port) for ip, (instance, port) in ips.items()]
         except Exception as e:
             print("Cannot get connections", e)
             return []
@@ -200,6 +416,8 @@ class Foundry(object):
                 self._instances = info["instances"]
                 self._production_instance = info["production_instance"]
                 self._docker_image = info["docker_image"]
+                self._geoip = info.get("geoip", {})
+                self._sync = info.get("sync", {})
                 self._backup_path = os.path.join(self._path, self._backup)
                 self._instances_path = os.path.join(self._path, self._instances)
                 self._production_instance_path = os.path.join(self._instances_path, self._production_instance)
@@ -212,6 +430,8 @@ class Foundry(object):
             "instances": self._instances,
             "production_instance": self._production_instance,
             "docker_image": self._docker_image,
+            "geoip": self._geoip,
+            "sync": self._sync,
             }
         
         with open(self._settings_path, "wt") as f:
@@ -0,0 +1,168 @@
+import collections
+import ipaddress
+import json
+import os
+import threading
+import time
+from typing import List
+
+GEO_FIELDS = ["city", "region", "country", "org", "postal"]
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def is_public(ip: str):
+    """Tell if ``ip`` is a global address a provider can locate, not a private, loopback or bogon one."""
+    try:
+        return ipaddress.ip_address(ip).is_global
+    except ValueError:
+        return False
+
+
+class GeoCache(object):
+    """On-disk LRU cache of IP geolocation results with a time to live."""
+
+    def __init__(self, path: str, ttl: float=DEFAULT_TTL, max_entries: int=DEFAULT_MAX_ENTRIES):
+        self._path = path
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.load()
+
+    @property
+    def path(self):
+        return self._path
+
+    def get(self, ip: str):
+        with self._lock:
+            entry = self._entries.get(ip)
+            if not entry:
+                return None
+            if time.time() - entry["time"] > self._ttl:
+                del self._entries[ip]
+                self._dirty = True
+                return None
+            self._entries.move_to_end(ip)
+            return entry["info"]
+
+    def put(self, ip: str, info: dict):
+        with self._lock:
+            self._entries[ip] = {"time": time.time(), "info": info}
+            self._entries.move_to_end(ip)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def load(self):
+        try:
+            with open(self._path, "rt") as f:
+                self._entries = collections.OrderedDict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Cannot load geoip cache: {e}")
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = f"{self._path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "wt") as f:
+                    json.dump(self._entries, f)
+                os.replace(tmp_path, self._path)
+                self._dirty = False
+            except Exception as e:
+                print(f"Cannot save geoip cache: {e}")
+
+
+class IpInfoProvider(object):
+    """Resolve IPs with the ipinfo.io API, or any server answering the same JSON.
+
+    A ``requests.Session`` is not thread safe, each lookup thread gets its own.
+    """
+
+    def __init__(self, url: str="https://ipinfo.io", token: str="", timeout: float=5.0):
+        import requests
+        self._url = url.rstrip("/")
+        self._token = token
+        self._timeout = timeout
+        self._new_session = requests.Session
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._new_session()
+            if self._token:
+                session.headers["Authorization"] = f"Bearer {self._token}"
+            self._local.session = session
+        return session
+
+    def lookup(self, ip: str):
+        res = self.session.get(f"{self._url}/{ip}", timeout=self._timeout)
+        res.raise_for_status()
+        info = res.json()
+        return {field: info.get(field, "") for field in GEO_FIELDS}
+
+
+class MaxMindProvider(object):
+    """Resolve IPs offline from a local MaxMind GeoIP2/GeoLite2 City database."""
+
+    def __init__(self, db_path: str):
+        import geoip2.database
+        self._reader = geoip2.database.Reader(db_path)
+
+    def lookup(self, ip: str):
+        res = self._reader.city(ip)
+        return {
+            "city": res.city.name or "",
+            "region": res.subdivisions.most_specific.name or "",
+            "country": res.country.iso_code or "",
+            "org": "",
+            "postal": res.postal.code or "",
+            }
+
+
+class GeoLocator(object):
+    """Geolocate IPs from the cache first, then concurrently with the provider.
+
+    Addresses that are not public get empty fields without a lookup.
+    """
+
+    def __init__(self, provider, cache: GeoCache, workers: int=8):
+        self._provider = provider
+        self._cache = cache
+        self._workers = workers
+
+    def locate(self, ips: List[str]):
+        results = {}
+        misses = []
+        for ip in ips:
+            if not is_public(ip):
+                results[ip] = {field: "" for field in GEO_FIELDS}
+                continue
+            info = self._cache.get(ip)
+            if info is None:
+                misses.append(ip)
+            else:
+                results[ip] = info
+        if misses:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(min(self._workers, len(misses))) as pool:
+                for ip, info in zip(misses, pool.map(self._lookup, misses)):
+                    results[ip] = info
+            self._cache.save()
+        return results
+
+    def _lookup(self, ip: str):
+        try:
+            info = self._provider.lookup(ip)
+        except Exception as e:
+            print(f"Cannot locate {ip}: {e}")
+            return {field: "" for field in GEO_FIELDS}
+        self._cache.put(ip, info)
+        return info
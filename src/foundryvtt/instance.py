@@ -1,13 +1,13 @@
 import datetime
-import docker
-from docker.types import LogConfig
 import json
 import os
-from packaging import version
 from typing import List
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
+    from .backupengine import BackupEngine
     from .foundry import Foundry
+from .logs import LogIndex, container_logs
+from .tracker import DataTracker
 
 class FoundryInstance(object):
 
@@ -44,8 +44,9 @@ class FoundryInstance(object):
         self._logs_path = os.path.join(self._instance_data_path, "Logs")
         self._worlds_path = os.path.join(self._data_path, "worlds")
         self._settings_path = os.path.join(self.path, "settings.db")
+        self._tracker = None
+        self._log_index = None
         self.load_settings()
-        self._dclient = docker.client.from_env()
 
     @property
     def path(self):
@@ -55,6 +56,10 @@ class FoundryInstance(object):
     def instance_data_path(self):
         return self._instance_data_path
 
+    @property
+    def logs_path(self):
+        return self._logs_path
+
     @property
     def world_path(self):
         return self._worlds_path
@@ -78,11 +83,28 @@ class FoundryInstance(object):
     @property
     def port(self):
         return self._port
+
+    @property
+    def docker_client(self):
+        return self._foundry.docker_client
+
+    @property
+    def tracker(self):
+        if not self._tracker:
+            self._tracker = DataTracker(self)
+        return self._tracker
+
+    @property
+    def log_index(self):
+        if not self._log_index:
+            self._log_index = LogIndex(self)
+        return self._log_index
     
     def create_service(self):
         if not self._get_service():
+            from docker.types import LogConfig
             lc = LogConfig(type=LogConfig.types.JSON, config={"max-size": "10m", "max-file": "3", "labels": "production_status", "env": "os,customer"})
-            service = self._dclient.containers.create(
+            service = self.docker_client.containers.create(
                 f"{self._foundry.docker_image}:{str(self._version)}",
                 tty=True,
                 restart_policy={"Name": "unless-stopped"},
@@ -108,27 +130,77 @@ class FoundryInstance(object):
             service = self._get_service()
         service.stop()
     
-    def status(self):
+    def restart(self):
+        service = self._get_service()
+        if not service:
+            self.create_service()
+            service = self._get_service()
+        service.restart()
+
+    def running_service(self):
+        """The container when it is running, None otherwise."""
         service = self._get_service()
+        return service if service and service.status == "running" else None
+
+    def snapshot(self, paths: List[str]=None, method: str="auto"):
+        """Context manager freezing ``paths`` of the data dir, all of it when not set."""
+        from .snapshot import Snapshot
+        return Snapshot(self, paths, method)
+
+    def status(self, container=None):
+        service = container or self._get_service()
         return service.status
     
-    def logs(self):
+    def logs(self, since: datetime.datetime=None, until: datetime.datetime=None, tail: int=None,
+             follow: bool=False, level: str="", files: bool=False):
+        """Stream the log records of the container, or of the Logs dir files when ``files`` is set."""
+        if files:
+            return self.log_index.records(since, until, tail, follow, level)
         service = self._get_service()
-        return service.logs().decode()
+        if not service:
+            print(f"Cannot find the container of {self._name}")
+            return iter([])
+        return container_logs(service, self._name, since, until, tail, follow, level)
 
-    def full_backup(self):
-        self._foundry.backup_manager.create_full_backup(self)
+    def full_backup(self, dedup: bool=False, engine: 'BackupEngine'=None, consistent: bool=False):
+        return self._foundry.backup_manager.create_full_backup(self, dedup, engine, consistent)
     
-    def world_backup(self):
-        self._foundry.backup_manager.create_world_backup(self)
+    def world_backup(self, dedup: bool=False, engine: 'BackupEngine'=None, per_world: bool=False, jobs: int=2,
+                     force: bool=False, consistent: bool=False):
+        if per_world:
+            return self._foundry.backup_manager.create_world_backups(self, dedup, engine, jobs, force, consistent)
+        return self._foundry.backup_manager.create_world_backup(self, dedup, engine, consistent)
+
+    def last_backup(self, type: str="world", world: str=None):
+        """Newest backup of this instance, for ``world`` the newest one holding it."""
+        backups = [b for b in self._foundry.backup_manager.catalog.backups()
+                   if b.type == type and b.instance == self._name and (world is None or b.world in ("", world))]
+        return max(backups, key=lambda b: b.date) if backups else None
+
+    def changed_worlds(self, since: datetime.datetime=None):
+        """Worlds changed since ``since``, or each since the last backup holding it."""
+        self.tracker.update()
+        if since is not None:
+            return self.tracker.changed_worlds(since)
+        results = []
+        for world in self.tracker.children("Data/worlds"):
+            backup = self.last_backup("world", world)
+            last = self.tracker.last_change(f"Data/worlds/{world}")
+            if not backup or last is None or last > self._foundry.backup_manager.backup_started(backup):
+                results.append(world)
+        return results
 
     def load_settings(self):
+        # Read through the registry, which caches the settings by file mtime
+        info = self._foundry.registry.get(self._name)
+        if info is None:
+            return
         try:
-            with open(self._settings_path, "rt") as f:
-                info = json.load(f)
-                self._version = version.parse(info["version"])
-                self._service = info["service"]
-                self._create_date = datetime.datetime.strptime(info["create_date"], "%Y-%m-%dT%H:%M:%S.%f")
+            from packaging import version
+            self._version = version.parse(info["version"])
+            self._service = info["service"]
+            self._port = info.get("port", self._port)
+            self._create_date = datetime.datetime.strptime(info["create_date"], "%Y-%m-%dT%H:%M:%S.%f")
         except Exception as e:
             print(f"Cannot load settings: {e}")
 
@@ -137,6 +209,7 @@ class FoundryInstance(object):
             "name": self._name,
             "version": str(self._version),
             "service": self._service,
+            "port": self._port,
             "create_date": self._create_date.isoformat(),
             }
         
@@ -145,7 +218,7 @@ class FoundryInstance(object):
     
     def _get_service(self):
         try:
-            container = self._dclient.containers.get(self._service)
+            container = self.docker_client.containers.get(self._service)
             return container
         except Exception:
             return None
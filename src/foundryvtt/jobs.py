@@ -0,0 +1,294 @@
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+import statistics
+import uuid
+from typing import List
+
+QUEUE_FILE = ".jobs.jsonl"
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# Finished jobs kept for their latency and duration when the queue is compacted
+HISTORY = 1000
+
+
+class Job(object):
+
+    def __init__(self, record: dict):
+        self._record = record
+
+    @property
+    def id(self):
+        return self._record["id"]
+
+    @property
+    def kind(self):
+        return self._record["kind"]
+
+    @property
+    def instance(self):
+        """Instance the job works on, empty for jobs on the whole host like cleanups."""
+        return self._record.get("instance", "")
+
+    @property
+    def key(self):
+        return (self.kind, self.instance)
+
+    @property
+    def params(self):
+        return self._record.get("params", {})
+
+    @property
+    def state(self):
+        return self._record["state"]
+
+    @property
+    def attempts(self):
+        return self._record.get("attempts", 0)
+
+    @property
+    def coalesced(self):
+        """Number of submissions merged in this job while it was queued."""
+        return self._record.get("coalesced", 0)
+
+    @property
+    def queued(self):
+        return datetime.datetime.fromisoformat(self._record["queued"])
+
+    @property
+    def ready(self):
+        """When the job can run, later than ``queued`` while it backs off after a failure."""
+        not_before = self._record.get("not_before")
+        return datetime.datetime.fromisoformat(not_before) if not_before else self.queued
+
+    @property
+    def latency(self):
+        """Seconds between the job becoming ready and its last run starting."""
+        return self._record.get("latency")
+
+    @property
+    def duration(self):
+        return self._record.get("duration")
+
+    @property
+    def error(self):
+        return self._record.get("error", "")
+
+    @property
+    def finished(self):
+        finished = self._record.get("finished")
+        return datetime.datetime.fromisoformat(finished) if finished else None
+
+    def __str__(self):
+        target = f"{self.kind} {self.instance}".strip()
+        text = f"{self.id} {target}: {self.state}"
+        if self.attempts:
+            text += f", attempt {self.attempts}"
+        if self.latency is not None:
+            text += f", waited {self.latency:.1f}s"
+        if self.duration is not None:
+            text += f", ran {self.duration:.1f}s"
+        if self.error:
+            text += f", {self.error}"
+        return text
+
+
+class JobQueue(object):
+    """Durable JSON lines queue of the jobs run by the daemon.
+
+    Like the backup catalog, every line is an operation: ``add`` a job,
+    ``update`` its state or ``schedule`` the last run of a schedule. Any
+    process can submit a job while the daemon runs; every change happens
+    under an exclusive lock on ``.jobs.lock`` after reading the lines other
+    processes appended. A queued job submitted again for the same kind and
+    instance is coalesced instead of queued twice.
+    """
+
+    def __init__(self, path: str):
+        self._queue_path = os.path.join(path, QUEUE_FILE)
+        self._lock_path = os.path.join(path, ".jobs.lock")
+        self._records = None
+        self._schedules = {}
+        self._lines = 0
+        self._stamp = None
+
+    @property
+    def path(self):
+        return self._queue_path
+
+    def jobs(self, states: List[str]=None):
+        with self._transaction():
+            records = list(self._records.values())
+        jobs = [Job(r) for r in records if not states or r["state"] in states]
+        return sorted(jobs, key=lambda j: j.queued)
+
+    def get(self, job_id: str):
+        with self._transaction():
+            record = self._records.get(job_id)
+        return Job(record) if record else None
+
+    def submit(self, kind: str, instance: str="", **params):
+        """Queue a job, or merge it in the queued job of the same kind and instance."""
+        with self._transaction():
+            for record in self._records.values():
+                if record["state"] == QUEUED and (record["kind"], record.get("instance", "")) == (kind, instance):
+                    self._append([{"op": "update", "id": record["id"], "params": dict(record["params"], **params),
+                                   "coalesced": record.get("coalesced", 0) + 1}])
+                    return Job(self._records[record["id"]])
+            record = {
+                "op": "add",
+                "id": uuid.uuid4().hex[:12],
+                "kind": kind,
+                "instance": instance,
+                "params": params,
+                "state": QUEUED,
+                "queued": datetime.datetime.now().isoformat(),
+                }
+            self._append([record])
+            return Job(self._records[record["id"]])
+
+    def start(self, job_id: str):
+        """Mark a queued job as running, None when another process took or cancelled it."""
+        with self._transaction():
+            record = self._records.get(job_id)
+            if not record or record["state"] != QUEUED:
+                return None
+            now = datetime.datetime.now()
+            latency = max(0.0, (now - Job(record).ready).total_seconds())
+            self._append([{"op": "update", "id": job_id, "state": RUNNING, "started": now.isoformat(),
+                           "attempts": record.get("attempts", 0) + 1, "latency": round(latency, 3),
+                           "finished": None, "duration": None, "error": ""}])
+            return Job(self._records[job_id])
+
+    def finish(self, job_id: str, duration: float, error: str="", retry: datetime.timedelta=None):
+        """Record the end of a run, ``retry`` queues the job again after that delay."""
+        now = datetime.datetime.now()
+        update = {"op": "update", "id": job_id, "finished": now.isoformat(), "duration": round(duration, 3),
+                  "error": error, "state": FAILED if error else DONE}
+        if error and retry is not None:
+            update.update(state=QUEUED, not_before=(now + retry).isoformat())
+        with self._transaction():
+            self._append([update])
+            return Job(self._records[job_id])
+
+    def cancel(self, job_id: str):
+        with self._transaction():
+            record = self._records.get(job_id)
+            if not record or record["state"] != QUEUED:
+                return False
+            self._append([{"op": "update", "id": job_id, "state": FAILED, "error": "cancelled",
+                           "finished": datetime.datetime.now().isoformat()}])
+            return True
+
+    def recover(self):
+        """Queue again the jobs left running by a daemon that died, return them."""
+        with self._transaction():
+            running = [r["id"] for r in self._records.values() if r["state"] == RUNNING]
+            self._append([{"op": "update", "id": job_id, "state": QUEUED} for job_id in running])
+            return [Job(self._records[job_id]) for job_id in running]
+
+    def last_scheduled(self, name: str):
+        with self._transaction():
+            last = self._schedules.get(name)
+        return datetime.datetime.fromisoformat(last) if last else None
+
+    def set_scheduled(self, name: str, when: datetime.datetime):
+        with self._transaction():
+            self._append([{"op": "schedule", "name": name, "value": when.isoformat()}])
+
+    def stats(self):
+        """Median latency and duration of the finished runs of each job kind."""
+        results = {}
+        for job in self.jobs([DONE, FAILED]):
+            if job.duration is None:
+                continue
+            entry = results.setdefault(job.kind, {"runs": 0, "failed": 0, "latency": [], "duration": []})
+            entry["runs"] += 1
+            entry["failed"] += job.state == FAILED
+            entry["latency"].append(job.latency or 0.0)
+            entry["duration"].append(job.duration)
+        for entry in results.values():
+            entry["latency"] = statistics.median(entry["latency"])
+            entry["duration"] = statistics.median(entry["duration"])
+        return results
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            yield
+
+    def _load(self):
+        try:
+            stamp = self._file_stamp()
+        except FileNotFoundError:
+            stamp = None
+        if self._records is None or stamp != self._stamp:
+            self._read()
+            self._stamp = stamp
+
+    def _read(self):
+        self._records = {}
+        self._schedules = {}
+        self._lines = 0
+        try:
+            with open(self._queue_path, "rt") as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # Torn last line of an interrupted write
+                        continue
+        except FileNotFoundError:
+            pass
+
+    def _apply(self, record: dict):
+        op = record["op"]
+        if op == "add":
+            info = dict(record)
+            del info["op"]
+            self._records[record["id"]] = info
+        elif op == "update":
+            if record["id"] in self._records:
+                info = dict(record)
+                del info["op"]
+                self._records[record["id"]].update(info)
+        elif op == "schedule":
+            self._schedules[record["name"]] = record["value"]
+
+    def _append(self, records: List[dict]):
+        if not records:
+            return
+        with open(self._queue_path, "at") as f:
+            for record in records:
+                self._apply(record)
+                f.write(json.dumps(record) + "\n")
+        self._lines += len(records)
+        self._stamp = self._file_stamp()
+        if self._lines > 2 * (len(self._records) + len(self._schedules)) + 100:
+            self._compact()
+
+    def _compact(self):
+        finished = [r for r in self._records.values() if r["state"] in (DONE, FAILED)]
+        finished = sorted(finished, key=lambda r: r.get("finished") or r["queued"])
+        dropped = {r["id"] for r in finished[:-HISTORY]}
+        self._records = {i: r for i, r in self._records.items() if i not in dropped}
+        tmp_path = f"{self._queue_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wt") as f:
+            for record in self._records.values():
+                f.write(json.dumps(dict(record, op="add")) + "\n")
+            for name, value in self._schedules.items():
+                f.write(json.dumps({"op": "schedule", "name": name, "value": value}) + "\n")
+        os.replace(tmp_path, self._queue_path)
+        self._lines = len(self._records) + len(self._schedules)
+        self._stamp = self._file_stamp()
+
+    def _file_stamp(self):
+        st = os.stat(self._queue_path)
+        return (st.st_size, st.st_mtime_ns)
@@ -0,0 +1,448 @@
+import datetime
+import gzip
+import heapq
+import json
+import os
+import queue
+import re
+import threading
+import time
+from typing import Iterable, List
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .instance import FoundryInstance
+
+INDEX_FILE = ".logs-index.json"
+# Rotated logs can be gzipped
+LOG_EXTENSIONS = (".log", ".log.gz")
+# Distance between two index entries, the most read past a time or level boundary
+BLOCK_SIZE = 64 * 1024
+LEVELS = ["debug", "verbose", "info", "warn", "error"]
+LEVEL_ALIASES = {"warning": "warn", "err": "error"}
+LEVEL_RE = re.compile(r"\[(debug|verbose|info|warn|warning|err|error)\]", re.IGNORECASE)
+TIME_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})[ T](\d{2}):(\d{2}):(\d{2})(?:[.,](\d+))?(Z|[+-]\d{2}:?\d{2})?")
+# Only look for a timestamp at the start of a line, messages can contain dates
+TIME_SEARCH_LENGTH = 48
+DURATION_RE = re.compile(r"^(\d+)([smhdw])$")
+DURATION_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+FOLLOW_INTERVAL = 1.0
+
+
+def level_number(level: str):
+    """Position of ``level`` in ``LEVELS``, 0 when not set so every record matches."""
+    if not level:
+        return 0
+    level = LEVEL_ALIASES.get(level.lower(), level.lower())
+    if level not in LEVELS:
+        raise ValueError(f"Unknown log level {level}, expected one of {', '.join(LEVELS)}")
+    return LEVELS.index(level)
+
+
+def parse_duration(value: str):
+    """Timedelta from a duration like ``90s``, ``15m``, ``1h``, ``2d`` or ``1w``, None when it is not one."""
+    match = DURATION_RE.match(value or "")
+    if not match:
+        return None
+    return datetime.timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def parse_time(value: str):
+    """Aware datetime from an ISO date or a duration before now like ``90s``, ``15m``, ``1h`` or ``2d``."""
+    if not value:
+        return None
+    delta = parse_duration(value)
+    if delta is not None:
+        return datetime.datetime.now().astimezone() - delta
+    result = datetime.datetime.fromisoformat(value)
+    return result if result.tzinfo else result.astimezone()
+
+
+def _match_time(match: re.Match):
+    fraction = (match.group(7) or "0")[:6].ljust(6, "0")
+    result = datetime.datetime(*(int(match.group(i)) for i in range(1, 7)), int(fraction))
+    zone = match.group(8)
+    if not zone:
+        # Foundry writes local times
+        return result.astimezone()
+    if zone == "Z":
+        return result.replace(tzinfo=datetime.timezone.utc)
+    zone = zone.replace(":", "")
+    offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+    return result.replace(tzinfo=datetime.timezone(-offset if zone[0] == "-" else offset))
+
+
+def _epoch(value: datetime.datetime):
+    return value.timestamp() if value else None
+
+
+def _from_epoch(value: float):
+    return datetime.datetime.fromtimestamp(value).astimezone() if value is not None else None
+
+
+class LogRecord(object):
+
+    def __init__(self, time: datetime.datetime, level: str, text: str, instance: str="", source: str=""):
+        self._time = time
+        self._level = level
+        self._text = text
+        self._instance = instance
+        self._source = source
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def level(self):
+        return self._level
+
+    @property
+    def level_number(self):
+        return LEVELS.index(self._level)
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def instance(self):
+        return self._instance
+
+    @property
+    def source(self):
+        """``container`` for the Docker logs, otherwise the name of the file in the Logs dir."""
+        return self._source
+
+    def matches(self, since: datetime.datetime=None, until: datetime.datetime=None, level: int=0):
+        if self.level_number < level:
+            return False
+        if self._time is None:
+            return since is None and until is None
+        return (since is None or self._time >= since) and (until is None or self._time <= until)
+
+    def __str__(self):
+        return f"{self._instance} | {self._text}" if self._instance else self._text
+
+
+def parse_line(line: str, previous: LogRecord=None, instance: str="", source: str="", prefixed: bool=False):
+    """Parse a log line, ``prefixed`` lines start with the Docker timestamp which is removed.
+
+    A line without its own timestamp or level, like a stack trace, continues
+    the previous record and gets its time and level.
+    """
+    time = None
+    if prefixed:
+        stamp, _, line = line.partition(" ")
+        match = TIME_RE.match(stamp)
+        time = _match_time(match) if match else None
+    match = TIME_RE.search(line, 0, TIME_SEARCH_LENGTH)
+    if match and time is None:
+        time = _match_time(match)
+    level = LEVEL_RE.search(line)
+    if level:
+        level = LEVEL_ALIASES.get(level.group(1).lower(), level.group(1).lower())
+    elif previous and not match:
+        level = previous.level
+    else:
+        level = "info"
+    if time is None and previous:
+        time = previous.time
+    return LogRecord(time, level, line, instance, source)
+
+
+def _open_log(path: str):
+    # Offsets in a gzipped log are in its uncompressed data
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def _sort_key(record: LogRecord):
+    return _epoch(record.time) or 0.0
+
+
+def container_logs(container, instance: str="", since: datetime.datetime=None, until: datetime.datetime=None,
+                   tail: int=None, follow: bool=False, level: str=""):
+    """Stream the Docker logs of ``container``, filtered on time by the daemon and on level here."""
+    level = level_number(level)
+    kwargs = {"stream": True, "timestamps": True, "follow": follow}
+    # The daemon filters on whole seconds, the records are checked again below
+    if since:
+        kwargs["since"] = int(since.timestamp())
+    if until:
+        kwargs["until"] = int(until.timestamp()) + 1
+    # The daemon cannot filter on level, the tail is taken after the level filter
+    if tail is not None and not level:
+        kwargs["tail"] = tail
+    records = _container_records(container.logs(**kwargs), instance, since, until, level)
+    if tail is not None and level and not follow:
+        yield from _tail(records, tail)
+    else:
+        yield from records
+
+
+def _container_records(stream, instance: str, since: datetime.datetime, until: datetime.datetime, level: int):
+    previous = None
+    buffer = b""
+    try:
+        for chunk in stream:
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                previous = parse_line(line.decode(errors="replace"), previous, instance, "container", True)
+                if previous.matches(since, until, level):
+                    yield previous
+        if buffer:
+            record = parse_line(buffer.decode(errors="replace"), previous, instance, "container", True)
+            if record.matches(since, until, level):
+                yield record
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+
+def _tail(records: Iterable[LogRecord], count: int):
+    results = []
+    for record in records:
+        results.append(record)
+        if len(results) > 2 * count:
+            del results[:-count]
+    yield from results[-count:] if count else []
+
+
+class LogIndex(object):
+    """Sparse offset index of the ``*.log`` and ``*.log.gz`` files in an instance Logs dir.
+
+    Every ``BLOCK_SIZE`` bytes of a file, the index keeps the offset and time
+    of the next line, with the highest level logged until the following entry.
+    Reading a time range or a level only reads the blocks that can match, and
+    ``update`` only parses what was appended since the last run. A file renamed
+    by a rotation keeps its entry, found by inode, and a truncated or replaced
+    file is indexed again. Gzipped files never grow, they are indexed once,
+    and reading them decompresses up to the blocks that match. The index is
+    kept in ``<instance>/.logs-index.json``.
+    """
+
+    def __init__(self, instance: 'FoundryInstance'):
+        self._instance = instance.name
+        self._logs_path = instance.logs_path
+        self._index_path = os.path.join(instance.path, INDEX_FILE)
+        self._files = None
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self):
+        return self._index_path
+
+    def files(self):
+        with self._lock:
+            if self._files is None:
+                self._load()
+            return dict(self._files)
+
+    def _load(self):
+        try:
+            with open(self._index_path, "rt") as f:
+                self._files = json.load(f)["files"]
+        except FileNotFoundError:
+            self._files = {}
+        except Exception as e:
+            print(f"Cannot load log index: {e}")
+            self._files = {}
+
+    def _save(self):
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wt") as f:
+                json.dump({"version": 1, "block_size": BLOCK_SIZE, "files": self._files}, f)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            print(f"Cannot save log index: {e}")
+
+    def update(self):
+        """Index the lines appended since the last update, return the number of bytes parsed."""
+        with self._lock:
+            if self._files is None:
+                self._load()
+            try:
+                names = sorted(n for n in os.listdir(self._logs_path) if n.endswith(LOG_EXTENSIONS))
+            except FileNotFoundError:
+                names = []
+            inodes = {entry["ino"]: entry for entry in self._files.values()}
+            files = {}
+            parsed = 0
+            for name in names:
+                path = os.path.join(self._logs_path, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                compressed = name.endswith(".gz")
+                entry = self._files.get(name)
+                if not entry or entry["ino"] != st.st_ino:
+                    # A rotated file keeps its inode under its new name
+                    entry = inodes.get(st.st_ino)
+                if not entry or not self._current(entry, st, compressed):
+                    entry = {"ino": st.st_ino, "size": 0, "time": None, "level": 0, "blocks": []}
+                if ("stored" not in entry) if compressed else entry["size"] < st.st_size:
+                    size = entry["size"]
+                    entry = self._index(path, entry, compressed)
+                    if compressed:
+                        entry["stored"] = st.st_size
+                    parsed += entry["size"] - size
+                files[name] = entry
+            changed = parsed or files.keys() != self._files.keys()
+            self._files = files
+            if changed:
+                self._save()
+            return parsed
+
+    def _current(self, entry: dict, st: os.stat_result, compressed: bool):
+        """Tell if ``entry`` still indexes the start of the file, not if it was truncated or replaced."""
+        if entry["ino"] != st.st_ino:
+            return False
+        if compressed:
+            return entry.get("stored") == st.st_size
+        return "stored" not in entry and entry["size"] <= st.st_size
+
+    def _index(self, path: str, entry: dict, compressed: bool=False):
+        blocks = [list(b) for b in entry["blocks"]]
+        previous = self._carried(entry["time"], entry["level"])
+        offset = entry["size"]
+        with _open_log(path) as f:
+            f.seek(offset)
+            for raw in f:
+                # A line still being written is indexed by the next update
+                if not raw.endswith(b"\n") and not compressed:
+                    break
+                carry = previous.level_number if previous else 0
+                record = parse_line(raw.decode(errors="replace").rstrip("\r\n"), previous)
+                if not blocks or offset - blocks[-1][1] >= BLOCK_SIZE:
+                    blocks.append([_epoch(record.time), offset, record.level_number, carry])
+                elif blocks[-1][0] is None and record.time:
+                    blocks[-1][0] = _epoch(record.time)
+                blocks[-1][2] = max(blocks[-1][2], record.level_number)
+                offset += len(raw)
+                previous = record
+        return {"ino": entry["ino"], "size": offset, "time": _epoch(previous.time) if previous else None,
+                "level": previous.level_number if previous else 0, "blocks": blocks}
+
+    def _carried(self, time: float, level: int):
+        if time is None and not level:
+            return None
+        return LogRecord(_from_epoch(time), LEVELS[level], "")
+
+    def read(self, name: str, since: datetime.datetime=None, until: datetime.datetime=None, level: str="",
+             tail: int=None):
+        """Records of one indexed file, only reading the blocks that can match."""
+        entry = self.files().get(name)
+        if not entry:
+            return
+        level = level_number(level)
+        ranges = self._ranges(entry, _epoch(since), _epoch(until), level)
+        path = os.path.join(self._logs_path, name)
+        if tail is None:
+            for start, end, block in ranges:
+                yield from self._read_range(path, name, start, end, block, since, until, level)
+            return
+        # Walk the blocks backward until enough records are found
+        results = []
+        for start, end, block in reversed(ranges):
+            results[:0] = list(self._read_range(path, name, start, end, block, since, until, level))
+            if len(results) >= tail:
+                break
+        yield from results[-tail:] if tail else []
+
+    def _ranges(self, entry: dict, since: float, until: float, level: int):
+        blocks = entry["blocks"]
+        results = []
+        for i, block in enumerate(blocks):
+            following = blocks[i + 1] if i + 1 < len(blocks) else None
+            last = following[0] if following else entry["time"]
+            if since is not None and last is not None and last < since:
+                continue
+            if until is not None and block[0] is not None and block[0] > until:
+                break
+            if block[2] < level:
+                continue
+            end = following[1] if following else entry["size"]
+            if results and results[-1][1] == block[1]:
+                results[-1] = (results[-1][0], end, results[-1][2])
+            else:
+                results.append((block[1], end, block))
+        return results
+
+    def _read_range(self, path: str, name: str, start: int, end: int, block: list, since: datetime.datetime,
+                    until: datetime.datetime, level: int, previous: LogRecord=None):
+        if previous is None and block:
+            previous = self._carried(block[0], block[3])
+        try:
+            with _open_log(path) as f:
+                f.seek(start)
+                while f.tell() < end:
+                    raw = f.readline(end - f.tell())
+                    if not raw:
+                        break
+                    previous = parse_line(raw.decode(errors="replace").rstrip("\r\n"), previous, self._instance,
+                                          name)
+                    if previous.matches(since, until, level):
+                        yield previous
+        except FileNotFoundError:
+            return
+
+    def records(self, since: datetime.datetime=None, until: datetime.datetime=None, tail: int=None,
+                follow: bool=False, level: str="", interval: float=FOLLOW_INTERVAL):
+        """Records of every log file merged by time, then the new ones when following."""
+        self.update()
+        files = self.files()
+        streams = [self.read(name, since, until, level, tail) for name in files]
+        records = heapq.merge(*streams, key=_sort_key)
+        yield from _tail(records, tail) if tail is not None else records
+        if not follow:
+            return
+        sizes = {name: entry["size"] for name, entry in files.items()}
+        while True:
+            time.sleep(interval)
+            self.update()
+            files = self.files()
+            streams = []
+            for name, entry in files.items():
+                start = sizes.get(name, 0)
+                if entry["size"] < start:
+                    start = 0
+                if entry["size"] > start:
+                    streams.append(self._read_range(os.path.join(self._logs_path, name), name, start,
+                                                    entry["size"], None, since, until, level_number(level)))
+                sizes[name] = entry["size"]
+            yield from heapq.merge(*streams, key=_sort_key)
+
+
+def merge_logs(streams: List[Iterable[LogRecord]], follow: bool=False, tail: int=None):
+    """Merge the record streams of many instances, by time or as they come when following."""
+    if not follow:
+        records = heapq.merge(*streams, key=_sort_key)
+        yield from _tail(records, tail) if tail is not None else records
+        return
+    if len(streams) == 1:
+        yield from streams[0]
+        return
+    records = queue.Queue(maxsize=1000)
+    done = object()
+
+    def pump(stream):
+        try:
+            for record in stream:
+                records.put(record)
+        except Exception as e:
+            print(f"Cannot read logs: {e}")
+        finally:
+            records.put(done)
+
+    for stream in streams:
+        threading.Thread(target=pump, args=(stream,), name="logs", daemon=True).start()
+    running = len(streams)
+    while running:
+        record = records.get()
+        if record is done:
+            running -= 1
+        else:
+            yield record
@@ -0,0 +1,273 @@
+import collections
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .foundry import Foundry
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+METRICS = {
+    "fvtt_container_up": "1 when the instance container is running",
+    "fvtt_container_cpu_ratio": "CPU used by the instance container, 1.0 is one full core",
+    "fvtt_container_memory_bytes": "Memory used by the instance container",
+    "fvtt_connections": "Established connections to the instance port",
+    "fvtt_data_bytes": "Size of the instance data directory",
+    "fvtt_world_bytes": "Size of each world directory",
+    "fvtt_backup_age_seconds": "Age of the newest backup",
+    "fvtt_backup_bytes": "Size of the newest backup",
+    "fvtt_backup_duration_seconds": "Time taken to create the newest backup",
+    "fvtt_backup_throughput_bytes_per_second": "Data backed up per second by the newest backup",
+    }
+
+
+class Sample(object):
+
+    def __init__(self, timestamp: float=None):
+        self._timestamp = timestamp if timestamp is not None else time.time()
+        self._values = collections.defaultdict(list)
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @property
+    def values(self):
+        return self._values
+
+    def add(self, name: str, labels: dict, value: float):
+        self._values[name].append((labels, value))
+
+    def to_dict(self):
+        return {"timestamp": self._timestamp,
+                "values": {name: [[labels, value] for labels, value in values] for name, values in self._values.items()}}
+
+
+def render_openmetrics(sample: Sample):
+    lines = []
+    for name, description in METRICS.items():
+        values = sample.values.get(name)
+        if not values:
+            continue
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"# HELP {name} {description}")
+        for labels, value in values:
+            label_text = ",".join(f'{k}="{_escape(str(v))}"' for k, v in sorted(labels.items()))
+            lines.append(f"{name}{{{label_text}}} {value}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class ContainerStatsStream(object):
+    """Latest resource usage of the instance containers.
+
+    One streaming ``stats`` request per running container is kept open on
+    the shared Docker client, each read by its own daemon thread, so sampling
+    only reads the last values instead of waiting on a new stats round trip.
+    """
+
+    def __init__(self, foundry: 'Foundry'):
+        self._foundry = foundry
+        self._latest = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Open a stream for new running containers, return the container status by name."""
+        statuses = {}
+        for name, container in self._foundry.get_containers().items():
+            statuses[name] = container.status
+            with self._lock:
+                if container.status != "running" or name in self._streams:
+                    continue
+                thread = threading.Thread(target=self._read, args=(name, container), daemon=True)
+                self._streams[name] = thread
+            thread.start()
+        return statuses
+
+    def latest(self, name: str):
+        with self._lock:
+            return self._latest.get(name)
+
+    def _read(self, name: str, container):
+        try:
+            for stats in container.stats(stream=True, decode=True):
+                with self._lock:
+                    self._latest[name] = self._usage(stats)
+        except Exception as e:
+            print(f"Stats stream of {name} stopped: {e}")
+        finally:
+            with self._lock:
+                self._streams.pop(name, None)
+                self._latest.pop(name, None)
+
+    def _usage(self, stats: dict):
+        cpu = stats.get("cpu_stats", {})
+        precpu = stats.get("precpu_stats", {})
+        cpu_delta = cpu.get("cpu_usage", {}).get("total_usage", 0) - precpu.get("cpu_usage", {}).get("total_usage", 0)
+        system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+        cpus = cpu.get("online_cpus") or len(cpu.get("cpu_usage", {}).get("percpu_usage") or [1])
+        ratio = cpu_delta / system_delta * cpus if system_delta > 0 else 0.0
+        memory = stats.get("memory_stats", {})
+        usage = memory.get("usage", 0) - memory.get("stats", {}).get("inactive_file", 0)
+        return {"cpu": ratio, "memory": max(usage, 0)}
+
+
+class MetricsSampler(object):
+    """Collect instance metrics every ``interval`` seconds into a bounded ring buffer."""
+
+    def __init__(self, foundry: 'Foundry', interval: float=15, history: int=240, size_interval: float=600):
+        self._foundry = foundry
+        self._interval = interval
+        self._size_interval = size_interval
+        self._samples = collections.deque(maxlen=history)
+        self._stats = ContainerStatsStream(foundry)
+        self._sizes = {}
+        self._sizes_time = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def samples(self):
+        return list(self._samples)
+
+    @property
+    def latest(self):
+        return self._samples[-1] if self._samples else None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self._samples.append(self.collect())
+            except Exception as e:
+                print(f"Cannot collect metrics: {e}")
+            self._stop.wait(max(0, self._interval - (time.monotonic() - started)))
+
+    def collect(self):
+        sample = Sample()
+        instances = self._foundry.get_instances()
+        self._collect_containers(sample, instances)
+        self._collect_connections(sample)
+        self._collect_sizes(sample, instances)
+        self._collect_backups(sample)
+        return sample
+
+    def _collect_containers(self, sample: Sample, instances):
+        try:
+            statuses = self._stats.refresh()
+        except Exception as e:
+            print(f"Cannot read container stats: {e}")
+            return
+        for instance in instances:
+            labels = {"instance": instance.name}
+            sample.add("fvtt_container_up", labels, 1 if statuses.get(instance.service) == "running" else 0)
+            usage = self._stats.latest(instance.service)
+            if usage:
+                sample.add("fvtt_container_cpu_ratio", labels, round(usage["cpu"], 4))
+                sample.add("fvtt_container_memory_bytes", labels, usage["memory"])
+
+    def _collect_connections(self, sample: Sample):
+        for name, count in self._foundry.get_connection_counts().items():
+            sample.add("fvtt_connections", {"instance": name}, count)
+
+    def _collect_sizes(self, sample: Sample, instances):
+        # Sizes come from each instance data index, which only lists the directories that changed
+        if time.monotonic() - self._sizes_time > self._size_interval:
+            sizes = {}
+            for instance in instances:
+                try:
+                    instance.tracker.update()
+                except Exception as e:
+                    print(f"Cannot update data index of {instance.name}: {e}")
+                    continue
+                sizes[instance.name] = (instance.tracker.size(), instance.tracker.world_sizes())
+            self._sizes = sizes
+            self._sizes_time = time.monotonic()
+        for name, (data_size, worlds) in self._sizes.items():
+            sample.add("fvtt_data_bytes", {"instance": name}, data_size)
+            for world, size in worlds.items():
+                sample.add("fvtt_world_bytes", {"instance": name, "world": world}, size)
+
+    def _collect_backups(self, sample: Sample):
+        now = datetime.datetime.now()
+        newest = {}
+        for backup in self._foundry.backup_manager.catalog.backups():
+            key = (backup.type, backup.instance, backup.world)
+            if key not in newest or backup.date > newest[key].date:
+                newest[key] = backup
+        records = self._foundry.backup_manager.catalog.records()
+        for (backup_type, instance, world), backup in newest.items():
+            labels = {"type": backup_type, "instance": instance}
+            if world:
+                labels["world"] = world
+            sample.add("fvtt_backup_age_seconds", labels, round((now - backup.date).total_seconds()))
+            sample.add("fvtt_backup_bytes", labels, backup.size)
+            record = records.get(backup.file, {})
+            duration = record.get("duration")
+            if duration:
+                sample.add("fvtt_backup_duration_seconds", labels, duration)
+                sample.add("fvtt_backup_throughput_bytes_per_second", labels,
+                           round(record.get("data_size", 0) / duration))
+
+
+class MetricsServer(object):
+    """Serve the latest sample in OpenMetrics format on ``/metrics`` and the history as JSON on ``/history``."""
+
+    def __init__(self, sampler: MetricsSampler, host: str="127.0.0.1", port: int=9110):
+        self._sampler = sampler
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path == "/metrics":
+                    latest = sampler.latest
+                    body = render_openmetrics(latest or Sample()).encode()
+                    content_type = CONTENT_TYPE
+                elif self.path == "/history":
+                    body = json.dumps([s.to_dict() for s in sampler.samples]).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def serve_forever(self):
+        self._sampler.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._sampler.stop()
+            self._server.server_close()
+
+    def shutdown(self):
+        self._server.shutdown()
@@ -0,0 +1,82 @@
+import fcntl
+import json
+import os
+import time
+from .sockets import listening_ports
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .foundry import Foundry
+
+PORT_START = 30000
+PORT_END = 40000
+# Reservations only need to outlive the window between picking a port and writing the instance settings
+RESERVATION_TTL = 3600
+
+
+class PortAllocator(object):
+    """Pick free ports for new instances.
+
+    Used ports are marked in a bitmap covering the instance port range, from
+    the listening sockets read from ``/proc/net/tcp[6]``, the instance ports and the pending
+    reservations. Reservations are written under an exclusive lock file so
+    concurrent ``create_instance`` calls never get the same port.
+    """
+
+    def __init__(self, foundry: 'Foundry', start: int=PORT_START, end: int=PORT_END):
+        self._foundry = foundry
+        self._start = start
+        self._end = end
+        self._lock_path = os.path.join(foundry.path, ".ports.lock")
+        self._reservations_path = os.path.join(foundry.path, ".ports.json")
+
+    def listening_ports(self):
+        return listening_ports()
+
+    def used_ports(self):
+        return self.listening_ports() | set(self._foundry.get_instance_ports()) | set(self._load_reservations())
+
+    def available(self):
+        """First free port, without reserving it. -1 when the range is full."""
+        return self._first_free(self.used_ports())
+
+    def reserve(self, name: str):
+        """Reserve and return the first free port for instance ``name``, -1 when the range is full."""
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            reservations = self._load_reservations()
+            used = self.listening_ports() | set(self._foundry.get_instance_ports()) | set(reservations)
+            port = self._first_free(used)
+            if port != -1:
+                reservations[port] = {"instance": name, "time": time.time()}
+                self._write_reservations(reservations)
+            return port
+
+    def release(self, port: int):
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            reservations = self._load_reservations()
+            if reservations.pop(port, None):
+                self._write_reservations(reservations)
+
+    def _first_free(self, used):
+        bitmap = bytearray(self._end - self._start)
+        for port in used:
+            if self._start <= port < self._end:
+                bitmap[port - self._start] = 1
+        index = bitmap.find(0)
+        return self._start + index if index != -1 else -1
+
+    def _load_reservations(self):
+        try:
+            with open(self._reservations_path, "rt") as f:
+                reservations = {int(port): info for port, info in json.load(f).items()}
+        except (FileNotFoundError, ValueError):
+            return {}
+        limit = time.time() - RESERVATION_TTL
+        return {port: info for port, info in reservations.items() if info["time"] > limit}
+
+    def _write_reservations(self, reservations: dict):
+        tmp_path = f"{self._reservations_path}.tmp"
+        with open(tmp_path, "wt") as f:
+            json.dump({str(port): info for port, info in reservations.items()}, f)
+        os.replace(tmp_path, self._reservations_path)
@@ -0,0 +1,101 @@
+import json
+import os
+
+# Port Foundry listens on inside its container
+CONTAINER_PORT = "30000/tcp"
+
+
+def published_port(container):
+    """Host port a container publishes Foundry on, None when it publishes none.
+
+    Works with the full container attributes, where the bindings of stopped
+    containers are kept in ``HostConfig``, and with the sparse ones of a
+    container listing, where only running containers have ``Ports``.
+    """
+    if container is None:
+        return None
+    attrs = container.attrs or {}
+    for binding in ((attrs.get("HostConfig") or {}).get("PortBindings") or {}).get(CONTAINER_PORT) or []:
+        try:
+            return int(binding["HostPort"])
+        except (KeyError, TypeError, ValueError):
+            continue
+    for port in attrs.get("Ports") or []:
+        if port.get("PrivatePort") == 30000 and port.get("Type") == "tcp" and port.get("PublicPort"):
+            return int(port["PublicPort"])
+    return None
+
+
+class InstanceRegistry(object):
+    """Instance settings read straight from their ``settings.db``.
+
+    Settings are cached by file mtime, so asking for the instance ports again
+    only costs a ``stat`` per instance and never builds ``FoundryInstance``
+    objects or Docker clients.
+    """
+
+    def __init__(self, instances_path: str):
+        self._instances_path = instances_path
+        self._names = []
+        self._dir_mtime = None
+        self._cache = {}
+
+    @property
+    def instances_path(self):
+        return self._instances_path
+
+    def names(self):
+        try:
+            mtime = os.stat(self._instances_path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if mtime != self._dir_mtime:
+            self._names = sorted(e.name for e in os.scandir(self._instances_path) if e.is_dir())
+            self._dir_mtime = mtime
+        return self._names
+
+    def get(self, name: str):
+        """Settings of instance ``name``, None when it has none."""
+        path = os.path.join(self._instances_path, name, "settings.db")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._cache.pop(name, None)
+            return None
+        cached = self._cache.get(name)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path, "rt") as f:
+                info = json.load(f)
+        except Exception as e:
+            print(f"Cannot load settings: {e}")
+            return None
+        self._cache[name] = (mtime, info)
+        return info
+
+    def update(self, name: str, **info):
+        """Merge ``info`` in the settings of instance ``name``, replacing the file atomically."""
+        current = self.get(name)
+        if current is None:
+            return None
+        info = dict(current, **info)
+        path = os.path.join(self._instances_path, name, "settings.db")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wt") as f:
+            json.dump(info, f)
+        os.replace(tmp_path, path)
+        self._cache[name] = (os.stat(path).st_mtime_ns, info)
+        return info
+
+    def entries(self):
+        results = {}
+        for name in self.names():
+            info = self.get(name)
+            if info is not None:
+                results[name] = info
+        return results
+
+    def ports(self):
+        """Ports recorded in the settings, see ``Foundry.get_instance_ports`` for older instances."""
+        return {info["port"] for info in self.entries().values() if "port" in info}
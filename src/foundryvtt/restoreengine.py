@@ -0,0 +1,284 @@
+import contextlib
+import fnmatch
+import hashlib
+import os
+import shutil
+import time
+import zipfile
+import zlib
+from .backupengine import COPY_BUFFER_SIZE, INTEGRITY_FILE
+from .dedupstore import CHUNK_SIZE, DedupStore
+from typing import List
+
+
+class RestoreEntry(object):
+
+    def __init__(self, name: str, size: int=0, mtime: float=0, mode: int=0):
+        # Archive names start with the backup name, entries are relative to the data dir
+        self._name = name.split("/", 1)[1] if "/" in name else ""
+        self._is_dir = name.endswith("/")
+        self._size = size
+        self._mtime = mtime
+        self._mode = mode
+
+    @property
+    def name(self):
+        return self._name.rstrip("/")
+
+    @property
+    def is_dir(self):
+        return self._is_dir
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def mtime(self):
+        return self._mtime
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def read_chunks(self):
+        raise NotImplementedError()
+
+    def same_content(self, path: str):
+        raise NotImplementedError()
+
+
+class ZipEntry(RestoreEntry):
+
+    def __init__(self, zf: zipfile.ZipFile, zinfo: zipfile.ZipInfo):
+        mtime = time.mktime(zinfo.date_time + (0, 0, -1))
+        super().__init__(zinfo.filename, zinfo.file_size, mtime, (zinfo.external_attr >> 16) & 0o7777)
+        self._zf = zf
+        self._zinfo = zinfo
+
+    def read_chunks(self):
+        with self._zf.open(self._zinfo) as f:
+            while True:
+                data = f.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def same_content(self, path: str):
+        crc = 0
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(COPY_BUFFER_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+        return crc == self._zinfo.CRC
+
+
+class ManifestEntry(RestoreEntry):
+
+    def __init__(self, store: DedupStore, entry: dict):
+        super().__init__(entry["name"], entry.get("size", 0), entry["mtime"] / 1e9, entry["mode"])
+        self._store = store
+        self._chunks = entry.get("chunks", [])
+
+    def read_chunks(self):
+        for digest in self._chunks:
+            yield self._store.get_chunk(digest)
+
+    def same_content(self, path: str):
+        digests = []
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                digests.append(hashlib.sha256(data).hexdigest())
+        return digests == self._chunks
+
+
+class RestoreStats(object):
+
+    def __init__(self):
+        self._written = 0
+        self._written_bytes = 0
+        self._kept = 0
+        self._start = time.monotonic()
+        self._end = None
+
+    @property
+    def written(self):
+        return self._written
+
+    @property
+    def written_bytes(self):
+        return self._written_bytes
+
+    @property
+    def kept(self):
+        return self._kept
+
+    @property
+    def elapsed(self):
+        end = self._end if self._end is not None else time.monotonic()
+        return end - self._start
+
+    def add_written(self, size: int):
+        self._written += 1
+        self._written_bytes += size
+
+    def add_kept(self):
+        self._kept += 1
+
+    def stop(self):
+        self._end = time.monotonic()
+
+    def __str__(self):
+        return (f"{self.written} files written ({self.written_bytes / (1024 * 1024):.1f} MiB), "
+                f"{self.kept} unchanged files kept in {self.elapsed:.1f}s")
+
+
+class RestoreEngine(object):
+    """Restore backups by reading entries straight from the archive or manifest.
+
+    Only files that differ from what is on disk are extracted. Unchanged files
+    are hard linked into a staging directory next to the one being restored,
+    which is then swapped in with two renames, so a restore never needs a full
+    copy of the data. ``merge`` writes the files in place instead, keeping the
+    ones that are not in the backup.
+    """
+
+    @contextlib.contextmanager
+    def open(self, backup_path: str):
+        """Yield the entries of a backup, the archive is closed when the block ends."""
+        if backup_path.endswith(".manifest"):
+            store = DedupStore(os.path.dirname(backup_path))
+            manifest = store.load_manifest(backup_path)
+            yield [ManifestEntry(store, entry) for entry in manifest["entries"]]
+            return
+        with zipfile.ZipFile(backup_path) as zf:
+            yield [ZipEntry(zf, zinfo) for zinfo in zf.infolist() if zinfo.filename != INTEGRITY_FILE]
+
+    def children(self, entries: List[RestoreEntry], folder: str):
+        """Names of the directories directly under ``folder`` in the backup."""
+        prefix = f"{folder}/"
+        names = set()
+        for entry in entries:
+            if entry.name.startswith(prefix):
+                names.add(entry.name[len(prefix):].split("/", 1)[0])
+        return sorted(f"{prefix}{name}" for name in names if name)
+
+    def contains(self, entries: List[RestoreEntry], folder: str):
+        """Whether the backup has anything under ``folder``, the data dir when empty."""
+        prefix = f"{folder}/" if folder else ""
+        return any(entry.name and (entry.name == folder or entry.name.startswith(prefix)) for entry in entries)
+
+    def restore(self, entries: List[RestoreEntry], dest: str, roots: List[str], stats: RestoreStats=None):
+        """Replace each directory in ``roots`` under ``dest`` with its content in the backup.
+
+        Raises ``ValueError`` before touching ``dest`` when a root is not in the
+        backup, swapping in an empty directory would wipe the live one.
+        """
+        missing = [root or "/" for root in roots if not self.contains(entries, root)]
+        if missing:
+            raise ValueError(f"Not in the backup: {', '.join(missing)}")
+        stats = stats or RestoreStats()
+        for root in roots:
+            self._restore_root(entries, dest, root, stats)
+        stats.stop()
+        return stats
+
+    def merge(self, entries: List[RestoreEntry], dest: str, roots: List[str], stats: RestoreStats=None):
+        """Restore the files under ``roots`` in place, keeping the files added since the backup."""
+        prefixes = tuple(f"{root}/" for root in roots)
+        return self._restore_in_place(entries, dest, lambda name: name.startswith(prefixes), stats)
+
+    def restore_files(self, entries: List[RestoreEntry], dest: str, pattern: str, stats: RestoreStats=None):
+        """Restore the files matching ``pattern`` in place, leaving everything else untouched."""
+        return self._restore_in_place(entries, dest, lambda name: fnmatch.fnmatch(name, pattern), stats)
+
+    def _restore_in_place(self, entries: List[RestoreEntry], dest: str, match, stats: RestoreStats=None):
+        stats = stats or RestoreStats()
+        for entry in entries:
+            if entry.is_dir or not match(entry.name):
+                continue
+            path = os.path.join(dest, entry.name)
+            if self._is_unchanged(entry, path):
+                stats.add_kept()
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.restore")
+            self._write(entry, tmp_path)
+            os.replace(tmp_path, path)
+            stats.add_written(entry.size)
+        stats.stop()
+        return stats
+
+    def _restore_root(self, entries: List[RestoreEntry], dest: str, root: str, stats: RestoreStats):
+        target = os.path.join(dest, root) if root else dest
+        parent, name = os.path.split(target.rstrip("/"))
+        staging = os.path.join(parent, f".{name}.restore")
+        old = os.path.join(parent, f".{name}.old")
+        shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+        os.makedirs(staging)
+        dirs = []
+        prefix = f"{root}/" if root else ""
+        matched = 0
+        try:
+            for entry in entries:
+                if not entry.name.startswith(prefix) or not entry.name:
+                    continue
+                matched += 1
+                relative = entry.name[len(prefix):]
+                path = os.path.join(staging, relative)
+                if entry.is_dir:
+                    os.makedirs(path, exist_ok=True)
+                    dirs.append((path, entry))
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                current = os.path.join(target, relative)
+                if self._is_unchanged(entry, current) and self._link(current, path):
+                    stats.add_kept()
+                else:
+                    self._write(entry, path)
+                    stats.add_written(entry.size)
+            for path, entry in reversed(dirs):
+                os.utime(path, (entry.mtime, entry.mtime))
+            if not matched:
+                raise ValueError(f"Not in the backup: {root}")
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        if os.path.exists(target):
+            os.rename(target, old)
+        os.rename(staging, target)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def _is_unchanged(self, entry: RestoreEntry, path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if st.st_size != entry.size:
+            return False
+        # Zip timestamps have a two seconds resolution
+        if abs(st.st_mtime - entry.mtime) < 2:
+            return True
+        return entry.same_content(path)
+
+    def _link(self, src: str, dest: str):
+        try:
+            os.link(src, dest)
+            return True
+        except OSError:
+            return False
+
+    def _write(self, entry: RestoreEntry, path: str):
+        with open(path, "wb") as f:
+            for data in entry.read_chunks():
+                f.write(data)
+        if entry.mode:
+            os.chmod(path, entry.mode)
+        os.utime(path, (entry.mtime, entry.mtime))
@@ -0,0 +1,99 @@
+import datetime
+from .backup import Backup
+from typing import List
+
+EPOCH = datetime.datetime(1970, 1, 5)  # A monday, so weeks start on mondays
+
+
+class RetentionPolicy(object):
+    """Grandfather-father-son retention rules.
+
+    Each rule keeps the newest backup of every period (hour, day, week, month)
+    for the given number of periods back from now. The newest backup of each
+    series is always kept.
+    """
+
+    def __init__(self, hourly: int=24, daily: int=14, weekly: int=8, monthly: int=12):
+        self._hourly = hourly
+        self._daily = daily
+        self._weekly = weekly
+        self._monthly = monthly
+
+    @property
+    def rules(self):
+        return [
+            (self._hourly, self._hour),
+            (self._daily, self._day),
+            (self._weekly, self._week),
+            (self._monthly, self._month),
+            ]
+
+    def _hour(self, date: datetime.datetime):
+        return (date - EPOCH).days * 24 + date.hour
+
+    def _day(self, date: datetime.datetime):
+        return (date - EPOCH).days
+
+    def _week(self, date: datetime.datetime):
+        return (date - EPOCH).days // 7
+
+    def _month(self, date: datetime.datetime):
+        return date.year * 12 + date.month - 1
+
+    def __str__(self):
+        return f"hourly: {self._hourly} daily: {self._daily} weekly: {self._weekly} monthly: {self._monthly}"
+
+
+class RetentionPlan(object):
+
+    def __init__(self, keep: List[Backup], delete: List[Backup]):
+        self._keep = keep
+        self._delete = delete
+
+    @property
+    def keep(self):
+        return self._keep
+
+    @property
+    def delete(self):
+        return self._delete
+
+    @property
+    def freed_bytes(self):
+        return sum(b.size for b in self._delete)
+
+    def __str__(self):
+        return (f"Keep {len(self._keep)} backups, delete {len(self._delete)} backups "
+                f"freeing {self.freed_bytes / (1024 * 1024):.1f} MiB")
+
+
+def plan_retention(backups: List[Backup], policy: RetentionPolicy, now: datetime.datetime=None):
+    """Split ``backups`` in the ones ``policy`` keeps and the ones to delete.
+
+    Backups are grouped by type, instance and world, each group is handled in
+    a single pass from the newest backup to the oldest.
+    """
+    now = now or datetime.datetime.now()
+    rules = [(count, key, key(now) - count) for count, key in policy.rules if count > 0]
+    keep = []
+    delete = []
+    last_keys = {}
+    for backup in sorted(backups, key=lambda b: (b.type, b.instance, b.world, b.date), reverse=True):
+        series = (backup.type, backup.instance, backup.world)
+        if series not in last_keys:
+            # Newest backup of the series
+            last_keys[series] = [key(backup.date) for _, key, _ in rules]
+            keep.append(backup)
+            continue
+        kept = False
+        seen = last_keys[series]
+        for i, (_, key, oldest) in enumerate(rules):
+            period = key(backup.date)
+            if period != seen[i] and period > oldest:
+                seen[i] = period
+                kept = True
+        if kept:
+            keep.append(backup)
+        else:
+            delete.append(backup)
+    return RetentionPlan(keep, delete)
@@ -0,0 +1,244 @@
+import contextlib
+import fcntl
+import os
+import shutil
+import subprocess
+import time
+from typing import List
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .instance import FoundryInstance
+
+SNAPSHOT_DIR = ".snapshot"
+METHODS = ["btrfs", "reflink", "pause"]
+# LevelDB files written in place, its tables (.ldb) are immutable and safe to link
+LEVELDB_MUTABLE = ("CURRENT", "MANIFEST-", "LOG")
+LEVELDB_MUTABLE_EXT = ".log"
+# Inode number of every btrfs subvolume root
+BTRFS_SUBVOLUME_INODE = 256
+
+
+def is_mutable(name: str):
+    """Tell if a LevelDB file is written in place instead of replaced."""
+    return name.startswith(LEVELDB_MUTABLE) or name.endswith(LEVELDB_MUTABLE_EXT)
+
+
+class Snapshot(object):
+    """Frozen view of an instance data tree to build an archive from.
+
+    ``btrfs`` takes a read-only snapshot when the data dir is a btrfs subvolume.
+    ``reflink`` clones ``paths`` with ``cp --reflink=always`` while the container
+    is paused. ``pause`` pauses the container while every file is hard linked,
+    which only takes metadata updates, except the few LevelDB files written in
+    place (``CURRENT``, ``MANIFEST-*``, ``LOG`` and the ``.log`` journals) that
+    are copied. A linked file is still the live one, the other files Foundry
+    writes are replaced by a rename, or appended to for NeDB databases whose
+    loader skips a torn last line. ``pause`` is skipped when a data file cannot
+    be linked, rather than copying the whole tree while players are frozen.
+    ``auto`` uses the first method that works, in that order.
+
+    The snapshot lives in ``<instance>/.snapshot``, mirroring the data dir, so
+    ``translate`` maps a source dir to its frozen copy.
+    """
+
+    def __init__(self, instance: 'FoundryInstance', paths: List[str]=None, method: str="auto"):
+        if method != "auto" and method not in METHODS:
+            raise ValueError(f"Unknown snapshot method {method}, expected auto or one of {', '.join(METHODS)}")
+        self._instance = instance
+        self._paths = paths or [""]
+        self._method = method
+        self._path = os.path.join(instance.path, SNAPSHOT_DIR)
+        self._lock = None
+        self._used = None
+        self._paused = 0.0
+        self._linked = 0
+        self._copied = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def method(self):
+        return self._used
+
+    @property
+    def paused(self):
+        """Seconds the container was paused for."""
+        return self._paused
+
+    @property
+    def linked(self):
+        """Files hard linked by the ``pause`` method."""
+        return self._linked
+
+    @property
+    def copied(self):
+        """Bytes copied by the ``pause`` method while the container was paused."""
+        return self._copied
+
+    def translate(self, path: str):
+        relative = os.path.relpath(path, self._instance.instance_data_path)
+        return self._path if relative == "." else os.path.join(self._path, relative)
+
+    def take(self):
+        # One snapshot per instance at a time, a second backup waits for the first one
+        self._lock = open(f"{self._path}.lock", "a")
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        self._remove()
+        for method in METHODS if self._method == "auto" else [self._method]:
+            if self._method == "auto" and not getattr(self, f"_supports_{method}")():
+                continue
+            try:
+                getattr(self, f"_take_{method}")()
+                self._used = method
+                text = f"Snapshot of {self._instance.name} taken with {method}, container paused for " \
+                       f"{self._paused * 1000:.0f} ms"
+                if method == "pause":
+                    text += f", {self._linked} files linked, {self._copied / (1024 * 1024):.1f} MiB copied"
+                print(text)
+                return self
+            except (OSError, subprocess.CalledProcessError) as e:
+                if self._method != "auto":
+                    raise
+                print(f"Cannot take a {method} snapshot: {e}")
+                self._remove()
+        raise RuntimeError(f"Cannot take a snapshot of {self._instance.name}")
+
+    def release(self):
+        try:
+            self._remove()
+        finally:
+            if self._lock:
+                self._lock.close()
+                self._lock = None
+
+    def __enter__(self):
+        return self.take()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def _supports_btrfs(self):
+        return os.stat(self._instance.instance_data_path).st_ino == BTRFS_SUBVOLUME_INODE
+
+    def _supports_reflink(self):
+        # Clone a probe file first, so the container is not paused for a copy bound to fail
+        probe = f"{self._path}.probe"
+        try:
+            with open(probe, "wb") as f:
+                f.write(b"\0")
+            return subprocess.run(["cp", "--reflink=always", probe, f"{probe}.clone"],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+        except OSError:
+            return False
+        finally:
+            for path in (probe, f"{probe}.clone"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _supports_pause(self):
+        # Link a data file first, across filesystems or with protected hard links
+        # every file would be copied while the container is paused
+        probe = f"{self._path}.probe"
+        sample = self._sample_file()
+        created = None
+        try:
+            if not sample:
+                sample = created = os.path.join(self._instance.instance_data_path, f".{SNAPSHOT_DIR}.probe")
+                open(created, "wb").close()
+            os.link(sample, probe)
+            return True
+        except OSError:
+            return False
+        finally:
+            for path in (probe, created):
+                if path and os.path.lexists(path):
+                    os.remove(path)
+
+    def _sample_file(self):
+        for relative in self._paths:
+            for folder, _, files in os.walk(os.path.join(self._instance.instance_data_path, relative)):
+                for name in files:
+                    if not is_mutable(name):
+                        return os.path.join(folder, name)
+        return None
+
+    def _take_btrfs(self):
+        data_path = self._instance.instance_data_path
+        if os.stat(data_path).st_ino != BTRFS_SUBVOLUME_INODE:
+            raise OSError(f"{data_path} is not a btrfs subvolume")
+        subprocess.run(["btrfs", "subvolume", "snapshot", "-r", data_path, self._path], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def _take_reflink(self):
+        with self._paused_container():
+            for relative in self._paths:
+                src = os.path.join(self._instance.instance_data_path, relative)
+                if not os.path.exists(src):
+                    continue
+                dest = self.translate(src)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                subprocess.run(["cp", "-a", "--reflink=always", src, dest], check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def _take_pause(self):
+        if not self._supports_pause():
+            raise OSError(f"Cannot hard link the data of {self._instance.name} to {self._path}, "
+                          f"not pausing the container to copy it")
+        with self._paused_container():
+            for relative in self._paths:
+                src = os.path.join(self._instance.instance_data_path, relative)
+                if os.path.isdir(src):
+                    self._link_tree(src, self.translate(src))
+
+    def _link_tree(self, src: str, dest: str):
+        folders = []
+        for folder, _, files in os.walk(src):
+            target = os.path.join(dest, os.path.relpath(folder, src))
+            os.makedirs(target, exist_ok=True)
+            folders.append((folder, target))
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    if not is_mutable(name):
+                        try:
+                            os.link(path, os.path.join(target, name))
+                            self._linked += 1
+                            continue
+                        except OSError:
+                            # Rare once the probe linked, e.g. a file owned by another user
+                            pass
+                    shutil.copy2(path, os.path.join(target, name))
+                    self._copied += os.path.getsize(path)
+                except FileNotFoundError:
+                    continue
+        # Creating the files changed the directory times, set them back deepest first
+        for folder, target in reversed(folders):
+            shutil.copystat(folder, target)
+
+    @contextlib.contextmanager
+    def _paused_container(self):
+        container = self._instance.running_service()
+        start = time.monotonic()
+        if container:
+            container.pause()
+        try:
+            yield
+        finally:
+            if container:
+                container.unpause()
+                self._paused = time.monotonic() - start
+
+    def _remove(self):
+        if not os.path.lexists(self._path):
+            return
+        if os.stat(self._path).st_ino == BTRFS_SUBVOLUME_INODE:
+            try:
+                subprocess.run(["btrfs", "subvolume", "delete", self._path], check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                return
+            except (OSError, subprocess.CalledProcessError):
+                # Other filesystems can use that inode number for a plain directory
+                pass
+        shutil.rmtree(self._path)
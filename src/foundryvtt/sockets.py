@@ -0,0 +1,110 @@
+import ipaddress
+import os
+from typing import List, Set
+
+PROC_TCP = ["/proc/net/tcp", "/proc/net/tcp6"]
+TCP_ESTABLISHED = "01"
+TCP_LISTEN = "0A"
+
+
+class Connection(object):
+
+    def __init__(self, local_ip: str, local_port: int, remote_ip: str, remote_port: int):
+        self._local_ip = local_ip
+        self._local_port = local_port
+        self._remote_ip = remote_ip
+        self._remote_port = remote_port
+
+    @property
+    def local_ip(self):
+        return self._local_ip
+
+    @property
+    def local_port(self):
+        return self._local_port
+
+    @property
+    def remote_ip(self):
+        return self._remote_ip
+
+    @property
+    def remote_port(self):
+        return self._remote_port
+
+    def __str__(self):
+        return f"{self._remote_ip}:{self._remote_port} -> {self._local_ip}:{self._local_port}"
+
+
+def parse_address(address: str):
+    """Decode a ``/proc/net/tcp[6]`` address, e.g. ``0100007F:7530``, to (ip, port)."""
+    host, port = address.split(":")
+    raw = bytes.fromhex(host)
+    # The kernel prints each 32 bits word in host (little endian) order
+    raw = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    ip = ipaddress.ip_address(raw)
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return str(ip), int(port, 16)
+
+
+def read_proc_rows(state: str, paths: List[str]=PROC_TCP):
+    """Fields of the ``/proc/net/tcp[6]`` lines of the sockets in ``state``."""
+    for path in paths:
+        try:
+            with open(path, "rt") as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[3] == state:
+                        yield fields
+        except FileNotFoundError:
+            continue
+
+
+def read_proc_connections(ports: Set[int]=None, paths: List[str]=PROC_TCP):
+    """Established TCP connections whose local port is in ``ports``, all of them when not set."""
+    connections = []
+    for fields in read_proc_rows(TCP_ESTABLISHED, paths):
+        local = fields[1]
+        if ports is not None and int(local[local.rindex(":") + 1:], 16) not in ports:
+            continue
+        local_ip, local_port = parse_address(local)
+        remote_ip, remote_port = parse_address(fields[2])
+        connections.append(Connection(local_ip, local_port, remote_ip, remote_port))
+    return connections
+
+
+def read_proc_listening_ports(paths: List[str]=PROC_TCP):
+    """Local ports of the listening TCP sockets, IPv4 and IPv6."""
+    return {int(fields[1][fields[1].rindex(":") + 1:], 16) for fields in read_proc_rows(TCP_LISTEN, paths)}
+
+
+def read_psutil_connections(ports: Set[int]=None):
+    import psutil
+    connections = []
+    for c in psutil.net_connections(kind="tcp"):
+        if c.status != psutil.CONN_ESTABLISHED or not c.raddr:
+            continue
+        if ports is not None and c.laddr.port not in ports:
+            continue
+        connections.append(Connection(c.laddr.ip, c.laddr.port, c.raddr.ip, c.raddr.port))
+    return connections
+
+
+def read_psutil_listening_ports():
+    import psutil
+    return {c.laddr.port for c in psutil.net_connections(kind="tcp") if c.status == psutil.CONN_LISTEN}
+
+
+def listening_ports():
+    """Ports of the listening TCP sockets, from ``/proc`` when available or through psutil."""
+    if os.path.exists(PROC_TCP[0]):
+        return read_proc_listening_ports()
+    return read_psutil_listening_ports()
+
+
+def established_connections(ports: Set[int]=None):
+    """Read the socket table in process, from ``/proc`` when available or through psutil."""
+    if os.path.exists(PROC_TCP[0]):
+        return read_proc_connections(ports)
+    return read_psutil_connections(ports)
@@ -0,0 +1,401 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+from typing import List
+from .backupengine import COPY_BUFFER_SIZE
+from .throttle import Throttle
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .backupmgr import BackupManager
+
+# Objects uploaded between two saves of the sync state
+SAVE_EVERY = 50
+MULTIPART_SIZE = 64 * 1024 * 1024
+
+
+class ThrottledReader(object):
+    """File object wrapper accounting every read against a shared ``Throttle``."""
+
+    def __init__(self, f, size: int, throttle: Throttle=None):
+        self._f = f
+        self._size = size
+        self._throttle = throttle
+
+    def read(self, size: int=-1):
+        """Read ``size`` bytes, or up to the end for -1, throttled one buffer at a time.
+
+        Only a short read means the end of the file, callers like requests or
+        s3transfer size their uploads on what they get back.
+        """
+        parts = []
+        left = None if size is None or size < 0 else size
+        while left is None or left > 0:
+            data = self._f.read(COPY_BUFFER_SIZE if left is None else min(left, COPY_BUFFER_SIZE))
+            if not data:
+                break
+            if self._throttle:
+                self._throttle.consume(len(data))
+            parts.append(data)
+            if left is not None:
+                left -= len(data)
+        return b"".join(parts)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        while True:
+            data = self.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            yield data
+
+
+class SyncTarget(object):
+    """Remote store of the backups, objects are named by their path relative to ``backup_path``."""
+
+    def __init__(self, url: str):
+        self._url = url
+
+    @property
+    def url(self):
+        return self._url
+
+    def put(self, name: str, path: str, throttle: Throttle=None):
+        raise NotImplementedError()
+
+    def delete(self, name: str):
+        raise NotImplementedError()
+
+
+class LocalTarget(SyncTarget):
+    """A directory, like a mounted network share or a stand-in for tests."""
+
+    def __init__(self, url: str):
+        super().__init__(url)
+        self._path = urllib.parse.urlparse(url).path if url.startswith("file://") else url
+
+    def put(self, name: str, path: str, throttle: Throttle=None):
+        dest = os.path.join(self._path, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = f"{dest}.{threading.get_ident()}.part"
+        with open(path, "rb") as src, open(tmp_path, "wb") as f:
+            shutil.copyfileobj(ThrottledReader(src, os.path.getsize(path), throttle), f, COPY_BUFFER_SIZE)
+        os.replace(tmp_path, dest)
+
+    def delete(self, name: str):
+        try:
+            os.remove(os.path.join(self._path, name))
+        except FileNotFoundError:
+            pass
+
+
+class WebDavTarget(SyncTarget):
+    """A WebDAV collection like Nextcloud, with the credentials in the URL or ``user`` and ``password``."""
+
+    def __init__(self, url: str, user: str="", password: str=""):
+        super().__init__(url)
+        import requests
+        parts = urllib.parse.urlparse(url)
+        scheme = {"webdav": "http", "webdavs": "https"}.get(parts.scheme, parts.scheme)
+        netloc = parts.hostname + (f":{parts.port}" if parts.port else "")
+        self._base = urllib.parse.urlunparse((scheme, netloc, parts.path.rstrip("/"), "", "", ""))
+        self._session = requests.Session()
+        user = user or urllib.parse.unquote(parts.username or "")
+        password = password or urllib.parse.unquote(parts.password or "")
+        if user:
+            self._session.auth = (user, password)
+        self._collections = set()
+        self._lock = threading.Lock()
+
+    def _object_url(self, name: str):
+        return f"{self._base}/{urllib.parse.quote(name)}"
+
+    def _make_collections(self, name: str):
+        parts = name.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            collection = "/".join(parts[:i])
+            with self._lock:
+                if collection in self._collections:
+                    continue
+                self._collections.add(collection)
+            response = self._session.request("MKCOL", self._object_url(collection) + "/")
+            # 405 when the collection already exists
+            if response.status_code not in (201, 405):
+                response.raise_for_status()
+
+    def put(self, name: str, path: str, throttle: Throttle=None):
+        self._make_collections(name)
+        with open(path, "rb") as f:
+            response = self._session.put(self._object_url(name), data=ThrottledReader(f, os.path.getsize(path),
+                                                                                     throttle))
+        response.raise_for_status()
+
+    def delete(self, name: str):
+        response = self._session.delete(self._object_url(name))
+        if response.status_code != 404:
+            response.raise_for_status()
+
+
+class S3Target(SyncTarget):
+    """An S3 compatible bucket like AWS or MinIO, ``s3://bucket/prefix``, with the optional boto3 package.
+
+    Archives larger than ``MULTIPART_SIZE`` are sent in parts, ``part_jobs`` at a time.
+    """
+
+    def __init__(self, url: str, endpoint: str="", region: str="", access_key: str="", secret_key: str="",
+                 part_jobs: int=4):
+        super().__init__(url)
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise RuntimeError("Syncing to S3 needs the boto3 package")
+        parts = urllib.parse.urlparse(url)
+        self._bucket = parts.netloc
+        self._prefix = parts.path.strip("/")
+        self._client = boto3.client("s3", endpoint_url=endpoint or None, region_name=region or None,
+                                    aws_access_key_id=access_key or None, aws_secret_access_key=secret_key or None)
+        self._config = TransferConfig(multipart_threshold=MULTIPART_SIZE, multipart_chunksize=MULTIPART_SIZE,
+                                      max_concurrency=part_jobs)
+
+    def _key(self, name: str):
+        return f"{self._prefix}/{name}" if self._prefix else name
+
+    def put(self, name: str, path: str, throttle: Throttle=None):
+        # From the path, s3transfer reads the parts in parallel and reports each block read to the callback
+        self._client.upload_file(path, self._bucket, self._key(name), Config=self._config,
+                                 Callback=throttle.consume if throttle else None)
+
+    def delete(self, name: str):
+        self._client.delete_object(Bucket=self._bucket, Key=self._key(name))
+
+
+def create_target(url: str, **options):
+    """Sync target for ``url``: ``s3://``, ``webdav(s)://`` or ``http(s)://``, otherwise a local directory."""
+    scheme = urllib.parse.urlparse(url).scheme
+    if scheme == "s3":
+        return S3Target(url, **options)
+    if scheme in ("webdav", "webdavs", "http", "https"):
+        return WebDavTarget(url, **options)
+    if scheme not in ("", "file"):
+        raise ValueError(f"Unknown sync target {url}")
+    return LocalTarget(url)
+
+
+class SyncStats(object):
+
+    def __init__(self):
+        self._uploaded = 0
+        self._bytes = 0
+        self._deleted = 0
+        self._errors = []
+        self._start = time.monotonic()
+        self._elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, size: int):
+        with self._lock:
+            self._uploaded += 1
+            self._bytes += size
+
+    def delete(self):
+        with self._lock:
+            self._deleted += 1
+
+    def error(self, name: str, error: Exception):
+        with self._lock:
+            self._errors.append(f"{name}: {error}")
+
+    def stop(self):
+        self._elapsed = time.monotonic() - self._start
+
+    @property
+    def uploaded(self):
+        return self._uploaded
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    @property
+    def deleted(self):
+        return self._deleted
+
+    @property
+    def errors(self):
+        return self._errors
+
+    @property
+    def elapsed(self):
+        return self._elapsed
+
+    def __str__(self):
+        rate = self._bytes / self._elapsed / (1024 * 1024) if self._elapsed else 0
+        text = (f"{self._uploaded} objects uploaded ({self._bytes / (1024 * 1024):.1f} MiB, {rate:.1f} MiB/s), "
+                f"{self._deleted} deleted in {self._elapsed:.1f}s")
+        return text + (f", {len(self._errors)} failed" if self._errors else "")
+
+
+class BackupSync(object):
+    """Mirror the backups of a ``BackupManager`` to a ``SyncTarget``.
+
+    The objects already uploaded are tracked in a state file in the backup
+    directory, one per target, so a run only uploads what is new: archives
+    from the catalog and the chunks of the manifests not synced yet. Chunks
+    are immutable, they go first so a remote manifest never lacks its chunks.
+    Archives deleted locally, by retention or cleanups, are deleted remotely,
+    as are the chunks no manifest references any more.
+    """
+
+    def __init__(self, backup_manager: 'BackupManager', target: SyncTarget, jobs: int=4, max_rate: float=0,
+                 delete: bool=True):
+        self._backup_manager = backup_manager
+        self._target = target
+        self._jobs = max(1, jobs)
+        self._throttle = Throttle(max_rate)
+        self._delete = delete
+        digest = hashlib.sha256(target.url.encode()).hexdigest()[:12]
+        self._state_path = os.path.join(backup_manager.backup_path, f".sync-{digest}.json")
+        self._objects = None
+        self._lock = threading.Lock()
+        self._unsaved = 0
+
+    @property
+    def state_path(self):
+        return self._state_path
+
+    def _load(self):
+        try:
+            with open(self._state_path, "rt") as f:
+                self._objects = json.load(f)["objects"]
+        except FileNotFoundError:
+            self._objects = {}
+        except Exception as e:
+            print(f"Cannot load sync state: {e}")
+            self._objects = {}
+
+    def _save(self):
+        tmp_path = f"{self._state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wt") as f:
+            json.dump({"version": 1, "target": self._target.url, "objects": self._objects}, f)
+        os.replace(tmp_path, self._state_path)
+        self._unsaved = 0
+
+    def plan(self):
+        """Objects to upload as (name, path, size) and names to delete, chunks first."""
+        if self._objects is None:
+            self._load()
+        store = self._backup_manager.dedup_store
+        backups = {}
+        for backup in self._backup_manager.catalog.backups():
+            backups[backup.file] = backup
+        uploads = []
+        archives = []
+        for file, backup in sorted(backups.items()):
+            synced = self._objects.get(file)
+            try:
+                st = os.stat(backup.path)
+            except FileNotFoundError:
+                continue
+            if synced and synced == [st.st_size, st.st_mtime_ns]:
+                continue
+            archives.append((file, backup.path, st.st_size))
+            if backup.is_manifest:
+                for digest in self._manifest_chunks(backup.path):
+                    name = f"chunks/{digest[:2]}/{digest}"
+                    if name in self._objects:
+                        continue
+                    path = store.chunk_path(digest)
+                    try:
+                        uploads.append((name, path, os.path.getsize(path)))
+                    except FileNotFoundError:
+                        print(f"Cannot find chunk {digest} of {file}")
+        uploads = list({u[0]: u for u in uploads}.values()) + archives
+        deletes = []
+        if self._delete:
+            removed = [n for n in self._objects if not n.startswith("chunks/") and n not in backups]
+            deletes.extend(removed)
+            if any(n.endswith(".manifest") for n in removed):
+                used = set()
+                for backup in backups.values():
+                    if backup.is_manifest:
+                        used.update(self._manifest_chunks(backup.path))
+                deletes.extend(n for n in self._objects if n.startswith("chunks/") and n.split("/")[-1] not in used)
+        return uploads, deletes
+
+    def _manifest_chunks(self, path: str):
+        try:
+            entries = self._backup_manager.dedup_store.load_manifest(path)["entries"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Cannot read manifest {path}: {e}")
+            return set()
+        return {digest for entry in entries for digest in entry.get("chunks", [])}
+
+    def run(self, dry_run: bool=False):
+        from concurrent.futures import ThreadPoolExecutor
+        stats = SyncStats()
+        uploads, deletes = self.plan()
+        print(f"Syncing {len(uploads)} objects ({sum(u[2] for u in uploads) / (1024 * 1024):.1f} MiB) to "
+              f"{self._target.url}, deleting {len(deletes)}")
+        if dry_run:
+            for name, _, size in uploads:
+                print(f"\tWould upload {name} ({size / (1024 * 1024):.1f} MiB)")
+            for name in deletes:
+                print(f"\tWould delete {name}")
+            stats.stop()
+            return stats
+        try:
+            chunks = [u for u in uploads if u[0].startswith("chunks/")]
+            archives = [u for u in uploads if not u[0].startswith("chunks/")]
+            with ThreadPoolExecutor(self._jobs, thread_name_prefix="sync") as pool:
+                # Manifests only go once every chunk they reference is uploaded
+                list(pool.map(lambda u: self._upload(*u, stats), chunks))
+                failed_chunks = bool(stats.errors)
+                list(pool.map(lambda u: self._upload(*u, stats),
+                              [a for a in archives if not (failed_chunks and a[0].endswith(".manifest"))]))
+                # Archives first, a chunk is only deleted once no remote manifest uses it
+                names = [d for d in deletes if not d.startswith("chunks/")]
+                list(pool.map(lambda n: self._remove(n, stats), names))
+                list(pool.map(lambda n: self._remove(n, stats), [d for d in deletes if d.startswith("chunks/")]))
+        finally:
+            with self._lock:
+                self._save()
+        stats.stop()
+        return stats
+
+    def _upload(self, name: str, path: str, size: int, stats: SyncStats):
+        try:
+            st = os.stat(path)
+            self._target.put(name, path, self._throttle)
+        except Exception as e:
+            stats.error(name, e)
+            print(f"Cannot upload {name}: {e}")
+            return
+        stats.add(size)
+        self._record(name, [st.st_size, st.st_mtime_ns])
+
+    def _remove(self, name: str, stats: SyncStats):
+        try:
+            self._target.delete(name)
+        except Exception as e:
+            stats.error(name, e)
+            print(f"Cannot delete {name}: {e}")
+            return
+        stats.delete()
+        self._record(name, None)
+
+    def _record(self, name: str, value: List[int]):
+        with self._lock:
+            if value is None:
+                self._objects.pop(name, None)
+            else:
+                self._objects[name] = value
+            self._unsaved += 1
+            # An interrupted sync resumes from the last save
+            if self._unsaved >= SAVE_EVERY:
+                self._save()
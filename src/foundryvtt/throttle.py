@@ -0,0 +1,122 @@
+import os
+import subprocess
+import threading
+import time
+from typing import Callable
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .foundry import Foundry
+    from .instance import FoundryInstance
+
+IONICE_CLASSES = {"best-effort": 2, "idle": 3}
+BUSY_CHECK_INTERVAL = 10
+
+
+class Throttle(object):
+    """Token bucket limiting the bytes read per second, 0 means unlimited.
+
+    In adaptive mode, ``busy`` is polled every ``check_interval`` seconds and
+    ``busy_rate`` replaces ``rate`` while it returns True, so a backup slows
+    down while players are connected and speeds up again once they leave.
+    """
+
+    def __init__(self, rate: float=0, busy_rate: float=0, busy: Callable=None,
+                 check_interval: float=BUSY_CHECK_INTERVAL):
+        self._rate = rate
+        self._busy_rate = busy_rate
+        self._busy = busy if busy_rate else None
+        self._check_interval = check_interval
+        self._is_busy = False
+        self._checked = None
+        self._allowance = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        if self._busy:
+            now = time.monotonic()
+            if self._checked is None or now - self._checked > self._check_interval:
+                self._checked = now
+                try:
+                    self._is_busy = bool(self._busy())
+                except Exception as e:
+                    print(f"Cannot check for an active session: {e}")
+                    self._is_busy = False
+            if self._is_busy:
+                return min(self._rate, self._busy_rate) if self._rate else self._busy_rate
+        return self._rate
+
+    def consume(self, size: int):
+        """Account for ``size`` bytes, sleep long enough to stay under the rate."""
+        rate = self.rate
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # Allow bursts of up to one second worth of data
+            self._allowance = min(rate, self._allowance + (now - self._last) * rate) - size
+            self._last = now
+            delay = -self._allowance / rate if self._allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class SessionMonitor(object):
+    """Tell if players are connected to an instance.
+
+    Blind to players reaching a published port through Docker DNAT, see
+    ``Foundry.get_connection_counts``.
+    """
+
+    def __init__(self, foundry: 'Foundry', instance: 'FoundryInstance'):
+        self._foundry = foundry
+        self._instance = instance
+
+    def __call__(self):
+        return self._foundry.get_connection_counts().get(self._instance.name, 0) > 0
+
+
+def lower_priority(nice: int=0, ionice: str=""):
+    """Lower the CPU and I/O priority of the calling thread.
+
+    On Linux both apply to the thread only, and to the processes it starts.
+    Unprivileged users cannot raise a priority back, so only call this from a
+    thread that ends with the work, see ``run_low_priority``.
+    """
+    tid = threading.get_native_id() if hasattr(threading, "get_native_id") else 0
+    if nice:
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, min(19, os.getpriority(os.PRIO_PROCESS, tid) + nice))
+        except (AttributeError, OSError) as e:
+            print(f"Cannot change the CPU priority: {e}")
+    if ionice:
+        try:
+            args = ["ionice", "-c", str(IONICE_CLASSES[ionice]), "-p", str(tid or os.getpid())]
+            if ionice != "idle":
+                args[3:3] = ["-n", "7"]
+            subprocess.run(args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Cannot change the I/O priority: {e}")
+
+
+def run_low_priority(func: Callable, nice: int=0, ionice: str=""):
+    """Run ``func`` in a new thread with a lower priority and return its result."""
+    if not nice and not ionice:
+        return func()
+    results = {}
+
+    def run():
+        lower_priority(nice, ionice)
+        try:
+            results["value"] = func()
+        except BaseException as e:
+            results["error"] = e
+
+    # A daemon thread so an interrupted command exits, leaving the checkpoint to resume from
+    thread = threading.Thread(target=run, name="low-priority", daemon=True)
+    thread.start()
+    thread.join()
+    if "error" in results:
+        raise results["error"]
+    return results["value"]
@@ -0,0 +1,193 @@
+import datetime
+import json
+import os
+import time
+from typing import List
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .instance import FoundryInstance
+
+INDEX_FILE = ".data-index.json"
+# World databases are rewritten in place, which does not touch their directory mtime
+DEEP_PATHS = ["Data/worlds"]
+
+
+class DataTracker(object):
+    """Persistent index of the files in an instance data tree.
+
+    The index keeps (size, mtime, inode) for every file, grouped by directory.
+    ``update`` only lists the directories whose mtime changed since the last
+    run; files under ``DEEP_PATHS`` are always restated since they can change
+    without their directory noticing.
+    """
+
+    def __init__(self, instance: 'FoundryInstance', deep_paths: List[str]=DEEP_PATHS):
+        self._root = instance.instance_data_path
+        self._index_path = os.path.join(instance.path, INDEX_FILE)
+        self._deep_paths = deep_paths
+        self._dirs = None
+
+    @property
+    def index_path(self):
+        return self._index_path
+
+    def load(self):
+        try:
+            with open(self._index_path, "rt") as f:
+                self._dirs = json.load(f)["dirs"]
+        except FileNotFoundError:
+            self._dirs = {}
+        except Exception as e:
+            print(f"Cannot load data index: {e}")
+            self._dirs = {}
+
+    def save(self):
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wt") as f:
+            json.dump({"version": 1, "dirs": self._dirs}, f)
+        os.replace(tmp_path, self._index_path)
+
+    def update(self):
+        """Refresh the index, return the number of directories that were listed again."""
+        if self._dirs is None:
+            self.load()
+        dirs = {}
+        rescanned = 0
+        stack = [""]
+        while stack:
+            relative = stack.pop()
+            path = os.path.join(self._root, relative) if relative else self._root
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            old = self._dirs.get(relative)
+            if old and old["mtime"] == st.st_mtime_ns and old["ino"] == st.st_ino:
+                entry = old
+                if self._is_deep(relative):
+                    entry = dict(old, files=self._restat(path, old["files"]))
+            else:
+                entry = self._scan(path, st)
+                rescanned += 1
+            if entry is None:
+                continue
+            dirs[relative] = entry
+            stack.extend(f"{relative}/{name}" if relative else name for name in entry["dirs"])
+        changed = rescanned or dirs != self._dirs
+        self._dirs = dirs
+        if changed:
+            self.save()
+        return rescanned
+
+    def size(self, relative: str=""):
+        """Total size of the files under ``relative``, e.g. ``Data/worlds/<name>``."""
+        self._ensure_loaded()
+        return sum(sum(f[0] for f in entry["files"].values())
+                   for path, entry in self._dirs.items() if self._is_under(path, relative))
+
+    def last_change(self, relative: str=""):
+        """Newest file or directory mtime under ``relative``, as a datetime."""
+        self._ensure_loaded()
+        newest = 0
+        for path, entry in self._dirs.items():
+            if not self._is_under(path, relative):
+                continue
+            newest = max([newest, entry["mtime"]] + [f[1] for f in entry["files"].values()])
+        return datetime.datetime.fromtimestamp(newest / 1e9) if newest else None
+
+    def changed_since(self, since: datetime.datetime, relative: str=""):
+        """Files under ``relative`` modified after ``since``."""
+        self._ensure_loaded()
+        limit = since.timestamp() * 1e9
+        results = []
+        for path, entry in self._dirs.items():
+            if not self._is_under(path, relative):
+                continue
+            for name, info in entry["files"].items():
+                if info[1] > limit:
+                    results.append(f"{path}/{name}" if path else name)
+        return sorted(results)
+
+    def children(self, relative: str):
+        self._ensure_loaded()
+        entry = self._dirs.get(relative)
+        return sorted(entry["dirs"]) if entry else []
+
+    def world_sizes(self):
+        return {name: self.size(f"Data/worlds/{name}") for name in self.children("Data/worlds")}
+
+    def changed_worlds(self, since: datetime.datetime):
+        """Worlds with a file or directory changed after ``since``, including deletions."""
+        results = []
+        for name in self.children("Data/worlds"):
+            last = self.last_change(f"Data/worlds/{name}")
+            if last is None or last > since:
+                results.append(name)
+        return results
+
+    def watch(self, interval: float=60, stop=None):
+        """Keep the index up to date until ``stop`` (a threading.Event) is set.
+
+        With the optional ``inotify_simple`` package, updates run when the tree
+        changes; otherwise the tree is polled every ``interval`` seconds.
+        """
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            INotify = None
+        while stop is None or not stop.is_set():
+            self.update()
+            if INotify is None:
+                if stop is not None:
+                    stop.wait(interval)
+                else:
+                    time.sleep(interval)
+                continue
+            with INotify() as inotify:
+                mask = flags.CREATE | flags.DELETE | flags.MODIFY | flags.MOVED_FROM | flags.MOVED_TO | flags.ATTRIB
+                for relative in self._dirs:
+                    try:
+                        inotify.add_watch(os.path.join(self._root, relative) if relative else self._root, mask)
+                    except OSError:
+                        continue
+                inotify.read(timeout=int(interval * 1000))
+                # Let a burst of writes settle before the next update
+                inotify.read(timeout=1000, read_delay=1000)
+
+    def _ensure_loaded(self):
+        if self._dirs is None:
+            self.load()
+
+    def _is_under(self, path: str, relative: str):
+        return not relative or path == relative or path.startswith(f"{relative}/")
+
+    def _is_deep(self, relative: str):
+        return any(self._is_under(relative, deep) for deep in self._deep_paths)
+
+    def _scan(self, path: str, st: os.stat_result):
+        files = {}
+        subdirs = []
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    fst = entry.stat(follow_symlinks=False)
+                    files[entry.name] = [fst.st_size, fst.st_mtime_ns, fst.st_ino]
+            except FileNotFoundError:
+                continue
+        return {"mtime": st.st_mtime_ns, "ino": st.st_ino, "files": files, "dirs": sorted(subdirs)}
+
+    def _restat(self, path: str, files: dict):
+        results = {}
+        for name in files:
+            try:
+                fst = os.stat(os.path.join(path, name))
+            except FileNotFoundError:
+                continue
+            results[name] = [fst.st_size, fst.st_mtime_ns, fst.st_ino]
+        return results
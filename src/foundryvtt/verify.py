@@ -0,0 +1,224 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+import zipfile
+import zlib
+from typing import List
+from .backup import Backup
+from .backupengine import COPY_BUFFER_SIZE, INTEGRITY_FILE
+from .dedupstore import DedupStore
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .catalog import BackupCatalog
+
+# Work handed to a single worker, so a few huge archives still use every core
+TASK_SIZE = 256 * 1024 * 1024
+MAX_ERRORS = 20
+
+
+class VerifyResult(object):
+
+    def __init__(self, file: str, ok: bool=True, files: int=0, bytes: int=0, errors: List[str]=None,
+                 elapsed: float=0.0, hashed: bool=True):
+        self._file = file
+        self._ok = ok
+        self._files = files
+        self._bytes = bytes
+        self._errors = errors or []
+        self._elapsed = elapsed
+        self._hashed = hashed
+
+    @property
+    def file(self):
+        return self._file
+
+    @property
+    def ok(self):
+        return self._ok
+
+    @property
+    def files(self):
+        return self._files
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    @property
+    def errors(self):
+        return self._errors
+
+    @property
+    def elapsed(self):
+        return self._elapsed
+
+    @property
+    def hashed(self):
+        """False when the archive has no integrity manifest and only the CRCs were checked."""
+        return self._hashed
+
+    def merge(self, other: 'VerifyResult'):
+        self._ok = self._ok and other.ok
+        self._files += other.files
+        self._bytes += other.bytes
+        self._errors.extend(other.errors[:MAX_ERRORS - len(self._errors)])
+        self._elapsed += other.elapsed
+        self._hashed = self._hashed and other.hashed
+
+    def __str__(self):
+        state = "ok" if self._ok else f"FAILED: {'; '.join(self._errors)}"
+        checked = "sha256" if self._hashed else "crc only"
+        return (f"{self._file}: {state} ({self._files} files, {self._bytes / (1024 * 1024):.1f} MiB, "
+                f"{checked}, {self._elapsed:.1f}s)")
+
+
+def read_integrity(zf: zipfile.ZipFile):
+    """The integrity manifest files of an archive, None for archives written before manifests."""
+    try:
+        with zf.open(INTEGRITY_FILE) as f:
+            return json.load(f)["files"]
+    except KeyError:
+        return None
+
+
+def verify_zip_entries(path: str, names: List[str]):
+    """Stream ``names`` out of the archive, check their CRC and the sha256 of the integrity manifest."""
+    start = time.monotonic()
+    result = VerifyResult(os.path.basename(path))
+    try:
+        with zipfile.ZipFile(path) as zf:
+            hashes = read_integrity(zf)
+            if hashes is None:
+                result = VerifyResult(result.file, hashed=False)
+            for name in names:
+                digest = hashlib.sha256()
+                size = 0
+                try:
+                    # The zip module raises at the end of a member whose CRC does not match
+                    with zf.open(name) as f:
+                        while True:
+                            data = f.read(COPY_BUFFER_SIZE)
+                            if not data:
+                                break
+                            size += len(data)
+                            digest.update(data)
+                except (zipfile.BadZipFile, zlib.error, EOFError, KeyError) as e:
+                    result.merge(VerifyResult(result.file, False, errors=[f"{name}: {e}"]))
+                    continue
+                expected = hashes.get(name) if hashes is not None else None
+                if hashes is not None and not expected:
+                    result.merge(VerifyResult(result.file, False, errors=[f"{name}: missing from the manifest"]))
+                elif expected and expected[1] and (expected[0] != size or expected[1] != digest.hexdigest()):
+                    result.merge(VerifyResult(result.file, False, errors=[f"{name}: content does not match"]))
+                result.merge(VerifyResult(result.file, files=1, bytes=size))
+    except (OSError, zipfile.BadZipFile) as e:
+        result.merge(VerifyResult(result.file, False, errors=[str(e)]))
+    result.merge(VerifyResult(result.file, elapsed=time.monotonic() - start))
+    return result
+
+
+def verify_manifest(path: str):
+    """Check that every chunk of a deduplicated backup is in the store with the right content."""
+    start = time.monotonic()
+    result = VerifyResult(os.path.basename(path))
+    store = DedupStore(os.path.dirname(path))
+    checked = {}
+    try:
+        entries = store.load_manifest(path)["entries"]
+    except (OSError, ValueError, KeyError) as e:
+        return VerifyResult(result.file, False, errors=[str(e)])
+    for entry in entries:
+        if entry["name"].endswith("/"):
+            continue
+        size = 0
+        for digest in entry.get("chunks", []):
+            if digest not in checked:
+                try:
+                    data = store.get_chunk(digest)
+                    checked[digest] = len(data) if hashlib.sha256(data).hexdigest() == digest else -1
+                except (OSError, ValueError, zlib.error) as e:
+                    result.merge(VerifyResult(result.file, False, errors=[f"{entry['name']}: chunk {digest}: {e}"]))
+                    checked[digest] = -1
+                    continue
+            if checked[digest] < 0:
+                result.merge(VerifyResult(result.file, False, errors=[f"{entry['name']}: chunk {digest} is corrupted"]))
+                continue
+            size += checked[digest]
+        if result.ok and size != entry.get("size", size):
+            result.merge(VerifyResult(result.file, False, errors=[f"{entry['name']}: size does not match"]))
+        result.merge(VerifyResult(result.file, files=1, bytes=size))
+    result.merge(VerifyResult(result.file, elapsed=time.monotonic() - start))
+    return result
+
+
+class BackupVerifier(object):
+    """Verify backups without extracting them, ``workers`` processes at a time.
+
+    Archives are split in tasks of about ``TASK_SIZE`` compressed bytes, so
+    the work spreads over every core even for a handful of large archives.
+    Each result is recorded in the catalog as ``verified`` and ``verified_ok``,
+    and backups verified successfully within ``window`` are skipped.
+    """
+
+    def __init__(self, catalog: 'BackupCatalog', workers: int=None):
+        self._catalog = catalog
+        self._workers = max(1, workers or os.cpu_count() or 1)
+
+    def pending(self, backups: List[Backup], window: datetime.timedelta=None):
+        if not window:
+            return list(backups)
+        records = self._catalog.records()
+        limit = datetime.datetime.now() - window
+        results = []
+        for backup in backups:
+            record = records.get(backup.file, {})
+            verified = record.get("verified")
+            if verified and record.get("verified_ok") and datetime.datetime.fromisoformat(verified) > limit:
+                continue
+            results.append(backup)
+        return results
+
+    def verify(self, backups: List[Backup], window: datetime.timedelta=None):
+        backups = self.pending(backups, window)
+        from concurrent.futures import ProcessPoolExecutor
+        results = {b.file: VerifyResult(b.file) for b in backups}
+        with ProcessPoolExecutor(self._workers) as pool:
+            futures = []
+            for backup in backups:
+                if backup.is_manifest:
+                    futures.append(pool.submit(verify_manifest, backup.path))
+                    continue
+                try:
+                    tasks = self._split(backup.path)
+                except (OSError, zipfile.BadZipFile) as e:
+                    results[backup.file].merge(VerifyResult(backup.file, False, errors=[str(e)]))
+                    continue
+                futures.extend(pool.submit(verify_zip_entries, backup.path, names) for names in tasks)
+            for future in futures:
+                result = future.result()
+                results[result.file].merge(result)
+        now = datetime.datetime.now().isoformat()
+        for backup in backups:
+            result = results[backup.file]
+            self._catalog.update(backup.file, verified=now, verified_ok=result.ok, verify_errors=result.errors)
+        return [results[b.file] for b in backups]
+
+    def _split(self, path: str):
+        tasks = []
+        names = []
+        size = 0
+        with zipfile.ZipFile(path) as zf:
+            for zinfo in zf.infolist():
+                if zinfo.is_dir() or zinfo.filename == INTEGRITY_FILE:
+                    continue
+                names.append(zinfo.filename)
+                size += zinfo.compress_size
+                if size >= TASK_SIZE:
+                    tasks.append(names)
+                    names = []
+                    size = 0
+        if names or not tasks:
+            tasks.append(names)
+        return tasks
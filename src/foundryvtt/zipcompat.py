@@ -0,0 +1,140 @@
+"""Zip writing the public ``zipfile`` API does not offer.
+
+The backup engine appends members compressed by worker processes, resumes
+an archive from a checkpoint, picks a compression level per member and
+hashes the archive while writing it. Each of these relies on
+``zipfile.ZipFile`` internals that are unchanged from Python 3.8 to 3.13.
+They are only used here, and ``tests/test_zipcompat.py`` writes and reads
+back an archive with every codec, so a new Python release only needs
+checking against this module.
+"""
+import hashlib
+import io
+import zipfile
+from typing import List
+
+# ZipInfo._compresslevel became a public slot in Python 3.13
+COMPRESS_LEVEL_ATTR = "compress_level" if hasattr(zipfile.ZipInfo, "compress_level") else "_compresslevel"
+
+
+class HashingWriter(object):
+    """Append only file object computing the sha256 of everything written through it.
+
+    It cannot seek, so ``ZipFile`` writes every member in one go with its CRC
+    and sizes in a data descriptor after the data, instead of seeking back to
+    patch the local header, and the digest is the one of the file on disk.
+    """
+
+    def __init__(self, fp, digest=None):
+        self._fp = fp
+        self._digest = digest or hashlib.sha256()
+        self._offset = fp.tell()
+
+    def write(self, data: bytes):
+        self._digest.update(data)
+        self._offset += len(data)
+        return self._fp.write(data)
+
+    def tell(self):
+        return self._offset
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset: int, whence: int=0):
+        # ZipFile probes seek() once when opened and falls back to streaming
+        raise io.UnsupportedOperation("seek")
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+def get_compressor(compress_type: int, level: int=None):
+    """Compressor object ``ZipFile`` would use for ``compress_type``, None when data is stored."""
+    return zipfile._get_compressor(compress_type, level)
+
+
+def set_compress_level(zinfo: zipfile.ZipInfo, level: int=None):
+    """Compression level of the member, ``ZipFile.open(zinfo, "w")`` ignores the archive level."""
+    setattr(zinfo, COMPRESS_LEVEL_ATTR, level)
+
+
+def create(path: str, compression: int, level: int=None):
+    """Open a new archive written through a ``HashingWriter``, return both."""
+    return _open(open(path, "wb"), compression, level)
+
+
+def resume(path: str, offset: int, entries: List[zipfile.ZipInfo], compression: int, level: int=None):
+    """Reopen an archive to append after the members in ``entries``, which end at ``offset``.
+
+    Everything from ``offset`` on, a partly written member and the old central
+    directory, is truncated. The part kept is read once to seed the digest.
+    The central directory is written again from ``entries`` plus the new
+    members when the archive is closed.
+    """
+    fp = open(path, "r+b")
+    try:
+        fp.truncate(offset)
+        digest = hashlib.sha256()
+        while fp.tell() < offset:
+            data = fp.read(min(1024 * 1024, offset - fp.tell()))
+            if not data:
+                break
+            digest.update(data)
+        fp.seek(offset)
+    except BaseException:
+        fp.close()
+        raise
+    zf, writer = _open(fp, compression, level, digest)
+    for zinfo in entries:
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+    return zf, writer
+
+
+def _open(fp, compression: int, level: int=None, digest=None):
+    try:
+        writer = HashingWriter(fp, digest)
+        zf = zipfile.ZipFile(writer, "w", compression, allowZip64=True, compresslevel=level,
+                             strict_timestamps=False)
+    except BaseException:
+        fp.close()
+        raise
+    # A ZipFile does not close a file object it was given, make it own this one
+    zf._filePassed = 0
+    return zf, writer
+
+
+def end_offset(zf: zipfile.ZipFile):
+    """Offset where the next member goes, everything before it is on disk once flushed."""
+    zf.fp.flush()
+    return zf.start_dir
+
+
+def write_compressed(zf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, data: bytes):
+    """Append a member whose data is already compressed with ``zinfo.compress_type``.
+
+    ``zinfo`` must have its ``CRC``, ``file_size`` and ``compress_size`` set.
+    These are the steps of ``ZipFile.open(zinfo, "w")`` without compressing.
+    """
+    zinfo.flag_bits = 0
+    if zinfo.compress_type == zipfile.ZIP_LZMA:
+        # Compressed data includes an end-of-stream marker
+        zinfo.flag_bits |= 0x02
+    if zf._seekable:
+        zf.fp.seek(zf.start_dir)
+    zinfo.header_offset = zf.fp.tell()
+    # Raises on duplicate names, a closed archive or sizes needing ZIP64 when it is not allowed
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader(False))
+    zf.fp.write(data)
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
@@ -0,0 +1,50 @@
+import json
+import os
+import pytest
+from foundryvtt.backupmgr import BackupManager
+
+
+class FakeFoundry(object):
+    """The part of ``Foundry`` the backup manager uses, without Docker or settings."""
+
+    def __init__(self, path: str):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def backup_path(self):
+        return os.path.join(self._path, "backup")
+
+
+def write_file(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_settings(path: str, name: str, **info):
+    """Write the settings.db of instance ``name`` of the Foundry root ``path``."""
+    info = dict({"name": name, "version": "9.280", "service": f"foundryvtt-{name}",
+                 "create_date": "2024-01-01T12:00:00.000000"}, **info)
+    write_file(os.path.join(path, "instances", name, "settings.db"), json.dumps(info).encode())
+
+
+def make_foundry(path: str, instances):
+    """A Foundry root with ``instances`` by name with their settings, without Docker."""
+    from foundryvtt.foundry import Foundry
+    write_file(os.path.join(path, "settings.db"), json.dumps({
+        "backup": "backup", "instances": "instances", "production_instance": "prod",
+        "docker_image": "foundryvtt"}).encode())
+    for name, info in instances.items():
+        write_settings(path, name, **info)
+    return Foundry(path)
+
+
+@pytest.fixture
+def backup_manager(tmp_path):
+    foundry = FakeFoundry(str(tmp_path))
+    os.makedirs(foundry.backup_path)
+    return BackupManager(foundry)
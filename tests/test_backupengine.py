@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import zipfile
+import pytest
+from foundryvtt.backupengine import CODECS, INTEGRITY_FILE, BackupEngine
+from foundryvtt.catalog import file_checksum
+from conftest import write_file
+
+
+@pytest.fixture
+def tree(tmp_path):
+    path = str(tmp_path / "data")
+    write_file(os.path.join(path, "worlds", "w1", "data", "actors.db"), b'{"name": "actor"}\n' * 5000)
+    write_file(os.path.join(path, "worlds", "w1", "scenes", "map.webp"), os.urandom(200000))
+    for i in range(10):
+        write_file(os.path.join(path, "assets", f"token-{i}.txt"), f"token {i}\n".encode() * 300)
+    os.makedirs(os.path.join(path, "empty"))
+    return path
+
+
+def tree_files(path: str):
+    results = {}
+    for folder, _, files in os.walk(path):
+        for name in files:
+            with open(os.path.join(folder, name), "rb") as f:
+                results[os.path.relpath(os.path.join(folder, name), path).replace(os.sep, "/")] = f.read()
+    return results
+
+
+def check_archive(archive: str, tree: str):
+    expected = tree_files(tree)
+    with zipfile.ZipFile(archive) as zf:
+        assert zf.testzip() is None
+        # A resumed archive must neither repeat nor drop a member
+        assert len(zf.namelist()) == len(set(zf.namelist()))
+        files = {i.filename[len("backup/"):]: zf.read(i) for i in zf.infolist()
+                 if not i.is_dir() and i.filename != INTEGRITY_FILE}
+        integrity = json.loads(zf.read(INTEGRITY_FILE))["files"]
+        assert "backup/empty/" in zf.namelist()
+    assert files == expected
+    assert integrity == {f"backup/{name}": [len(data), hashlib.sha256(data).hexdigest()]
+                         for name, data in expected.items()}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_create_round_trip(tmp_path, tree, codec, workers):
+    archive = str(tmp_path / "full-20240101-120000.zip")
+    stats = BackupEngine(codec, workers=workers).create(archive, [(tree, "backup")])
+    check_archive(archive, tree)
+    assert stats.files == 12
+    assert stats.checksum == file_checksum(archive)
+    assert not os.path.exists(BackupEngine().partial_path(archive))
+
+
+def test_resume_from_checkpoint(tmp_path, tree):
+    archive = str(tmp_path / "full-20240101-120000.zip")
+    engine = BackupEngine(checkpoint=1e-9)
+    add_file = engine.add_file
+    added = []
+
+    def interrupted(zf, path, *args, **kwargs):
+        add_file(zf, path, *args, **kwargs)
+        added.append(path)
+        if len(added) == 6:
+            raise KeyboardInterrupt()
+
+    engine.add_file = interrupted
+    with pytest.raises(KeyboardInterrupt):
+        engine.create(archive, [(tree, "backup")])
+    assert not os.path.exists(archive)
+    assert os.path.exists(engine.partial_path(archive))
+    assert engine.find_partial(str(tmp_path), "full", [tree]) == "full-20240101-120000"
+
+    engine = BackupEngine(checkpoint=1e-9)
+    read = []
+    add_file = engine.add_file
+    engine.add_file = lambda zf, path, *args, **kwargs: read.append(path) or add_file(zf, path, *args, **kwargs)
+    stats = engine.create(archive, [(tree, "backup")])
+    check_archive(archive, tree)
+    assert stats.files == 12
+    assert stats.checksum == file_checksum(archive)
+    assert set(read).isdisjoint(added[:-1])
+    assert not os.path.exists(engine.partial_path(archive))
+
+
+def interrupt_after(engine: BackupEngine, method: str, count: int, torn: bytes=b""):
+    """Make ``engine`` fail after ``count`` calls of ``method``, leaving ``torn`` bytes of a member."""
+    original = getattr(engine, method)
+    calls = []
+
+    def interrupted(zf, *args, **kwargs):
+        original(zf, *args, **kwargs)
+        calls.append(args)
+        if len(calls) == count:
+            zf.fp.write(torn)
+            raise KeyboardInterrupt()
+
+    setattr(engine, method, interrupted)
+    return calls
+
+
+def test_resume_after_a_torn_member(tmp_path, tree, capsys):
+    archive = str(tmp_path / "full-20240101-120000.zip")
+    engine = BackupEngine(checkpoint=1e-9)
+    interrupt_after(engine, "add_file", 4, b"PK\x03\x04" + os.urandom(5000))
+    with pytest.raises(KeyboardInterrupt):
+        engine.create(archive, [(tree, "backup")])
+    stats = BackupEngine(checkpoint=1e-9).create(archive, [(tree, "backup")])
+    assert "after 4 entries" in capsys.readouterr().out
+    check_archive(archive, tree)
+    assert stats.files == 12
+    assert stats.checksum == file_checksum(archive)
+
+
+def test_resume_parallel_compression(tmp_path, tree, capsys):
+    archive = str(tmp_path / "full-20240101-120000.zip")
+    engine = BackupEngine("deflate", workers=2, checkpoint=1e-9)
+    interrupt_after(engine, "_write_compressed", 5, os.urandom(100))
+    with pytest.raises(KeyboardInterrupt):
+        engine.create(archive, [(tree, "backup")])
+    BackupEngine("deflate", workers=2, checkpoint=1e-9).create(archive, [(tree, "backup")])
+    assert "Resuming" in capsys.readouterr().out
+    check_archive(archive, tree)
+
+
+def test_resume_sees_files_changed_meanwhile(tmp_path, tree):
+    archive = str(tmp_path / "full-20240101-120000.zip")
+    engine = BackupEngine(checkpoint=1e-9)
+    written = interrupt_after(engine, "add_file", 6)
+    with pytest.raises(KeyboardInterrupt):
+        engine.create(archive, [(tree, "backup")])
+    archived = {arcname for _, arcname, *_ in written}
+    remaining = sorted(name for name in tree_files(tree) if f"backup/{name}" not in archived)
+    os.remove(os.path.join(tree, remaining[0]))
+    write_file(os.path.join(tree, "assets", "new.txt"), b"uploaded meanwhile")
+    BackupEngine(checkpoint=1e-9).create(archive, [(tree, "backup")])
+    check_archive(archive, tree)
+
+
+def test_checkpoint_of_other_sources_is_ignored(tmp_path, tree):
+    archive = str(tmp_path / "full-20240101-120000.zip")
+    engine = BackupEngine(checkpoint=1e-9)
+    interrupt_after(engine, "add_file", 6)
+    with pytest.raises(KeyboardInterrupt):
+        engine.create(archive, [(os.path.join(tree, "assets"), "backup/assets")])
+    BackupEngine(checkpoint=1e-9).create(archive, [(tree, "backup")])
+    check_archive(archive, tree)
@@ -0,0 +1,131 @@
+import json
+import os
+import pytest
+from foundryvtt import catalog as catalog_module
+from foundryvtt.catalog import BackupCatalog, file_checksum
+from conftest import write_file
+
+
+class FakeInstance(object):
+
+    def __init__(self, path: str):
+        self.name = "prod"
+        self.instance_data_path = path
+
+
+def add_backup(path: str, file: str, catalog: BackupCatalog=None, size: int=100):
+    write_file(os.path.join(path, file), b"x" * size)
+    if catalog:
+        catalog.add(file, "prod", 1, checksum="")
+
+
+def test_replays_the_log_in_another_process(tmp_path):
+    path = str(tmp_path)
+    catalog = BackupCatalog(path)
+    catalog.records()
+    add_backup(path, "full-prod-20240101-120000.zip", catalog)
+    add_backup(path, "world-prod-w1-20240102-120000.zip", catalog)
+    catalog.update("full-prod-20240101-120000.zip", verified="2024-01-03T00:00:00")
+    catalog.remove(["world-prod-w1-20240102-120000.zip"])
+    os.remove(os.path.join(path, "world-prod-w1-20240102-120000.zip"))
+    add_backup(path, "world-prod-w2-20240103-120000.zip", catalog)
+
+    records = BackupCatalog(path).records()
+    assert sorted(records) == ["full-prod-20240101-120000.zip", "world-prod-w2-20240103-120000.zip"]
+    assert records["full-prod-20240101-120000.zip"]["verified"] == "2024-01-03T00:00:00"
+    assert records["world-prod-w2-20240103-120000.zip"]["world"] == "w2"
+
+
+def test_reconciles_changes_made_behind_its_back(tmp_path):
+    path = str(tmp_path)
+    catalog = BackupCatalog(path)
+    add_backup(path, "full-prod-20240101-120000.zip", catalog)
+    add_backup(path, "full-prod-20240102-120000.zip")
+    os.remove(os.path.join(path, "full-prod-20240101-120000.zip"))
+    write_file(os.path.join(path, "notes.txt"), b"not a backup")
+    backups = BackupCatalog(path).backups()
+    assert [b.file for b in backups] == ["full-prod-20240102-120000.zip"]
+    assert backups[0].size == 100
+
+
+def test_skips_a_torn_last_line(tmp_path):
+    path = str(tmp_path)
+    catalog = BackupCatalog(path)
+    add_backup(path, "full-prod-20240101-120000.zip", catalog)
+    with open(catalog.path, "at") as f:
+        f.write('{"op": "add", "file": "full-prod-2024')
+    assert list(BackupCatalog(path).records()) == ["full-prod-20240101-120000.zip"]
+
+
+def test_compacts_the_log(tmp_path):
+    path = str(tmp_path)
+    catalog = BackupCatalog(path)
+    add_backup(path, "full-prod-20240101-120000.zip", catalog)
+    for i in range(300):
+        catalog.update("full-prod-20240101-120000.zip", verified=str(i))
+    with open(catalog.path, "rt") as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) < 150
+    assert BackupCatalog(path).records()["full-prod-20240101-120000.zip"]["verified"] == "299"
+
+
+def test_backups_are_recorded_with_the_checksum_of_the_engine(tmp_path, backup_manager, monkeypatch):
+    data_path = str(tmp_path / "data")
+    write_file(os.path.join(data_path, "Data", "worlds", "w1", "world.json"), b"{}")
+
+    def reread(path):
+        pytest.fail(f"{path} read again for its checksum")
+
+    monkeypatch.setattr(catalog_module, "file_checksum", reread)
+    instance = FakeInstance(data_path)
+    backup_manager.create_world_backup(instance)
+    backup_manager.create_world_backup(instance, dedup=True)
+    backups = backup_manager.get_world_backups()
+    assert len(backups) == 2
+    for backup in backups:
+        assert backup.checksum == file_checksum(backup.path)
+
+
+def test_compaction_keeps_concurrent_appends(tmp_path):
+    import threading
+    path = str(tmp_path)
+    names = [f"full-prod-20240101-12{i:02d}00.zip" for i in range(40)]
+    for name in names:
+        add_backup(path, name)
+    BackupCatalog(path).records()
+
+    def writer(start: int):
+        # Separate catalogs like separate processes, updates force compactions
+        catalog = BackupCatalog(path)
+        for name in names[start::2]:
+            for _ in range(10):
+                catalog.update(name, verified="2024-01-03T00:00:00")
+            catalog.update(name, verified=name)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    records = BackupCatalog(path).records()
+    assert all(records[name]["verified"] == name for name in names)
+
+
+def test_backup_names_hold_the_instance(tmp_path, backup_manager):
+    instances = []
+    for name in ("prod", "test"):
+        instance = FakeInstance(str(tmp_path / name))
+        instance.name = name
+        write_file(os.path.join(instance.instance_data_path, "Data", "worlds", "w1", "world.json"), b"{}")
+        instances.append(instance)
+    for instance in instances:
+        backup_manager.create_full_backup(instance)
+        backup_manager.create_world_backup(instance)
+    backups = backup_manager.get_full_backups() + backup_manager.get_world_backups()
+    assert sorted((b.type, b.instance) for b in backups) == [("full", "prod"), ("full", "test"),
+                                                             ("world", "prod"), ("world", "test")]
+    for backup in backups:
+        assert backup.name.startswith(f"{backup.type}-{backup.instance}-")
+    records = BackupCatalog(backup_manager.backup_path)
+    os.remove(records.path)
+    assert sorted(r["instance"] for r in records.records().values()) == ["prod", "prod", "test", "test"]
@@ -0,0 +1,66 @@
+from foundryvtt.daemon import BackupDaemon
+from foundryvtt.jobs import DONE, FAILED, QUEUED, RUNNING, JobQueue
+from foundryvtt.verify import VerifyResult
+
+
+class FakeBackupManager(object):
+
+    def __init__(self, results):
+        self.results = results
+
+    def verify_backups(self, window=None, workers=None):
+        return self.results
+
+
+class FakeFoundry(object):
+
+    def __init__(self, path: str, results=None):
+        self.path = path
+        self.backup_manager = FakeBackupManager(results or [])
+
+    def sync_target(self, url: str=""):
+        return None
+
+
+def run_job(daemon: BackupDaemon, kind: str):
+    job = daemon.queue.submit(kind)
+    daemon._execute(daemon.queue.start(job.id))
+    return daemon.queue.get(job.id)
+
+
+def test_verification_failures_fail_the_job_without_retry(tmp_path):
+    results = [VerifyResult("full-20240101-120000.zip"),
+               VerifyResult("full-20240102-120000.zip", False, errors=["data.db: content does not match"])]
+    daemon = BackupDaemon(FakeFoundry(str(tmp_path), results), retries=3)
+    job = run_job(daemon, "verify")
+    assert job.state == FAILED
+    assert "full-20240102-120000.zip" in job.error
+    assert job.attempts == 1
+
+
+def test_successful_verification(tmp_path):
+    daemon = BackupDaemon(FakeFoundry(str(tmp_path), [VerifyResult("full-20240101-120000.zip")]))
+    assert run_job(daemon, "verify").state == DONE
+
+
+def test_other_failures_are_retried(tmp_path):
+    daemon = BackupDaemon(FakeFoundry(str(tmp_path)), retries=2, retry_delay=0)
+    job = run_job(daemon, "sync")
+    assert job.state == QUEUED and job.error == "No sync target configured"
+    daemon._execute(daemon.queue.start(job.id))
+    job = daemon.queue.get(job.id)
+    assert job.state == FAILED and job.attempts == 2
+
+
+def test_queue_coalesces_and_recovers(tmp_path):
+    queue = JobQueue(str(tmp_path))
+    first = queue.submit("world", "prod", dedup=True)
+    assert queue.submit("world", "prod", force=True).id == first.id
+    assert queue.submit("world", "test").id != first.id
+    job = queue.get(first.id)
+    assert job.coalesced == 1 and job.params == {"dedup": True, "force": True}
+    assert queue.start(first.id).state == RUNNING
+    # Another process sees the same queue, a daemon restarting queues the running job again
+    other = JobQueue(str(tmp_path))
+    assert [j.id for j in other.recover()] == [first.id]
+    assert queue.get(first.id).state == QUEUED
@@ -0,0 +1,92 @@
+import os
+import threading
+import pytest
+from foundryvtt import dedupstore
+from foundryvtt.dedupstore import DedupStore
+from conftest import write_file
+
+
+def test_concurrent_writers_store_a_chunk_once(tmp_path):
+    store = DedupStore(str(tmp_path))
+    data = os.urandom(100000)
+    barrier = threading.Barrier(8)
+    results = []
+    errors = []
+
+    def put():
+        barrier.wait()
+        try:
+            results.append(store.put_chunk(data))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=put) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    digest = results[0][0]
+    assert all(r[0] == digest for r in results)
+    assert store.get_chunk(digest) == data
+    assert os.listdir(os.path.dirname(store.chunk_path(digest))) == [digest]
+
+
+def test_replace_failure_of_a_stored_chunk_is_success(tmp_path, monkeypatch):
+    store = DedupStore(str(tmp_path))
+    digest, _ = store.put_chunk(b"chunk")
+    os.remove(store.chunk_path(digest))
+    replace = os.replace
+
+    def racing_replace(src, dst):
+        # Another writer stores the chunk first and removes our temp file
+        replace(src, dst)
+        raise FileNotFoundError(src)
+
+    monkeypatch.setattr(dedupstore.os, "replace", racing_replace)
+    assert store.put_chunk(b"chunk") == (digest, 0)
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(dedupstore.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        store.put_chunk(b"other chunk")
+
+
+def test_chunk_errors_fail_the_backup(tmp_path, monkeypatch):
+    data_path = str(tmp_path / "data")
+    write_file(os.path.join(data_path, "a.db"), b"a" * 1000)
+    store = DedupStore(str(tmp_path / "backup"))
+
+    def failing_put(data):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "put_chunk", failing_put)
+    manifest_path = str(tmp_path / "backup" / "world-prod-20240101-120000.manifest")
+    os.makedirs(os.path.dirname(manifest_path))
+    with pytest.raises(OSError):
+        store.create(manifest_path, [(data_path, "world-prod-20240101-120000/Data")])
+    assert not os.path.exists(manifest_path)
+
+
+def test_vanished_files_are_skipped(tmp_path, monkeypatch):
+    data_path = str(tmp_path / "data")
+    write_file(os.path.join(data_path, "a.db"), b"a" * 1000)
+    write_file(os.path.join(data_path, "gone.db"), b"gone")
+    store = DedupStore(str(tmp_path / "backup"))
+    walk = dedupstore.BackupEngine.walk
+
+    def walk_and_delete(engine, src, prefix):
+        for path, arcname in walk(engine, src, prefix):
+            if path.endswith("gone.db"):
+                os.remove(path)
+            yield path, arcname
+
+    monkeypatch.setattr(dedupstore.BackupEngine, "walk", walk_and_delete)
+    manifest_path = str(tmp_path / "backup" / "full-prod-20240101-120000.manifest")
+    os.makedirs(os.path.dirname(manifest_path))
+    store.create(manifest_path, [(data_path, "full-prod-20240101-120000/Data")])
+    names = [e["name"] for e in store.load_manifest(manifest_path)["entries"]]
+    assert "full-prod-20240101-120000/Data/a.db" in names
+    assert not any(n.endswith("gone.db") for n in names)
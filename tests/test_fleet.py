@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+from foundryvtt.fleet import FleetExecutor
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+class FakeInstance(object):
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+def test_results_in_order_and_limits():
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def action(instance):
+        with lock:
+            running.append(instance.name)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(instance.name)
+        if instance.name == "bad":
+            raise RuntimeError("cannot start")
+        return instance.name.upper()
+
+    instances = [FakeInstance(name) for name in ("a", "b", "bad", "c", "d")]
+    results = FleetExecutor(jobs=4, io_jobs=2).run(instances, "backup", action, io_bound=True)
+    assert [r.name for r in results] == ["a", "b", "bad", "c", "d"]
+    assert [r.ok for r in results] == [True, True, False, True, True]
+    assert results[0].result == "A"
+    assert results[2].error == "cannot start"
+    assert max(peak) == 2
+
+
+def test_timeout_bounds_the_process_wall_time():
+    script = textwrap.dedent("""
+        import time
+        from foundryvtt.fleet import FleetExecutor
+
+        class Instance(object):
+            def __init__(self, name):
+                self.name = name
+
+        results = FleetExecutor(jobs=2, io_jobs=1, timeout=0.5).run(
+            [Instance("hung"), Instance("quick")], "backup",
+            lambda i: time.sleep(60) if i.name == "hung" else "done", io_bound=True)
+        print([(r.name, r.ok) for r in results])
+    """)
+    start = time.monotonic()
+    process = subprocess.run([sys.executable, "-c", script], env=dict(os.environ, PYTHONPATH=SRC_PATH),
+                             stdout=subprocess.PIPE, text=True, timeout=30)
+    assert time.monotonic() - start < 10
+    # The hung backup frees its io slot for the next one
+    assert process.stdout.strip() == "[('hung', False), ('quick', True)]"
@@ -0,0 +1,130 @@
+import json
+import sys
+import threading
+import types
+import pytest
+from foundryvtt import geoip as geoip_module
+from foundryvtt.geoip import GEO_FIELDS, GeoCache, GeoLocator, IpInfoProvider, is_public
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(geoip_module, "time", clock)
+    return clock
+
+
+class FakeProvider(object):
+
+    def __init__(self):
+        self.lookups = []
+        self._lock = threading.Lock()
+
+    def lookup(self, ip: str):
+        with self._lock:
+            self.lookups.append(ip)
+        return dict({field: "" for field in GEO_FIELDS}, city=f"city of {ip}")
+
+
+def test_public_addresses():
+    assert is_public("8.8.8.8") and is_public("2001:4860:4860::8888")
+    for ip in ("127.0.0.1", "::1", "10.1.2.3", "172.17.0.1", "192.168.1.10", "100.64.0.1", "169.254.1.1",
+               "0.0.0.0", "fd00::1", "fe80::1", "not an ip"):
+        assert not is_public(ip)
+
+
+def test_cache_expires_entries(tmp_path, clock):
+    cache = GeoCache(str(tmp_path / "geoip.json"), ttl=60)
+    cache.put("8.8.8.8", {"city": "Mountain View"})
+    clock.now += 59
+    assert cache.get("8.8.8.8") == {"city": "Mountain View"}
+    clock.now += 2
+    assert cache.get("8.8.8.8") is None
+    cache.save()
+    assert json.loads((tmp_path / "geoip.json").read_text()) == {}
+
+
+def test_cache_is_saved_and_evicts_least_recently_used(tmp_path, clock):
+    path = str(tmp_path / "geoip.json")
+    cache = GeoCache(path, max_entries=2)
+    cache.put("1.1.1.1", {"city": "a"})
+    cache.put("8.8.8.8", {"city": "b"})
+    cache.get("1.1.1.1")
+    cache.put("9.9.9.9", {"city": "c"})
+    cache.save()
+    loaded = GeoCache(path, max_entries=2)
+    assert loaded.get("8.8.8.8") is None
+    assert loaded.get("1.1.1.1") == {"city": "a"}
+    assert loaded.get("9.9.9.9") == {"city": "c"}
+    # Entries keep the time they were looked up, not the time they were loaded
+    clock.now += geoip_module.DEFAULT_TTL + 1
+    assert GeoCache(path).get("1.1.1.1") is None
+
+
+def test_locator_skips_private_addresses_and_uses_the_cache(tmp_path, clock):
+    provider = FakeProvider()
+    locator = GeoLocator(provider, GeoCache(str(tmp_path / "geoip.json")))
+    ips = ["8.8.8.8", "127.0.0.1", "10.0.0.2", "1.1.1.1", "fd00::1"]
+    results = locator.locate(ips)
+    assert sorted(provider.lookups) == ["1.1.1.1", "8.8.8.8"]
+    assert results["8.8.8.8"]["city"] == "city of 8.8.8.8"
+    assert results["127.0.0.1"] == {field: "" for field in GEO_FIELDS}
+    assert set(results) == set(ips)
+    locator.locate(ips)
+    assert len(provider.lookups) == 2
+    clock.now += geoip_module.DEFAULT_TTL + 1
+    locator.locate(["8.8.8.8"])
+    assert provider.lookups[-1] == "8.8.8.8" and len(provider.lookups) == 3
+
+
+def test_ipinfo_session_per_thread(monkeypatch):
+    sessions = []
+
+    class FakeResponse(object):
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"city": "Mountain View", "ip": "8.8.8.8"}
+
+    class FakeSession(object):
+
+        def __init__(self):
+            self.headers = {}
+            self.thread = threading.get_ident()
+            sessions.append(self)
+
+        def get(self, url: str, timeout: float=None):
+            assert threading.get_ident() == self.thread
+            return FakeResponse()
+
+    requests = types.ModuleType("requests")
+    requests.Session = FakeSession
+    monkeypatch.setitem(sys.modules, "requests", requests)
+    provider = IpInfoProvider(token="secret")
+    barrier = threading.Barrier(4)
+    results = []
+
+    def lookup():
+        barrier.wait()
+        results.append(provider.lookup("8.8.8.8"))
+        results.append(provider.lookup("8.8.8.8"))
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(sessions) == 4
+    assert all(s.headers["Authorization"] == "Bearer secret" for s in sessions)
+    assert all(r["city"] == "Mountain View" for r in results) and len(results) == 8
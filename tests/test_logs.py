@@ -0,0 +1,125 @@
+import datetime
+import gzip
+import os
+import pytest
+from foundryvtt import logs as logs_module
+from foundryvtt.logs import LogIndex
+from conftest import write_file
+
+
+class FakeInstance(object):
+
+    def __init__(self, path: str):
+        self.name = "prod"
+        self.path = path
+        self.logs_path = os.path.join(path, "data", "Logs")
+
+
+def at(hour: int, minute: int=0):
+    return datetime.datetime(2024, 1, 1, hour, minute).astimezone()
+
+
+def lines(start: int, count: int, level: str="info"):
+    """One line a minute from ``start`` minutes past 10:00."""
+    result = []
+    for i in range(start, start + count):
+        time = datetime.datetime(2024, 1, 1, 10) + datetime.timedelta(minutes=i)
+        result.append(f"{time:%Y-%m-%d %H:%M:%S} [{level}] message {i}\n")
+    return "".join(result).encode()
+
+
+def numbers(records):
+    return [int(r.text.rsplit(" ", 1)[1]) for r in records]
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    # Small blocks so a few lines span many of them
+    monkeypatch.setattr(logs_module, "BLOCK_SIZE", 256)
+    return LogIndex(FakeInstance(str(tmp_path)))
+
+
+def test_rotated_and_gzipped_files_are_merged(tmp_path, index):
+    logs_path = index._logs_path
+    write_file(os.path.join(logs_path, "debug.2.log.gz"), gzip.compress(lines(0, 60)))
+    write_file(os.path.join(logs_path, "debug.1.log"), lines(60, 60))
+    write_file(os.path.join(logs_path, "debug.log"), lines(120, 60) + b"2024-01-01 13:00:00 [info] partial")
+    write_file(os.path.join(logs_path, "notes.txt"), b"not a log")
+    assert sorted(index.files()) == []
+    index.update()
+    assert sorted(index.files()) == ["debug.1.log", "debug.2.log.gz", "debug.log"]
+    assert numbers(index.records()) == list(range(180))
+    assert [r.source for r in index.records(tail=1)] == ["debug.log"]
+    # The gzipped file is indexed once
+    assert index.update() == 0
+    assert LogIndex(FakeInstance(str(tmp_path))).update() == 0
+
+
+def test_time_range_reads_only_matching_blocks(index, monkeypatch):
+    logs_path = index._logs_path
+    write_file(os.path.join(logs_path, "debug.1.log.gz"), gzip.compress(lines(0, 120)))
+    write_file(os.path.join(logs_path, "debug.log"), lines(120, 120))
+    index.update()
+    read = []
+    read_range = LogIndex._read_range
+
+    def spy(self, path, name, start, end, *args, **kwargs):
+        read.append(end - start)
+        return read_range(self, path, name, start, end, *args, **kwargs)
+
+    monkeypatch.setattr(LogIndex, "_read_range", spy)
+    assert numbers(index.records(since=at(11, 30), until=at(12, 10))) == list(range(90, 131))
+    total = sum(entry["size"] for entry in index.files().values())
+    assert sum(read) < total / 2
+    read.clear()
+    assert numbers(index.records(since=at(15))) == []
+    assert numbers(index.records(until=at(9))) == []
+    assert numbers(index.records(since=at(11, 30), tail=5)) == list(range(235, 240))
+
+
+def test_levels_are_filtered_by_block(index):
+    write_file(os.path.join(index._logs_path, "debug.log"), lines(0, 50) + lines(50, 1, "error") + lines(51, 50))
+    index.update()
+    assert [r.text for r in index.records(level="warn")] == ["2024-01-01 10:50:00 [error] message 50"]
+    assert len(index._ranges(index.files()["debug.log"], None, None, logs_module.level_number("warn"))) == 1
+
+
+def test_appends_are_indexed_incrementally(index):
+    path = os.path.join(index._logs_path, "debug.log")
+    write_file(path, lines(0, 10))
+    first = index.update()
+    with open(path, "ab") as f:
+        f.write(lines(10, 5))
+    assert index.update() == len(lines(10, 5))
+    assert first == len(lines(0, 10))
+    assert numbers(index.records()) == list(range(15))
+
+
+def test_truncated_file_is_indexed_again(index):
+    path = os.path.join(index._logs_path, "debug.log")
+    write_file(path, lines(0, 60))
+    index.update()
+    with open(path, "wb") as f:
+        f.write(lines(200, 3))
+    assert index.update() == len(lines(200, 3))
+    assert numbers(index.records()) == [200, 201, 202]
+    assert index.files()["debug.log"]["size"] == len(lines(200, 3))
+
+
+def test_rotation_keeps_the_renamed_entry(index):
+    logs_path = index._logs_path
+    path = os.path.join(logs_path, "debug.log")
+    write_file(path, lines(0, 60))
+    index.update()
+    os.rename(path, os.path.join(logs_path, "debug.1.log"))
+    write_file(path, lines(60, 2))
+    # Only the new file is parsed, the renamed one keeps its entry
+    assert index.update() == len(lines(60, 2))
+    assert numbers(index.records()) == list(range(62))
+    # Compressing the rotated file replaces it with a new inode
+    with open(os.path.join(logs_path, "debug.1.log"), "rb") as f:
+        write_file(os.path.join(logs_path, "debug.1.log.gz"), gzip.compress(f.read()))
+    os.remove(os.path.join(logs_path, "debug.1.log"))
+    assert index.update() == len(lines(0, 60))
+    assert sorted(index.files()) == ["debug.1.log.gz", "debug.log"]
+    assert numbers(index.records()) == list(range(62))
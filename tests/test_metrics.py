@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+import pytest
+from foundryvtt.backupengine import BackupEngine
+from foundryvtt.metrics import CONTENT_TYPE, METRICS, MetricsSampler, MetricsServer, Sample, render_openmetrics
+from conftest import make_foundry, write_file
+
+# metric{label="value",...} value, with the label values escaped
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)\{((?:[a-zA-Z_]\w*="(?:[^"\\\n]|\\[\\"n])*"'
+                       r'(?:,[a-zA-Z_]\w*="(?:[^"\\\n]|\\[\\"n])*")*)?)\} (-?[0-9.e+-]+)$')
+
+
+def parse_openmetrics(text: str):
+    """Check the exposition format, return the values by metric and sorted labels."""
+    assert text.endswith("# EOF\n")
+    lines = text[:-len("# EOF\n")].splitlines()
+    values = {}
+    families = []
+    for line in lines:
+        if line.startswith("# "):
+            kind, name = line.split(" ")[1:3]
+            assert kind in ("TYPE", "HELP")
+            if kind == "TYPE":
+                assert line == f"# TYPE {name} gauge"
+                # Each family once, its samples right after its metadata
+                assert name not in families
+                families.append(name)
+            else:
+                assert families[-1] == name
+            continue
+        match = SAMPLE_RE.match(line)
+        assert match, line
+        assert match.group(1) == families[-1]
+        labels = tuple(sorted(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', match.group(2) or "")))
+        assert (match.group(1), labels) not in values
+        values[(match.group(1), labels)] = float(match.group(3))
+    return values
+
+
+class FakeContainer(object):
+
+    def __init__(self, status: str):
+        self.status = status
+
+    def stats(self, stream: bool=True, decode: bool=True):
+        yield {"cpu_stats": {"cpu_usage": {"total_usage": 300}, "system_cpu_usage": 2000, "online_cpus": 2},
+               "precpu_stats": {"cpu_usage": {"total_usage": 100}, "system_cpu_usage": 1000},
+               "memory_stats": {"usage": 5000, "stats": {"inactive_file": 1000}}}
+        # Keep the stream open like the Docker API
+        threading.Event().wait(60)
+
+
+@pytest.fixture
+def foundry(tmp_path, monkeypatch):
+    foundry = make_foundry(str(tmp_path), {"prod": {"port": 30000}, "test": {"port": 30001}})
+    write_file(os.path.join(foundry.get_instance("prod").world_path, "w1", "world.json"), b"{}" * 50)
+    containers = {"foundryvtt-prod": FakeContainer("running"), "foundryvtt-test": FakeContainer("exited")}
+    monkeypatch.setattr(foundry, "get_containers", lambda: containers)
+    monkeypatch.setattr(foundry, "get_connection_counts", lambda: {"prod": 2, "test": 0})
+    return foundry
+
+
+def test_render_escapes_and_groups_families():
+    sample = Sample(0)
+    sample.add("fvtt_world_bytes", {"instance": "prod", "world": 'a "quoted"\\world\nname'}, 10)
+    sample.add("fvtt_connections", {"instance": "prod"}, 2)
+    sample.add("fvtt_world_bytes", {"instance": "prod", "world": "w2"}, 20)
+    sample.add("unknown_metric", {}, 1)
+    text = render_openmetrics(sample)
+    values = parse_openmetrics(text)
+    assert values == {
+        ("fvtt_connections", (("instance", "prod"),)): 2,
+        ("fvtt_world_bytes", (("instance", "prod"), ("world", 'a \\"quoted\\"\\\\world\\nname'))): 10,
+        ("fvtt_world_bytes", (("instance", "prod"), ("world", "w2"))): 20,
+        }
+    assert text.index("fvtt_connections") < text.index("fvtt_world_bytes")
+    assert render_openmetrics(Sample()) == "# EOF\n"
+
+
+def test_collect(foundry):
+    instance = foundry.get_instance("prod")
+    os.makedirs(foundry.backup_path)
+    BackupEngine().create(os.path.join(foundry.backup_path, "world-prod-20240101-120000.zip"),
+                          [(instance.world_path, "world-prod-20240101-120000/Data/worlds")])
+    foundry.backup_manager.catalog.add("world-prod-20240101-120000.zip", "prod", 1, duration=2.0, data_size=1000)
+    sampler = MetricsSampler(foundry)
+    sampler.collect()
+    # The stats stream of the running container delivers its first values
+    deadline = time.monotonic() + 10
+    while sampler._stats.latest("foundryvtt-prod") is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    values = parse_openmetrics(render_openmetrics(sampler.collect()))
+    prod = (("instance", "prod"),)
+    assert values[("fvtt_container_up", prod)] == 1
+    assert values[("fvtt_container_up", (("instance", "test"),))] == 0
+    assert values[("fvtt_container_cpu_ratio", prod)] == 0.4
+    assert values[("fvtt_container_memory_bytes", prod)] == 4000
+    assert values[("fvtt_connections", prod)] == 2
+    assert values[("fvtt_data_bytes", prod)] == instance.tracker.size()
+    assert values[("fvtt_world_bytes", (("instance", "prod"), ("world", "w1")))] == 100
+    backup = (("instance", "prod"), ("type", "world"))
+    assert values[("fvtt_backup_duration_seconds", backup)] == 2.0
+    assert values[("fvtt_backup_throughput_bytes_per_second", backup)] == 500
+    assert values[("fvtt_backup_age_seconds", backup)] > 0
+    assert set(name for name, _ in values) == set(METRICS)
+
+
+def test_ring_buffer_keeps_the_newest_samples(foundry, monkeypatch):
+    sampler = MetricsSampler(foundry, interval=0, history=3)
+    collected = []
+
+    def collect():
+        collected.append(Sample(len(collected)))
+        if len(collected) == 7:
+            sampler._stop.set()
+        return collected[-1]
+
+    monkeypatch.setattr(sampler, "collect", collect)
+    sampler.start()
+    sampler._thread.join(10)
+    assert [s.timestamp for s in sampler.samples] == [4, 5, 6]
+    assert sampler.latest is collected[-1]
+
+
+def test_server_endpoints(foundry, monkeypatch):
+    sampler = MetricsSampler(foundry, interval=3600, history=2)
+    samples = [Sample(1), Sample(2), Sample(3)]
+    samples[-1].add("fvtt_connections", {"instance": "prod"}, 2)
+    for sample in samples:
+        sampler._samples.append(sample)
+    monkeypatch.setattr(sampler, "start", lambda: None)
+    server = MetricsServer(sampler, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = "http://%s:%d" % server.address
+        with urllib.request.urlopen(f"{url}/metrics") as res:
+            assert res.headers["Content-Type"] == CONTENT_TYPE
+            assert parse_openmetrics(res.read().decode()) == {("fvtt_connections", (("instance", "prod"),)): 2}
+        with urllib.request.urlopen(f"{url}/history") as res:
+            history = json.loads(res.read())
+        assert [s["timestamp"] for s in history] == [2, 3]
+        assert history[-1]["values"] == {"fvtt_connections": [[{"instance": "prod"}, 2]]}
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.shutdown()
+        thread.join(10)
@@ -0,0 +1,77 @@
+import json
+import os
+import pytest
+from foundryvtt import foundry as foundry_module
+from foundryvtt.sockets import Connection
+from conftest import make_foundry
+
+
+class FakeContainer(object):
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+
+class FakeContainers(object):
+
+    def __init__(self, containers):
+        self._containers = containers
+        self.listed = 0
+
+    def list(self, all: bool=False, filters: dict=None):
+        self.listed += 1
+        return self._containers
+
+
+class FakeClient(object):
+
+    def __init__(self, containers):
+        self.containers = FakeContainers(containers)
+
+
+@pytest.fixture
+def foundry(tmp_path):
+    # Created before ports were saved, one stopped and one running container
+    foundry = make_foundry(str(tmp_path), {"prod": {}, "test": {}, "gone": {}, "new": {"port": 30005}})
+    foundry._docker_client = FakeClient([
+        FakeContainer("foundryvtt-prod", {"HostConfig": {"PortBindings": {"30000/tcp": [{"HostPort": "30000"}]}}}),
+        FakeContainer("foundryvtt-test", {"Ports": [{"PrivatePort": 30000, "PublicPort": 30002, "Type": "tcp"}]}),
+        ])
+    return foundry
+
+
+def test_ports_of_older_instances_come_from_their_containers(foundry):
+    assert foundry.get_instance_ports() == {30000: "prod", 30002: "test", 30005: "new"}
+    assert foundry.get_instance("test").port == 30002
+    with open(os.path.join(foundry.instances_path, "test", "settings.db"), "rt") as f:
+        assert json.load(f)["port"] == 30002
+    # Migrated settings do not need the containers any more
+    foundry.get_instance_ports()
+    assert foundry.docker_client.containers.listed == 1
+    assert foundry.registry.ports() == {30000, 30002, 30005}
+
+
+def test_connections_are_counted_per_instance(foundry, monkeypatch):
+    connections = [Connection("10.0.0.1", port, "1.2.3.4", 5000 + i) for i, port in enumerate([30000, 30002, 30002])]
+    monkeypatch.setattr(foundry_module, "established_connections",
+                        lambda ports: [c for c in connections if c.local_port in ports])
+    assert foundry.get_connection_counts() == {"gone": 0, "new": 0, "prod": 1, "test": 2}
+
+
+def test_connections_skip_local_peers(foundry, monkeypatch):
+    connections = [Connection("10.0.0.1", 443, "127.0.0.1", 5000), Connection("10.0.0.1", 30002, "172.17.0.1", 5001),
+                   Connection("10.0.0.1", 30000, "::1", 5002), Connection("10.0.0.1", 30000, "8.8.8.8", 5003)]
+    monkeypatch.setattr(foundry_module, "established_connections",
+                        lambda ports: [c for c in connections if c.local_port in ports])
+    located = []
+
+    class FakeLocator(object):
+
+        def locate(self, ips):
+            located.extend(ips)
+            return {ip: {"city": "Mountain View"} for ip in ips}
+
+    foundry._geolocator = FakeLocator()
+    assert foundry.get_connections() == [{"city": "Mountain View", "ip": "8.8.8.8", "instance": "prod", "port": 30000}]
+    assert located == ["8.8.8.8"]
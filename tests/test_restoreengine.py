@@ -0,0 +1,115 @@
+import os
+import pytest
+from foundryvtt.backupengine import BackupEngine
+from foundryvtt.restoreengine import RestoreEngine
+from conftest import write_file
+
+
+class FakeInstance(object):
+
+    def __init__(self, path: str):
+        self.name = "prod"
+        self.instance_data_path = path
+
+
+def read(path: str):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def world_backup(tmp_path, backup_manager):
+    data_path = str(tmp_path / "data")
+    write_file(os.path.join(data_path, "Data", "worlds", "w1", "world.json"), b"{}")
+    write_file(os.path.join(data_path, "Data", "worlds", "w1", "data", "actors.db"), b"actors" * 1000)
+    write_file(os.path.join(data_path, "Data", "assets", "map.webp"), os.urandom(10000))
+    name = "world-prod-20240101-120000"
+    sources = [(os.path.join(data_path, "Data", "worlds"), f"{name}/Data/worlds"),
+               (os.path.join(data_path, "Data", "assets"), f"{name}/Data/assets")]
+    BackupEngine().create(os.path.join(backup_manager.backup_path, f"{name}.zip"), sources)
+    backup_manager.catalog.add(f"{name}.zip", "prod", 3)
+    return FakeInstance(data_path), backup_manager.get_backup(name)
+
+
+def test_world_restore_keeps_new_assets(world_backup, backup_manager):
+    instance, backup = world_backup
+    data_path = instance.instance_data_path
+    actors = os.path.join(data_path, "Data", "worlds", "w1", "data", "actors.db")
+    original = read(actors)
+    write_file(actors, b"changed")
+    write_file(os.path.join(data_path, "Data", "worlds", "w1", "data", "new.db"), b"new")
+    new_asset = os.path.join(data_path, "Data", "assets", "uploaded.webp")
+    write_file(new_asset, b"uploaded after the backup")
+
+    stats = backup_manager.restore_world_backup(backup, instance)
+    assert read(actors) == original
+    assert not os.path.exists(os.path.join(data_path, "Data", "worlds", "w1", "data", "new.db"))
+    assert read(new_asset) == b"uploaded after the backup"
+    assert stats.written == 1 and stats.kept == 2
+
+
+def test_world_restore_replace_assets(world_backup, backup_manager):
+    instance, backup = world_backup
+    new_asset = os.path.join(instance.instance_data_path, "Data", "assets", "uploaded.webp")
+    write_file(new_asset, b"uploaded after the backup")
+    backup_manager.restore_world_backup(backup, instance, replace_assets=True)
+    assert not os.path.exists(new_asset)
+    assert os.path.exists(os.path.join(instance.instance_data_path, "Data", "assets", "map.webp"))
+
+
+def test_restore_pattern_and_closed_archive(world_backup, backup_manager):
+    instance, backup = world_backup
+    actors = os.path.join(instance.instance_data_path, "Data", "worlds", "w1", "data", "actors.db")
+    world = os.path.join(instance.instance_data_path, "Data", "worlds", "w1", "world.json")
+    write_file(actors, b"changed")
+    write_file(world, b"changed")
+    engine = RestoreEngine()
+    with engine.open(backup.path) as entries:
+        stats = engine.restore_files(entries, instance.instance_data_path, "Data/worlds/*/data/*.db")
+        zf = entries[0]._zf
+    assert zf.fp is None
+    assert stats.written == 1
+    assert read(world) == b"changed"
+    assert read(actors) == b"actors" * 1000
+
+
+def test_restore_from_manifest(tmp_path, backup_manager):
+    data_path = str(tmp_path / "data")
+    write_file(os.path.join(data_path, "Config", "options.json"), b'{"port": 30000}')
+    write_file(os.path.join(data_path, "Data", "assets", "big.bin"), os.urandom(5 * 1024 * 1024))
+    manifest = os.path.join(backup_manager.backup_path, "full-prod-20240101-120000.manifest")
+    backup_manager.dedup_store.create(manifest, [(data_path, "full-prod-20240101-120000")])
+    restored = str(tmp_path / "restored")
+    engine = RestoreEngine()
+    with engine.open(manifest) as entries:
+        engine.restore(entries, restored, [""])
+    for name in ("Config/options.json", "Data/assets/big.bin"):
+        assert read(os.path.join(restored, name)) == read(os.path.join(data_path, name))
+
+
+def test_missing_root_keeps_the_live_tree(world_backup):
+    instance, backup = world_backup
+    beta = os.path.join(instance.instance_data_path, "Data", "worlds", "beta")
+    write_file(os.path.join(beta, "world.json"), b"beta")
+    engine = RestoreEngine()
+    with engine.open(backup.path) as entries:
+        assert engine.contains(entries, "Data/worlds/w1") and engine.contains(entries, "")
+        assert not engine.contains(entries, "Data/worlds/beta")
+        with pytest.raises(ValueError):
+            engine.restore(entries, instance.instance_data_path, ["Data/worlds/w1", "Data/worlds/beta"])
+        with pytest.raises(ValueError):
+            engine._restore_root(entries, instance.instance_data_path, "Data/worlds/beta", None)
+    assert read(os.path.join(beta, "world.json")) == b"beta"
+    assert sorted(os.listdir(os.path.dirname(beta))) == ["beta", "w1"]
+
+
+def test_world_restore_of_another_world_is_refused(world_backup, backup_manager):
+    instance, backup = world_backup
+    beta = os.path.join(instance.instance_data_path, "Data", "worlds", "beta")
+    write_file(os.path.join(beta, "world.json"), b"beta")
+    write_file(os.path.join(beta, "data", "actors.db"), b"actors")
+    assert backup_manager.restore_world_backup(backup, instance, world="beta") is None
+    assert backup_manager.restore_world_backup(backup, instance, world="nosuch") is None
+    assert sorted(os.listdir(beta)) == ["data", "world.json"]
+    assert not os.path.exists(os.path.join(os.path.dirname(beta), "nosuch"))
+    assert backup_manager.restore_world_backup(backup, instance, world="w1")
@@ -0,0 +1,67 @@
+import datetime
+import os
+from foundryvtt.backup import Backup
+from foundryvtt.retention import RetentionPolicy, plan_retention
+from conftest import write_file
+
+NOW = datetime.datetime(2024, 6, 15, 12, 0, 0)
+
+
+def backup(date: datetime.datetime, type: str="full", instance: str="prod", world: str=""):
+    name = "-".join(filter(None, [type, instance, world, date.strftime("%Y%m%d-%H%M%S")]))
+    return Backup("/backup", f"{name}.zip", date, type, instance, 100, 1, "", world)
+
+
+def test_gfs_keeps_one_backup_per_period():
+    backups = [backup(NOW - datetime.timedelta(hours=h)) for h in range(0, 24 * 60, 6)]
+    plan = plan_retention(backups, RetentionPolicy(hourly=0, daily=7, weekly=4, monthly=0), NOW)
+    assert len(plan.keep) + len(plan.delete) == len(backups)
+    kept = sorted((b.date for b in plan.keep), reverse=True)
+    assert kept[0] == NOW
+    # The last backup of each of the last 7 days, at 18:00 before today
+    assert kept[1:7] == [datetime.datetime(2024, 6, d, 18) for d in range(14, 8, -1)]
+    # Then the last backup of each of the last 4 weeks, on sundays
+    assert kept[7:] == [datetime.datetime(2024, 6, 2, 18), datetime.datetime(2024, 5, 26, 18)]
+
+
+def test_gfs_keeps_the_newest_backup_of_each_series():
+    old = NOW - datetime.timedelta(days=400)
+    backups = [backup(old, "world", "prod", "w1"), backup(old, "world", "prod", "w2"),
+               backup(old - datetime.timedelta(days=1), "world", "prod", "w1"), backup(NOW, "full")]
+    plan = plan_retention(backups, RetentionPolicy(1, 1, 1, 1), NOW)
+    assert {b.file for b in plan.keep} == {backups[0].file, backups[1].file, backups[3].file}
+    assert plan.delete == [backups[2]]
+
+
+def test_gfs_monthly_rule():
+    backups = [backup(datetime.datetime(2024, month, day)) for month in range(1, 7) for day in (1, 15)]
+    plan = plan_retention(backups, RetentionPolicy(0, 0, 0, 3), datetime.datetime(2024, 6, 20))
+    assert sorted(b.date for b in plan.keep) == [datetime.datetime(2024, 4, 15), datetime.datetime(2024, 5, 15),
+                                                 datetime.datetime(2024, 6, 15)]
+
+
+def make_backups(backup_manager, files):
+    for file in files:
+        write_file(os.path.join(backup_manager.backup_path, file), b"backup")
+        backup_manager.catalog.add(file, Backup.Parse(file)[2], 1, checksum="")
+
+
+def test_cleanup_keeps_the_only_backup_of_a_stable_world(backup_manager):
+    now = datetime.datetime.now()
+    old = (now - datetime.timedelta(days=90)).strftime("%Y%m%d-%H%M%S")
+    older = (now - datetime.timedelta(days=100)).strftime("%Y%m%d-%H%M%S")
+    recent = (now - datetime.timedelta(days=1)).strftime("%Y%m%d-%H%M%S")
+    make_backups(backup_manager, [f"world-prod-stable-{old}.zip", f"world-prod-busy-{older}.zip",
+                                  f"world-prod-busy-{recent}.zip", f"assets-prod-{old}.zip"])
+    backup_manager.cleanup_world(datetime.timedelta(30))
+    assert sorted(b.file for b in backup_manager.get_world_backups()) == sorted(
+        [f"world-prod-stable-{old}.zip", f"world-prod-busy-{recent}.zip", f"assets-prod-{old}.zip"])
+
+
+def test_cleanup_by_count_is_per_series(backup_manager):
+    make_backups(backup_manager, [f"world-prod-w1-2024010{d}-120000.zip" for d in range(1, 5)] +
+                 ["world-prod-w2-20230101-120000.zip"])
+    backup_manager.cleanup_world(old_count=2)
+    assert sorted(b.file for b in backup_manager.get_world_backups()) == [
+        "world-prod-w1-20240103-120000.zip", "world-prod-w1-20240104-120000.zip",
+        "world-prod-w2-20230101-120000.zip"]
@@ -0,0 +1,58 @@
+import os
+import pytest
+from foundryvtt import snapshot as snapshot_module
+from foundryvtt.snapshot import Snapshot
+from conftest import write_file
+
+
+class FakeInstance(object):
+
+    def __init__(self, path: str):
+        self.name = "prod"
+        self.path = path
+        self.instance_data_path = os.path.join(path, "data")
+        self.paused = 0
+
+    def running_service(self):
+        return None
+
+
+def test_pause_links_everything_but_leveldb_journals(tmp_path):
+    instance = FakeInstance(str(tmp_path))
+    db_path = os.path.join(instance.instance_data_path, "Data", "worlds", "w", "data", "actors")
+    for name in ("000005.ldb", "000007.log", "CURRENT", "MANIFEST-000004", "LOCK"):
+        write_file(os.path.join(db_path, name), name.encode())
+    asset = os.path.join(instance.instance_data_path, "Data", "assets", "token.webp")
+    write_file(asset, b"image")
+
+    with Snapshot(instance, ["Data"], "pause") as snapshot:
+        def same(path):
+            return os.stat(path).st_ino == os.stat(snapshot.translate(path)).st_ino
+
+        assert same(asset)
+        assert same(os.path.join(db_path, "000005.ldb"))
+        assert same(os.path.join(db_path, "LOCK"))
+        for name in ("000007.log", "CURRENT", "MANIFEST-000004"):
+            assert not same(os.path.join(db_path, name))
+        assert snapshot.linked == 3
+        assert snapshot.copied == len("000007.log") + len("CURRENT") + len("MANIFEST-000004")
+    assert not os.path.exists(snapshot.path)
+
+
+def test_pause_is_skipped_when_links_fail(tmp_path, monkeypatch):
+    instance = FakeInstance(str(tmp_path))
+    write_file(os.path.join(instance.instance_data_path, "Data", "assets", "token.webp"), b"image")
+    paused = []
+    instance.running_service = lambda: paused.append(True)
+
+    def cross_device_link(src, dst):
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(snapshot_module.os, "link", cross_device_link)
+    with pytest.raises(OSError):
+        Snapshot(instance, ["Data"], "pause").take()
+    monkeypatch.setattr(Snapshot, "_supports_reflink", lambda self: False)
+    with pytest.raises(RuntimeError):
+        Snapshot(instance, ["Data"]).take()
+    assert not paused
+    assert sorted(os.listdir(str(tmp_path))) == [".snapshot.lock", "data"]
@@ -0,0 +1,51 @@
+import os
+import socket
+import pytest
+from foundryvtt.sockets import PROC_TCP, read_proc_connections, read_proc_listening_ports
+
+HEADER = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+TCP = [
+    # 0.0.0.0:30000 listening, 127.0.0.1:30001 listening
+    "   0: 00000000:7530 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 1 1\n",
+    "   1: 0100007F:7531 00000000:0000 0A 00000000:00000000 00:00000000 00000000  1000        0 2 1\n",
+    # 10.0.0.2:30000 <- 192.168.1.10:51000 established
+    "   2: 0200000A:7530 0A01A8C0:C738 01 00000000:00000000 00:00000000 00000000  1000        0 3 1\n",
+    ]
+TCP6 = [
+    # [::]:30002 listening
+    "   0: 00000000000000000000000000000000:7532 00000000000000000000000000000000:0000 0A "
+    "00000000:00000000 00:00000000 00000000  1000        0 4 1\n",
+    # ::ffff:10.0.0.2:30001 <- ::ffff:192.168.1.11:51001 established
+    "   1: 0000000000000000FFFF00000200000A:7531 0000000000000000FFFF00000B01A8C0:C739 01 "
+    "00000000:00000000 00:00000000 00000000  1000        0 5 1\n",
+    ]
+
+
+@pytest.fixture
+def proc_paths(tmp_path):
+    paths = []
+    for name, lines in (("tcp", TCP), ("tcp6", TCP6)):
+        path = str(tmp_path / name)
+        with open(path, "wt") as f:
+            f.write(HEADER + "".join(lines))
+        paths.append(path)
+    return paths
+
+
+def test_listening_ports(proc_paths):
+    assert read_proc_listening_ports(proc_paths) == {30000, 30001, 30002}
+
+
+def test_established_connections(proc_paths):
+    connections = read_proc_connections({30000, 30001}, proc_paths)
+    assert [str(c) for c in connections] == ["192.168.1.10:51000 -> 10.0.0.2:30000",
+                                             "192.168.1.11:51001 -> 10.0.0.2:30001"]
+    assert read_proc_connections({30002}, proc_paths) == []
+
+
+@pytest.mark.skipif(not os.path.exists(PROC_TCP[0]), reason="needs /proc/net/tcp")
+def test_reads_the_live_socket_table():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        s.listen()
+        assert s.getsockname()[1] in read_proc_listening_ports()
@@ -0,0 +1,113 @@
+import io
+import os
+import sys
+import types
+import pytest
+from foundryvtt.sync import BackupSync, LocalTarget, ThrottledReader
+from foundryvtt.throttle import Throttle
+from conftest import write_file
+
+THRESHOLD = 4 * 1024 * 1024
+
+
+class RecordingThrottle(Throttle):
+
+    def __init__(self):
+        super().__init__()
+        self.consumed = 0
+
+    def consume(self, size: int):
+        self.consumed += size
+
+
+class FakeS3Client(object):
+    """Keep the uploaded bytes, reading the body the way s3transfer does."""
+
+    def __init__(self, *args, **kwargs):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key, Config=None, Callback=None):
+        with open(path, "rb") as f:
+            self.upload_fileobj(f, bucket, key, Config, Callback)
+
+    def upload_fileobj(self, f, bucket, key, Config=None, Callback=None):
+        # A non-seekable stream is read up to the threshold to pick single or multipart
+        body = f.read(THRESHOLD)
+        if len(body) < THRESHOLD:
+            body += f.read()
+        else:
+            while True:
+                part = f.read(THRESHOLD)
+                if not part:
+                    break
+                body += part
+        if Callback:
+            Callback(len(body))
+        self.objects[(bucket, key)] = body
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+@pytest.fixture
+def fake_boto3(monkeypatch):
+    boto3 = types.ModuleType("boto3")
+    boto3.client = FakeS3Client
+    transfer = types.ModuleType("boto3.s3.transfer")
+    transfer.TransferConfig = lambda **kwargs: kwargs
+    monkeypatch.setitem(sys.modules, "boto3", boto3)
+    monkeypatch.setitem(sys.modules, "boto3.s3", types.ModuleType("boto3.s3"))
+    monkeypatch.setitem(sys.modules, "boto3.s3.transfer", transfer)
+    return boto3
+
+
+def test_throttled_reader_reads_full_sizes():
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    throttle = RecordingThrottle()
+    reader = ThrottledReader(io.BytesIO(data), len(data), throttle)
+    assert reader.read(2 * 1024 * 1024 + 1) == data[:2 * 1024 * 1024 + 1]
+    assert reader.read() == data[2 * 1024 * 1024 + 1:]
+    assert reader.read() == b""
+    assert throttle.consumed == len(data)
+
+
+def test_throttled_reader_as_fileobj_upload():
+    data = os.urandom(THRESHOLD + 3 * 1024 * 1024)
+    client = FakeS3Client()
+    client.upload_fileobj(ThrottledReader(io.BytesIO(data), len(data)), "bucket", "key")
+    assert client.objects[("bucket", "key")] == data
+
+
+def test_s3_put_larger_than_threshold(tmp_path, fake_boto3):
+    from foundryvtt.sync import create_target
+    data = os.urandom(THRESHOLD + 1024 * 1024 + 5)
+    path = str(tmp_path / "full-20240101-120000.zip")
+    write_file(path, data)
+    target = create_target("s3://bucket/prefix")
+    throttle = RecordingThrottle()
+    target.put("full-20240101-120000.zip", path, throttle)
+    assert len(target._client.objects[("bucket", "prefix/full-20240101-120000.zip")]) == len(data)
+    assert throttle.consumed == len(data)
+
+
+def test_sync_is_incremental_and_mirrors_deletes(tmp_path, backup_manager):
+    for name in ("full-prod-20240101-120000.zip", "full-prod-20240102-120000.zip"):
+        write_file(os.path.join(backup_manager.backup_path, name), os.urandom(2 * 1024 * 1024 + 3))
+        backup_manager.catalog.add(name, "prod", 1, checksum="")
+    remote = str(tmp_path / "remote")
+    target = LocalTarget(remote)
+    stats = BackupSync(backup_manager, target).run()
+    assert stats.uploaded == 2 and not stats.errors
+    for name in os.listdir(backup_manager.backup_path):
+        if name.endswith(".zip"):
+            with open(os.path.join(remote, name), "rb") as f, \
+                    open(os.path.join(backup_manager.backup_path, name), "rb") as g:
+                assert f.read() == g.read()
+
+    stats = BackupSync(backup_manager, target).run()
+    assert stats.uploaded == 0
+
+    backup_manager.delete_backups([b for b in backup_manager.catalog.backups() if b.date.day == 1])
+    stats = BackupSync(backup_manager, target).run()
+    assert stats.deleted == 1
+    assert sorted(os.listdir(remote)) == ["full-prod-20240102-120000.zip"]
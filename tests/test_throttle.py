@@ -0,0 +1,67 @@
+import pytest
+from foundryvtt import throttle as throttle_module
+from foundryvtt.throttle import Throttle
+
+
+class FakeClock(object):
+    """Stands for the ``time`` module, sleeping only moves the clock."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay: float):
+        self.slept += delay
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle_module, "time", clock)
+    return clock
+
+
+def test_unlimited_never_sleeps(clock):
+    throttle = Throttle()
+    for _ in range(100):
+        throttle.consume(1024 * 1024)
+    assert clock.slept == 0
+
+
+def test_rate_is_kept_after_the_first_burst(clock):
+    throttle = Throttle(1000)
+    for _ in range(50):
+        throttle.consume(100)
+    # 5000 bytes at 1000 per second, the bucket starts empty
+    assert clock.slept == pytest.approx(5.0)
+    # An idle second refills at most one second worth of data
+    clock.now += 10
+    for _ in range(20):
+        throttle.consume(100)
+    assert clock.slept == pytest.approx(6.0)
+
+
+def test_busy_rate_while_players_are_connected(clock):
+    sessions = [True]
+    throttle = Throttle(1000, 100, lambda: sessions[-1], check_interval=5)
+    assert throttle.rate == 100
+    sessions.append(False)
+    # Checked again only once the interval passed
+    assert throttle.rate == 100
+    clock.now += 6
+    assert throttle.rate == 1000
+    # Without a rate, the busy rate still applies while busy
+    assert Throttle(0, 100, lambda: True).rate == 100
+    assert Throttle(50, 100, lambda: True).rate == 50
+
+
+def test_failing_busy_check_is_not_busy(clock, capsys):
+    def busy():
+        raise RuntimeError("docker is down")
+
+    assert Throttle(1000, 100, busy).rate == 1000
+    assert "docker is down" in capsys.readouterr().out
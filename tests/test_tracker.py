@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+from foundryvtt.tracker import DataTracker
+from conftest import make_foundry, write_file
+
+
+def test_update_lists_only_changed_dirs(tmp_path):
+    foundry = make_foundry(str(tmp_path), {"prod": {}})
+    instance = foundry.get_instance("prod")
+    for world in ("w1", "w2"):
+        write_file(os.path.join(instance.world_path, world, "data", "actors.db"), b"actors")
+    write_file(os.path.join(instance.instance_data_path, "Data", "assets", "a.webp"), b"image")
+    tracker = DataTracker(instance)
+    tracker.update()
+    since = time.time_ns()
+    time.sleep(0.01)
+    assert tracker.update() == 0
+    write_file(os.path.join(instance.world_path, "w2", "data", "actors.db"), b"actors changed")
+    tracker.update()
+    assert tracker.changed_worlds(tracker.last_change("Data/worlds/w1")) == ["w2"]
+    assert DataTracker(instance).children("Data/worlds") == ["w1", "w2"]
+
+
+def test_watch_every_instance(tmp_path):
+    foundry = make_foundry(str(tmp_path), {"prod": {}, "test": {}})
+    instances = foundry.get_instances()
+    for instance in instances:
+        write_file(os.path.join(instance.world_path, "w1", "world.json"), b"{}")
+    stop = threading.Event()
+    watcher = threading.Thread(target=foundry.watch_data, args=(None, 0.1, stop))
+    watcher.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not all(os.path.exists(i.tracker.index_path) for i in instances) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        watcher.join(10)
+    assert not watcher.is_alive()
+    assert all(os.path.exists(i.tracker.index_path) for i in instances)
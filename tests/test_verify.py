@@ -0,0 +1,107 @@
+import datetime
+import os
+import zipfile
+import pytest
+from foundryvtt.backupengine import BackupEngine, INTEGRITY_FILE
+from conftest import write_file
+
+
+class FakeInstance(object):
+
+    def __init__(self, path: str):
+        self.name = "prod"
+        self.instance_data_path = path
+
+
+@pytest.fixture
+def backup(tmp_path, backup_manager):
+    data_path = str(tmp_path / "data")
+    write_file(os.path.join(data_path, "Data", "worlds", "w1", "data", "actors.db"), b"actors" * 1000)
+    write_file(os.path.join(data_path, "Config", "options.json"), b'{"port": 30000}')
+    backup_manager.create_full_backup(FakeInstance(data_path), engine=BackupEngine("store"))
+    return backup_manager.get_full_backups()[0]
+
+
+def rewrite_member(path: str, name: str, data: bytes):
+    """Replace a member with a valid one, CRC included, keeping the integrity manifest."""
+    tmp_path = f"{path}.tmp"
+    with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp_path, "w") as dest:
+        for zinfo in src.infolist():
+            dest.writestr(zinfo, data if zinfo.filename == name else src.read(zinfo))
+    os.replace(tmp_path, path)
+
+
+def test_intact_backup(backup, backup_manager):
+    result, = backup_manager.verify_backups([backup], workers=1)
+    assert result.ok and result.hashed
+    assert result.files == 2
+
+
+def test_content_not_matching_the_manifest(backup, backup_manager):
+    name = f"{backup.name}/Data/worlds/w1/data/actors.db"
+    rewrite_member(backup.path, name, b"tampered" * 750)
+    result, = backup_manager.verify_backups([backup], workers=1)
+    assert not result.ok
+    assert result.errors == [f"{name}: content does not match"]
+
+
+def test_corrupted_member_fails_its_crc(backup, backup_manager):
+    with open(backup.path, "r+b") as f:
+        data = f.read()
+        offset = data.index(b"actors" * 10) + 100
+        f.seek(offset)
+        f.write(b"X")
+    result, = backup_manager.verify_backups([backup], workers=1)
+    assert not result.ok
+    assert result.errors[0].startswith(f"{backup.name}/Data/worlds/w1/data/actors.db: ")
+
+
+def test_archive_without_manifest_is_crc_only(backup, backup_manager):
+    tmp_path = f"{backup.path}.tmp"
+    with zipfile.ZipFile(backup.path) as src, zipfile.ZipFile(tmp_path, "w") as dest:
+        for zinfo in src.infolist():
+            if zinfo.filename != INTEGRITY_FILE:
+                dest.writestr(zinfo, src.read(zinfo))
+    os.replace(tmp_path, backup.path)
+    result, = backup_manager.verify_backups([backup], workers=1)
+    assert result.ok and not result.hashed
+
+
+def test_recheck_window_and_catalog_time(backup, backup_manager):
+    window = datetime.timedelta(days=7)
+    before = datetime.datetime.now()
+    assert len(backup_manager.verify_backups([backup], window, workers=1)) == 1
+    record = backup_manager.catalog.records()[backup.file]
+    assert record["verified_ok"] and record["verify_errors"] == []
+    assert datetime.datetime.fromisoformat(record["verified"]) >= before
+    # Verified within the window, skipped
+    assert backup_manager.verify_backups([backup], window, workers=1) == []
+    # Outside of it, or without a window, verified again and the time updated
+    backup_manager.catalog.update(backup.file, verified=(before - datetime.timedelta(days=8)).isoformat())
+    assert len(backup_manager.verify_backups([backup], window, workers=1)) == 1
+    assert backup_manager.catalog.records()[backup.file]["verified"] > before.isoformat()
+    assert len(backup_manager.verify_backups([backup], workers=1)) == 1
+
+
+def test_failed_backups_are_checked_again(backup, backup_manager):
+    window = datetime.timedelta(days=7)
+    rewrite_member(backup.path, f"{backup.name}/Config/options.json", b"{}")
+    result, = backup_manager.verify_backups([backup], window, workers=1)
+    assert not result.ok
+    assert not backup_manager.catalog.records()[backup.file]["verified_ok"]
+    assert len(backup_manager.verify_backups([backup], window, workers=1)) == 1
+
+
+def test_dedup_backup_with_a_corrupted_chunk(tmp_path, backup_manager):
+    data_path = str(tmp_path / "data")
+    write_file(os.path.join(data_path, "Data", "worlds", "w1", "data", "actors.db"), b"actors" * 1000)
+    backup_manager.create_full_backup(FakeInstance(data_path), dedup=True)
+    backup = backup_manager.get_full_backups()[0]
+    assert backup_manager.verify_backups([backup], workers=1)[0].ok
+    entry = [e for e in backup_manager.dedup_store.load_manifest(backup.path)["entries"] if "chunks" in e][0]
+    digest = entry["chunks"][0]
+    with open(backup_manager.dedup_store.chunk_path(digest), "wb") as f:
+        f.write(b"R" + b"other data")
+    result, = backup_manager.verify_backups([backup], workers=1)
+    assert not result.ok
+    assert result.errors == [f"{entry['name']}: chunk {digest} is corrupted"]
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import zipfile
+import zlib
+import pytest
+from foundryvtt import zipcompat
+from foundryvtt.backupengine import CODECS
+
+DATA = b"".join(f"record {i} of a world database\n".encode() for i in range(20000))
+
+
+def compressed(compress_type: int, level: int=None):
+    compressor = zipcompat.get_compressor(compress_type, level)
+    if compressor is None:
+        return DATA
+    return compressor.compress(DATA) + compressor.flush()
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_write_compressed_round_trip(tmp_path, codec):
+    path = str(tmp_path / "archive.zip")
+    with zipfile.ZipFile(path, "w", allowZip64=True) as zf:
+        zinfo = zipfile.ZipInfo("backup/data.db", (2024, 1, 1, 12, 0, 0))
+        zinfo.compress_type = CODECS[codec]
+        zinfo.CRC = zlib.crc32(DATA)
+        zinfo.file_size = len(DATA)
+        data = compressed(CODECS[codec])
+        zinfo.compress_size = len(data)
+        zipcompat.write_compressed(zf, zinfo, data)
+        zf.writestr("backup/after.txt", b"after")
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert zf.read("backup/data.db") == DATA
+        assert zf.read("backup/after.txt") == b"after"
+        assert zf.getinfo("backup/data.db").compress_type == CODECS[codec]
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_compress_level(tmp_path, codec):
+    path = str(tmp_path / "archive.zip")
+    with zipfile.ZipFile(path, "w", CODECS[codec]) as zf:
+        zinfo = zipfile.ZipInfo("data.db", (2024, 1, 1, 12, 0, 0))
+        zinfo.compress_type = CODECS[codec]
+        zipcompat.set_compress_level(zinfo, 1 if codec in ("deflate", "bzip2") else None)
+        with zf.open(zinfo, "w") as f:
+            f.write(DATA)
+    with zipfile.ZipFile(path) as zf:
+        assert zf.read("data.db") == DATA
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_resume_after_offset(tmp_path, codec):
+    path = str(tmp_path / "archive.zip")
+    zf = zipfile.ZipFile(path, "w", CODECS[codec])
+    zf.writestr("first.db", DATA)
+    offset = zipcompat.end_offset(zf)
+    entries = list(zf.filelist)
+    # A member the checkpoint does not know about, and a stale central directory
+    zf.writestr("partial.db", DATA)
+    zf.close()
+    assert os.path.getsize(path) > offset
+
+    zf, writer = zipcompat.resume(path, offset, entries, CODECS[codec])
+    with zf:
+        zf.writestr("second.db", DATA[:1000])
+    with zipfile.ZipFile(path) as zf:
+        assert zf.namelist() == ["first.db", "second.db"]
+        assert zf.testzip() is None
+        assert zf.read("first.db") == DATA
+    assert writer.hexdigest() == file_digest(path)
+
+
+def file_digest(path: str):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_create_hashes_the_archive(tmp_path, codec):
+    path = str(tmp_path / "archive.zip")
+    zf, writer = zipcompat.create(path, CODECS[codec])
+    with zf:
+        zf.writestr("dir/", b"")
+        zf.writestr("data.db", DATA)
+        with zf.open("streamed.db", "w") as f:
+            f.write(DATA)
+        zinfo = zipfile.ZipInfo("precompressed.db", (2024, 1, 1, 12, 0, 0))
+        zinfo.compress_type = CODECS[codec]
+        zinfo.CRC = zlib.crc32(DATA)
+        zinfo.file_size = len(DATA)
+        data = compressed(CODECS[codec])
+        zinfo.compress_size = len(data)
+        zipcompat.write_compressed(zf, zinfo, data)
+    assert writer.hexdigest() == file_digest(path)
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert [zf.read(name) for name in ("data.db", "streamed.db", "precompressed.db")] == [DATA] * 3